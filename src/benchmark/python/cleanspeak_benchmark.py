@@ -0,0 +1,385 @@
+#
+# Copyright (c) 2016, Inversoft Inc., All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+# either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+#
+
+"""Benchmarks the CleanSpeak client against a local stand-in for the CleanSpeak API (see cleanspeak_mock_server.py) and reports the throughput,
+the p50/p99 latency, the CPU time per call and the memory of each scenario. Each scenario runs in a process of its own, so that its memory is
+not mixed up with that of the scenarios before it, and every response is checked: the run fails when a call does not succeed (unless the
+stand-in server is asked to fail some of them with --error-rate).
+
+Run it from the root of the project with:
+
+    PYTHONPATH=src/main/python python src/benchmark/python/cleanspeak_benchmark.py
+
+Save the results with --save and compare a later run against them with --compare to catch performance regressions; the run then fails when a
+scenario is slower than the saved one by more than the --tolerance.
+"""
+
+import argparse
+
+import asyncio
+
+import collections
+
+import concurrent.futures
+
+import json
+
+import multiprocessing
+
+import os
+
+import resource
+
+import socket
+
+import subprocess
+
+import sys
+
+import tempfile
+
+import threading
+
+import time
+
+import tracemalloc
+
+from com.inversoft.cleanspeak_client import CleanSpeakClient
+from com.inversoft.cleanspeak_transport import HTTP2Transport, HTTPClientTransport, RequestsTransport
+
+_MOCK_SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'test', 'python', 'com', 'inversoft', 'cleanspeak_mock_server.py')
+
+Result = collections.namedtuple('Result', ['scenario', 'calls', 'seconds', 'throughput', 'p50', 'p99', 'cpu_per_call', 'memory_kb',
+                                           'memory_growth_kb', 'failed', 'statuses'])
+
+_CONTENT = 'Hello world, this is a good game. gg! Nothing bad here.'
+
+
+def scenario_filter(client, url, calls, concurrency, statuses):
+    return _timed_calls(lambda i: client.filter({'content': _CONTENT}), calls, statuses)
+
+
+def scenario_filter_threads(client, url, calls, concurrency, statuses):
+    latencies = []
+    lock = threading.Lock()
+    per_thread = calls // concurrency
+
+    def run():
+        local = _timed_calls(lambda i: client.filter({'content': _CONTENT}), per_thread, statuses)
+        with lock:
+            latencies.extend(local)
+
+    threads = [threading.Thread(target=run) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    return latencies
+
+
+def scenario_moderate(client, url, calls, concurrency, statuses):
+    request = {'content': {'applicationId': 'f5d4bd8f-cf54-4ab5-9a4b-a6c4c2f51bc1', 'createInstant': 1, 'parts': [{'content': _CONTENT, 'type': 'text'}],
+                           'senderId': '00000000-0000-0000-0000-000000000001'}}
+    return _timed_calls(lambda i: client.moderate('00000000-0000-0000-0000-%012d' % i, request), calls, statuses)
+
+
+def scenario_moderate_prepared(client, url, calls, concurrency, statuses):
+    prepared = client.prepare_moderate({'applicationId': 'f5d4bd8f-cf54-4ab5-9a4b-a6c4c2f51bc1', 'parts': [{'type': 'text'}]})
+    return _timed_calls(lambda i: client.moderate_prepared('00000000-0000-0000-0000-%012d' % i, prepared, _CONTENT,
+                                                           '00000000-0000-0000-0000-000000000001', 1), calls, statuses)
+
+
+def scenario_retrieve_user(client, url, calls, concurrency, statuses):
+    return _timed_calls(lambda i: client.retrieve_user('00000000-0000-0000-0000-%012d' % i), calls, statuses)
+
+
+def scenario_filter_many(client, url, calls, concurrency, statuses):
+    for response in client.filter_many([{'content': _CONTENT} for _ in range(calls)], concurrency):
+        statuses.add(response)
+
+    return None
+
+
+def scenario_filter_stream(client, url, calls, concurrency, statuses):
+    for result in client.filter_stream(({'content': _CONTENT} for _ in range(calls)), window=concurrency):
+        statuses.add(result.response)
+
+    return None
+
+
+def scenario_async_filter(client, url, calls, concurrency, statuses):
+    from com.inversoft.cleanspeak_async_client import AsyncCleanSpeakClient
+
+    async def run():
+        latencies = []
+        async with AsyncCleanSpeakClient('benchmark', url, max_concurrency=concurrency, pool_maxsize=concurrency) as async_client:
+            async def call():
+                started = time.perf_counter()
+                response = await async_client.filter({'content': _CONTENT})
+                latencies.append(time.perf_counter() - started)
+                statuses.add(response)
+
+            await asyncio.gather(*[call() for _ in range(calls)])
+
+        return latencies
+
+    return asyncio.run(run())
+
+
+def scenario_backup(client, url, calls, concurrency, statuses):
+    path = os.path.join(tempfile.mkdtemp(), 'backup.zip')
+    latencies = _timed_calls(lambda i: client.backup_to_file(path, resume=False), calls, statuses)
+    os.remove(path)
+    return latencies
+
+
+def scenario_restore(client, url, calls, concurrency, statuses):
+    path = os.path.join(tempfile.mkdtemp(), 'backup.zip')
+    with open(path, 'wb') as f:
+        f.write(os.urandom(1024 * 1024))
+
+    latencies = _timed_calls(lambda i: client.restore(path), calls, statuses)
+    os.remove(path)
+    return latencies
+
+
+SCENARIOS = collections.OrderedDict([
+    ('filter', scenario_filter),
+    ('filter_threads', scenario_filter_threads),
+    ('moderate', scenario_moderate),
+    ('moderate_prepared', scenario_moderate_prepared),
+    ('retrieve_user', scenario_retrieve_user),
+    ('filter_many', scenario_filter_many),
+    ('filter_stream', scenario_filter_stream),
+    ('async_filter', scenario_async_filter),
+    ('backup', scenario_backup),
+    ('restore', scenario_restore)
+])
+
+TRANSPORTS = collections.OrderedDict([
+    ('requests', lambda concurrency: RequestsTransport(pool_maxsize=concurrency)),
+    ('http.client', lambda concurrency: HTTPClientTransport(pool_maxsize=concurrency)),
+    ('http2', lambda concurrency: HTTP2Transport(max_connections=concurrency))
+])
+
+# The transfer scenarios move a megabyte per call, so they make fewer calls
+_CALL_DIVISORS = {'backup': 20, 'restore': 20}
+
+
+def run_scenario(name, url, calls, concurrency, trace_memory=False, transport='requests'):
+    """Runs one scenario (after a short warm-up) and returns its Result. The responses of the warm-up and of the scenario are counted by
+    status in the statuses of the Result, and the ones that were not successful in its failed.
+
+    The memory_kb of the Result is the high-water mark of the resident set size of the process (in kilobytes on Linux), or the peak memory
+    allocated by Python during the scenario when trace_memory is True, and its memory_growth_kb is how much the high-water mark rose while
+    the scenario ran (after the warm-up)."""
+    scenario = SCENARIOS[name]
+    calls = max(1, calls // _CALL_DIVISORS.get(name, 1))
+    statuses = _Statuses()
+    with CleanSpeakClient('benchmark', url, pool_maxsize=concurrency, transport=TRANSPORTS[transport](concurrency)) as client:
+        scenario(client, url, max(1, calls // 10), concurrency, statuses)
+
+        if trace_memory:
+            tracemalloc.start()
+
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        cpu = time.process_time()
+        started = time.perf_counter()
+        latencies = scenario(client, url, calls, concurrency, statuses)
+        seconds = time.perf_counter() - started
+        cpu = time.process_time() - cpu
+        memory_growth_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss
+
+        if trace_memory:
+            memory_kb = tracemalloc.get_traced_memory()[1] // 1024
+            tracemalloc.stop()
+        else:
+            memory_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    p50 = p99 = None
+    if latencies:
+        latencies.sort()
+        p50 = latencies[len(latencies) // 2]
+        p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+
+    return Result(name, calls, seconds, calls / seconds, p50, p99, cpu / calls, memory_kb, memory_growth_kb, statuses.failed,
+                  dict((str(status), count) for status, count in sorted(statuses.counts.items())))
+
+
+def run_scenario_in_process(name, url, calls, concurrency, trace_memory=False, transport='requests'):
+    """Runs one scenario in a new process (see run_scenario) and returns its Result, so that the memory of the process is that of the
+    scenario alone."""
+    context = multiprocessing.get_context('spawn')
+    with concurrent.futures.ProcessPoolExecutor(1, mp_context=context) as executor:
+        # The Result class of the child process is not the one of this module when this is run as a script, so a tuple is passed back
+        values = executor.submit(_run_scenario_values, name, url, calls, concurrency, trace_memory, transport).result()
+
+    return Result(*values)
+
+
+def compare(results, baseline, tolerance):
+    """Returns a list of the regressions of the results against a baseline (a list of Result dicts saved with --save)."""
+    saved = dict((entry['scenario'], entry) for entry in baseline)
+    regressions = []
+    for result in results:
+        before = saved.get(result.scenario)
+        if before is None:
+            continue
+
+        if result.throughput < before['throughput'] * (1 - tolerance):
+            regressions.append('%s: throughput %.0f/s is below %.0f/s' % (result.scenario, result.throughput, before['throughput']))
+
+        if result.p99 is not None and before['p99'] is not None and result.p99 > before['p99'] * (1 + tolerance):
+            regressions.append('%s: p99 %.2fms is above %.2fms' % (result.scenario, result.p99 * 1000, before['p99'] * 1000))
+
+        if result.cpu_per_call > before['cpu_per_call'] * (1 + tolerance):
+            regressions.append('%s: CPU per call %.0fus is above %.0fus' % (result.scenario, result.cpu_per_call * 1e6, before['cpu_per_call'] * 1e6))
+
+    return regressions
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Benchmarks the CleanSpeak client against a local stand-in for the CleanSpeak API.')
+    parser.add_argument('scenarios', nargs='*', help='The scenarios to run (all of them by default): %s' % ', '.join(SCENARIOS))
+    parser.add_argument('--calls', type=int, default=2000, help='The number of calls made by each scenario')
+    parser.add_argument('--concurrency', type=int, default=16, help='The number of concurrent calls of the threaded, bulk and async scenarios')
+    parser.add_argument('--transport', choices=list(TRANSPORTS), default='requests', help='The transport of the client (see cleanspeak_transport)')
+    parser.add_argument('--url', help='The URL of a server to benchmark against instead of starting the stand-in server')
+    parser.add_argument('--latency', type=float, default=0.0, help='The number of seconds the stand-in server delays each request')
+    parser.add_argument('--jitter', type=float, default=0.0, help='The maximum number of seconds added at random to the latency')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='The share of requests the stand-in server answers with a 503')
+    parser.add_argument('--in-process', action='store_true', help='Run the stand-in server and the scenarios in this process (the CPU of the '
+                                                                      'server then counts too, and the max RSS includes the earlier scenarios)')
+    parser.add_argument('--trace-memory', action='store_true', help='Report the peak memory allocated by Python during each scenario '
+                                                                        '(this slows the scenarios down) instead of the peak RSS')
+    parser.add_argument('--save', help='The JSON file to save the results to')
+    parser.add_argument('--compare', help='A JSON file saved with --save to compare the results against')
+    parser.add_argument('--tolerance', type=float, default=0.15, help='The relative slowdown allowed by --compare')
+    options = parser.parse_args(args)
+    for name in options.scenarios:
+        if name not in SCENARIOS:
+            parser.error('Unknown scenario [%s]' % name)
+
+    server = process = None
+    url = options.url
+    if url is None and options.in_process:
+        sys.path.insert(0, os.path.dirname(_MOCK_SERVER))
+        from cleanspeak_mock_server import MockCleanSpeakServer
+        server = MockCleanSpeakServer(latency=options.latency, jitter=options.jitter, error_rate=options.error_rate)
+        url = server.start()
+    elif url is None:
+        port = _free_port()
+        process = subprocess.Popen([sys.executable, _MOCK_SERVER, '--port', str(port), '--latency', str(options.latency), '--jitter',
+                                    str(options.jitter), '--error-rate', str(options.error_rate)])
+        url = 'http://127.0.0.1:%d' % port
+        _wait_for_port(port)
+
+    results = []
+    try:
+        sys.stdout.write('%-18s %8s %10s %10s %10s %12s %12s %12s %8s\n' % ('scenario', 'calls', 'calls/s', 'p50 ms', 'p99 ms', 'CPU us/call',
+                                                                            'peak KB' if options.trace_memory else 'max RSS KB', 'RSS +KB',
+                                                                            'failed'))
+        run = run_scenario if options.in_process else run_scenario_in_process
+        for name in options.scenarios or SCENARIOS:
+            result = run(name, url, options.calls, options.concurrency, options.trace_memory, options.transport)
+            results.append(result)
+            sys.stdout.write('%-18s %8d %10.0f %10s %10s %12.0f %12d %12d %8d\n' % (result.scenario, result.calls, result.throughput,
+                                                                                    _ms(result.p50), _ms(result.p99), result.cpu_per_call * 1e6,
+                                                                                    result.memory_kb, result.memory_growth_kb, result.failed))
+            sys.stdout.flush()
+    finally:
+        if server is not None:
+            server.stop()
+
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    if options.save:
+        with open(options.save, 'w') as f:
+            json.dump([result._asdict() for result in results], f, indent=2)
+
+    # The stand-in server only fails calls when it is asked to, so any other failure means the numbers are not those of working calls
+    failures = [result for result in results if result.failed] if not options.error_rate else []
+    for result in failures:
+        sys.stderr.write('FAILED %s: %d calls did not succeed, statuses %s\n' % (result.scenario, result.failed, result.statuses))
+
+    regressions = []
+    if options.compare:
+        with open(options.compare) as f:
+            regressions = compare(results, json.load(f), options.tolerance)
+
+        for regression in regressions:
+            sys.stderr.write('REGRESSION %s\n' % regression)
+
+    return 1 if failures or regressions else 0
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _ms(seconds):
+    return '%.2f' % (seconds * 1000) if seconds is not None else '-'
+
+
+def _run_scenario_values(*args):
+    return tuple(run_scenario(*args))
+
+
+def _timed_calls(call, calls, statuses):
+    latencies = []
+    for i in range(calls):
+        started = time.perf_counter()
+        response = call(i)
+        latencies.append(time.perf_counter() - started)
+        statuses.add(response)
+
+    return latencies
+
+
+class _Statuses:
+    # Counts the responses by status (-1 when the call raised) and the ones that were not successful, from any thread
+    def __init__(self):
+        self.counts = collections.Counter()
+        self.failed = 0
+        self._lock = threading.Lock()
+
+    def add(self, client_response):
+        with self._lock:
+            self.counts[client_response.status] += 1
+            if not client_response.was_successful():
+                self.failed += 1
+
+
+def _wait_for_port(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 0.1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+
+    raise RuntimeError('The stand-in server did not start on port %d' % port)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,629 @@
+#
+# Copyright (c) 2016, Inversoft Inc., All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+# either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+#
+
+import asyncio
+
+import functools
+
+import time
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from com.inversoft.cleanspeak_balancer import LEAST_OUTSTANDING, Balancer
+from com.inversoft.cleanspeak_client import _ENDPOINTS, DEFAULT_JSON_CODEC, DEFAULT_RETRY_POLICY, RESTClient, Route
+from com.inversoft.cleanspeak_resilience import DeadlineExceededError, current_deadline
+from com.inversoft.cleanspeak_transport import Transport
+
+# The requests of the AsyncRESTClient are sent by its aiohttp session rather than a Transport
+_NO_TRANSPORT = Transport()
+
+# The errors after which a request may be retried
+_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError) if aiohttp is not None else ()
+
+
+class AsyncCleanSpeakClient:
+    """The AsyncCleanSpeakClient provides non-blocking access to the CleanSpeak API from asyncio code. It exposes the same end-points as the
+    CleanSpeakClient, except that each of them is a coroutine. This client requires the aiohttp package.
+
+    All of the API calls share a single pool of keep-alive connections. The pool is created on the first call (it must be created inside of the
+    event loop that will use it) and is released by close(). The client may also be used as an async context manager.
+
+    Attributes:
+        api_key: A string representing the API used to authenticate the API call to CleanSpeak. It is compiled into the headers of the requests
+            when the client is created, so it cannot be changed afterwards.
+        base_url: A string representing the URL use to access CleanSpeak WebService (i.e. https://foo-cleanspeak-api.inversoft.io), or a list
+            of the URLs of the nodes of a CleanSpeak cluster. Requests are then spread over the nodes by a Balancer (see balancer). The nodes
+            are not health checked in the background; a node is ejected when its requests fail.
+        max_concurrency: The maximum number of API calls that may be in flight at once. Calls beyond this wait for a free slot.
+        pool_maxsize: The maximum number of connections kept open to a single host
+        keep_alive_timeout: The number of seconds an idle connection is kept in the pool
+        coalesce_requests: True to share one call between identical filter and retrieve calls that are in flight at the same time. Every
+            caller receives the same AsyncClientResponse object.
+        json_codec: (Optional) The JSONCodec used to encode requests and decode responses. This defaults to the standard library json module.
+        timeout: The connect and read timeouts of each call in seconds, as a (connect, read) tuple or a single number for both. None waits
+            forever.
+        deadline: (Optional) The number of seconds each API call may take in total, including its retries and the time spent waiting for a
+            free slot. A call that runs out of time raises a DeadlineExceededError. Use cleanspeak_resilience.deadline() to set a deadline for a
+            single call.
+        retry_policy: (Optional) The RetryPolicy of the API calls, as for the CleanSpeakClient. Idempotent calls (GET, PUT, DELETE and filter)
+            are retried after a connection error, a timeout or a 429/502/503/504 status; the other calls are only retried when the connection
+            could not be opened. A call does not hold its slot of max_concurrency while it waits to be retried.
+        balancer: The Balancer that spreads requests over the nodes when base_url is a list of several nodes, otherwise None
+        balance_policy: How the Balancer chooses a node: LEAST_OUTSTANDING or EWMA (see Balancer)
+        sticky_routing: True to send the flag, moderate and moderate_update calls for a content id to the same node while it is healthy
+
+    """
+    def __init__(self, api_key, base_url, max_concurrency=100, pool_maxsize=100, keep_alive_timeout=15, coalesce_requests=False,
+                 json_codec=None, timeout=(10, 60), deadline=None, retry_policy=None, balance_policy=LEAST_OUTSTANDING, sticky_routing=False):
+        if aiohttp is None:
+            raise ImportError('The AsyncCleanSpeakClient requires the aiohttp package (pip install aiohttp)')
+
+        self.api_key = api_key
+        self.base_url = base_url
+        self._base_urls = [base_url] if isinstance(base_url, str) else list(base_url)
+        self.max_concurrency = max_concurrency
+        self.pool_maxsize = pool_maxsize
+        self.keep_alive_timeout = keep_alive_timeout
+        self.coalesce_requests = coalesce_requests
+        self.json_codec = json_codec if json_codec is not None else DEFAULT_JSON_CODEC
+        self.timeout = timeout
+        self.deadline = deadline
+        self.retry_policy = retry_policy if retry_policy is not None else DEFAULT_RETRY_POLICY
+        self.balance_policy = balance_policy
+        self.sticky_routing = sticky_routing
+        self.balancer = Balancer(self._base_urls, balance_policy, sticky_routing) if len(self._base_urls) > 1 else None
+        self._semaphore = None
+        self._single_flight = AsyncSingleFlight() if coalesce_requests else None
+        self._session = None
+        headers = {'Authorization': api_key}
+        json_headers = {'Authorization': api_key, 'Content-Type': 'application/json'}
+        route_url = '' if self.balancer is not None else self._base_urls[0]
+        self._routes = {name: Route(method, route_url, path, json_headers if json else headers)
+                        for name, (method, path, json) in _ENDPOINTS.items()}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def filter(self, filter_request):
+        """Calls CleanSpeak to filter content. This calls CleanSpeak's /content/item/filter end-point.
+
+        :parameter filter_request: The filter request that is converted to JSON and sent to CleanSpeak (see the docs for more information)
+        :type filter_request: object
+        :returns: An AsyncClientResponse object that contains the response information from the API call.
+        """
+        return await self._start('filter').request(filter_request).idempotent().coalesce(self._single_flight).go()
+
+    async def flag(self, content_id, flag_request):
+        """Calls CleanSpeak to indicate that a user has flagged another user's content (also known as reporting and often used to allow users to
+        report content/chat from other users). This calls CleanSpeak's /content/item/flag end-point.
+
+        :parameter content_id: The id of the piece of content that is being flagged (see the docs for more information).
+        :parameter flag_request: The flag request that is converted to JSON and sent to CleanSpeak (see the docs for more information)
+        :type content_id: uuid
+        :type flag_request: object
+        :returns: An AsyncClientResponse object that contains the response information from the API call.
+        """
+        return await self._start('flag', content_id).route_key(content_id).request(flag_request).go()
+
+    async def moderate(self, content_id, moderate_request):
+        """Calls CleanSpeak to moderate a piece of content according to the Application rules defined via the Management Interface. This calls
+        CleanSpeak's /content/item/moderate end-point.
+
+        :parameter content_id: (Optional) The id of the piece of content. This is only valid for persistent content Applications (see the docs for more information)
+        :parameter moderate_request: The moderate request that is converted to JSON and sent to CleanSpeak (see the docs for more information)
+        :type content_id: uuid
+        :type moderate_request: object
+        :returns: An AsyncClientResponse object that contains the response information from the API call.
+        """
+        return await self._start('moderate', content_id).route_key(content_id).request(moderate_request).go()
+
+    async def moderate_update(self, content_id, moderate_request):
+        """Calls CleanSpeak to update and re-moderate a piece of content that was updated externally by the user or a moderator. This re-moderates the
+        content according to the Application rules defined via the Management Interface. This calls CleanSpeak's /content/item/moderate end-point.
+
+        :parameter content_id: The id of the piece of content. This is only valid for persistent content Applications (see the docs for more information)
+        :parameter moderate_request: The moderate request that is converted to JSON and sent to CleanSpeak (see the docs for more information)
+        :type content_id: uuid
+        :type moderate_request: object
+        :returns: An AsyncClientResponse object that contains the response information from the API call.
+        """
+        return await self._start('moderate_update', content_id).route_key(content_id).request(moderate_request).go()
+
+    async def action_user(self, user_id, action_request):
+        """Calls CleanSpeak to notify it that a user was actioned outside of the CleanSpeak Management Interface. This calls CleanSpeak's
+        /content/user/action end-point.
+
+        :parameter user_id: The id of the user that is being actioned (see the docs for more information).
+        :parameter action_request: The action request that is converted to JSON and sent to CleanSpeak (see the docs for more information)
+        :type user_id: uuid
+        :type action_request: object
+        :returns: An AsyncClientResponse object that contains the response information from the API call.
+        """
+        return await self._start('action_user', user_id).request(action_request).go()
+
+    async def flag_user(self, user_id, flag_request):
+        """Calls CleanSpeak to indicate that a user has flagged another user for some type of inappropriate behavior. This calls CleanSpeak's
+        /content/user/flag end-point.
+
+        :parameter user_id: The id of the user that is being flagged (see the docs for more information).
+        :parameter flag_request: The flag request that is converted to JSON and sent to CleanSpeak (see the docs for more information)
+        :type user_id: uuid
+        :type flag_request: object
+        :returns: An AsyncClientResponse object that contains the response information from the API call.
+        """
+        return await self._start('flag_user', user_id).request(flag_request).go()
+
+    async def delete_all_user_content(self, user_id):
+        """Calls CleanSpeak to delete all of the content generated by a single user. This is helpful for COPPA compliance. This calls CleanSpeak's
+        /content/item end-point.
+
+        :parameter user_id: The id of the user whose content should be deleted (see the docs for more information).
+        :type user_id: uuid
+        :returns: An AsyncClientResponse object that contains the response information from the API call.
+        """
+        return await self._start('delete_all_user_content', user_id).go()
+
+    async def create_user(self, user_id, user_request):
+        """Calls CleanSpeak to create a user that will generate content (or already has). This stores the user details in CleanSpeak so that they are
+        available in the Management Interface. This calls CleanSpeak's /content/user end-point.
+
+        :parameter user_id: The id of the user being created (see the docs for more information).
+        :parameter user_request: The user request that is converted to JSON and sent to CleanSpeak (see the docs for more information)
+        :type user_id: uuid
+        :type user_request: object
+        :returns: An AsyncClientResponse object that contains the response information from the API call.
+        """
+        return await self._start('create_user', user_id).request(user_request).go()
+
+    async def retrieve_user(self, user_id):
+        """Calls CleanSpeak to retrieve a user. This calls CleanSpeak's /content/user end-point.
+
+        :parameter user_id: The id of the user being retrieved (see the docs for more information).
+        :type user_id: uuid
+        :returns: An AsyncClientResponse object that contains the response information from the API call.
+        """
+        return await self._start('retrieve_user', user_id).coalesce(self._single_flight).go()
+
+    async def update_user(self, user_id, user_request):
+        """Calls CleanSpeak to update a user that was previously created. This updates the user details in CleanSpeak so that they are
+        available in the Management Interface. This calls CleanSpeak's /content/user end-point.
+
+        :parameter user_id: The id of the user being updated (see the docs for more information).
+        :parameter user_request: The user request that is converted to JSON and sent to CleanSpeak (see the docs for more information)
+        :type user_id: uuid
+        :type user_request: object
+        :returns: An AsyncClientResponse object that contains the response information from the API call.
+        """
+        return await self._start('update_user', user_id).request(user_request).go()
+
+    async def deleted_user(self, user_id):
+        """Calls CleanSpeak to delete a user. This calls CleanSpeak's /content/user end-point.
+
+        :parameter user_id: The id of the user being deleted (see the docs for more information).
+        :type user_id: uuid
+        :returns: An AsyncClientResponse object that contains the response information from the API call.
+        """
+        return await self._start('deleted_user', user_id).go()
+
+    async def retrieve_whitelist(self):
+        """Calls CleanSpeak to retrieve the entire whitelist filter configuration. This is useful if your want to use a suggestion interface that
+        needs a set of words. This calls CleanSpeak's /filter/whitelist end-point.
+
+        :returns: An AsyncClientResponse object that contains the response information from the API call.
+        """
+        return await self._start('retrieve_whitelist').coalesce(self._single_flight).go()
+
+    async def create_application(self, application_id, application_request):
+        """Calls CleanSpeak to create an application that content will be generated in. This calls CleanSpeak's /system/application end-point.
+
+        :parameter application_id: (Optional) The id of the application being created (see the docs for more information).
+        :parameter application_request: The application request that is converted to JSON and sent to CleanSpeak (see the docs for more information)
+        :type application_id: uuid
+        :type application_request: object
+        :returns: An AsyncClientResponse object that contains the response information from the API call.
+        """
+        return await self._start('create_application', application_id).request(application_request).go()
+
+    async def retrieve_application(self, application_id):
+        """Calls CleanSpeak to retrieve an application. This calls CleanSpeak's /system/application end-point.
+
+        :parameter application_id: The id of the application being retrieved (see the docs for more information).
+        :type application_id: uuid
+        :returns: An AsyncClientResponse object that contains the response information from the API call.
+        """
+        return await self._start('retrieve_application', application_id).coalesce(self._single_flight).go()
+
+    async def retrieve_applications(self):
+        """Calls CleanSpeak to retrieve all of the applications. This calls CleanSpeak's /system/application end-point.
+
+        :returns: An AsyncClientResponse object that contains the response information from the API call.
+        """
+        return await self._start('retrieve_application').coalesce(self._single_flight).go()
+
+    async def update_application(self, application_id, application_request):
+        """Calls CleanSpeak to update an application that was previously created. This calls CleanSpeak's /system/application end-point.
+
+        :parameter application_id: The id of the application being updated (see the docs for more information).
+        :parameter application_request: The application request that is converted to JSON and sent to CleanSpeak (see the docs for more information)
+        :type application_id: uuid
+        :type application_request: object
+        :returns: An AsyncClientResponse object that contains the response information from the API call.
+        """
+        return await self._start('update_application', application_id).request(application_request).go()
+
+    async def deleted_application(self, application_id):
+        """Calls CleanSpeak to delete an application. This calls CleanSpeak's /system/application end-point.
+
+        :parameter application_id: The id of the application being deleted (see the docs for more information).
+        :type application_id: uuid
+        :returns: An AsyncClientResponse object that contains the response information from the API call.
+        """
+        return await self._start('deleted_application', application_id).go()
+
+    async def create_moderator(self, moderator_id, moderator_request):
+        """Calls CleanSpeak to create an admin/moderator that will have access to the CleanSpeak Management Interface. This calls CleanSpeak's
+        /system/user end-point.
+
+        :parameter moderator_id: (Optional) The id of the admin/moderator being created (see the docs for more information).
+        :parameter moderator_request: The admin/moderator request that is converted to JSON and sent to CleanSpeak (see the docs for more information)
+        :type moderator_id: uuid
+        :type moderator_request: object
+        :returns: An AsyncClientResponse object that contains the response information from the API call.
+        """
+        return await self._start('create_moderator', moderator_id).request(moderator_request).go()
+
+    async def retrieve_moderator(self, moderator_id):
+        """Calls CleanSpeak to retrieve an admin/moderator that has access to the CleanSpeak Management Interface. This calls CleanSpeak's
+        /system/user end-point.
+
+        :parameter moderator_id: The id of the admin/moderator being retrieved (see the docs for more information).
+        :type moderator_id: uuid
+        :returns: An AsyncClientResponse object that contains the response information from the API call.
+        """
+        return await self._start('retrieve_moderator', moderator_id).coalesce(self._single_flight).go()
+
+    async def update_moderator(self, moderator_id, moderator_request):
+        """Calls CleanSpeak to update an admin/moderator that will have access to the CleanSpeak Management Interface. This calls CleanSpeak's
+        /system/user end-point.
+
+        :parameter moderator_id: The id of the admin/moderator being updated (see the docs for more information).
+        :parameter moderator_request: The admin/moderator request that is converted to JSON and sent to CleanSpeak (see the docs for more information)
+        :type moderator_id: uuid
+        :type moderator_request: object
+        :returns: An AsyncClientResponse object that contains the response information from the API call.
+        """
+        return await self._start('update_moderator', moderator_id).request(moderator_request).go()
+
+    async def deleted_moderator(self, moderator_id):
+        """Calls CleanSpeak to delete an admin/moderator that will have access to the CleanSpeak Management Interface. This calls CleanSpeak's
+        /system/user end-point.
+
+        :parameter moderator_id: The id of the admin/moderator being deleted (see the docs for more information).
+        :type moderator_id: uuid
+        :returns: An AsyncClientResponse object that contains the response information from the API call.
+        """
+        return await self._start('deleted_moderator', moderator_id).go()
+
+    async def backup(self):
+        """Calls CleanSpeak to download a backup of the database as a ZIP file. This calls CleanSpeak's /system/backup end-point.
+
+        You should await the AsyncClientResponse#write_response_to_file(file) to write out the streamed response to a file.
+
+        :returns: An AsyncClientResponse object that contains the response information from the API call.
+        """
+        return await self._start('backup').stream_response().go()
+
+    async def restore(self, file):
+        """Calls CleanSpeak to restore the database from a backup ZIP file. This calls CleanSpeak's /system/restore end-point.
+
+        :parameter file: The backup ZIP file to restore from.
+        :type file: file
+        :returns: An AsyncClientResponse object that contains the response information from the API call.
+        """
+        return await self._start('restore').content_type('application/octet-stream').request_from_file(file).go()
+
+    async def filter_many(self, filter_requests):
+        """Filters many pieces of content concurrently using the filter() method. The number of calls in flight is bounded by the max_concurrency
+        of the client. Errors are captured rather than raised, so a failed call results in an AsyncClientResponse whose exception is set.
+
+        :parameter filter_requests: An iterable of filter requests (see filter())
+        :type filter_requests: iterable
+        :returns: A list of AsyncClientResponse objects in the same order as the requests.
+        """
+        return await asyncio.gather(*[_capture(self.filter(filter_request)) for filter_request in filter_requests])
+
+    async def moderate_many(self, moderate_requests):
+        """Moderates many pieces of content concurrently using the moderate() method. The number of calls in flight is bounded by the
+        max_concurrency of the client. Errors are captured rather than raised, so a failed call results in an AsyncClientResponse whose exception
+        is set.
+
+        :parameter moderate_requests: An iterable of (content_id, moderate_request) pairs (see moderate())
+        :type moderate_requests: iterable
+        :returns: A list of AsyncClientResponse objects in the same order as the requests.
+        """
+        return await asyncio.gather(*[_capture(self.moderate(content_id, request)) for content_id, request in moderate_requests])
+
+    async def close(self):
+        """Closes all of the pooled connections. The client should not be used after it has been closed."""
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def start(self):
+        if self._session is None:
+            connector = aiohttp.TCPConnector(limit=0, limit_per_host=self.pool_maxsize, keepalive_timeout=self.keep_alive_timeout)
+            self._session = aiohttp.ClientSession(connector=connector)
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        rest_client = AsyncRESTClient(self._session, self._semaphore, self.json_codec).authorization(self.api_key)
+        if self.balancer is not None:
+            rest_client.balance(self.balancer).url('')
+        else:
+            rest_client.url(self._base_urls[0])
+
+        return rest_client.timeout(self.timeout).deadline(self.deadline).retry(self.retry_policy)
+
+    def _start(self, endpoint, segment=None):
+        return self.start().route(self._routes[endpoint], segment)
+
+
+class AsyncSingleFlight:
+    """The asynchronous version of the SingleFlight. Only one call for a given key is in flight at once; other tasks that ask for the same key
+    await that call and receive its result (the same object).
+
+    The call runs in a task of its own that every caller awaits through asyncio.shield(), so a caller that is cancelled (i.e. by a timeout)
+    stops waiting without cancelling the call for the other callers.
+    """
+
+    def __init__(self):
+        self._calls = {}
+
+    async def do(self, key, function):
+        """Awaits the coroutine function, or the call already in flight for the key, and returns its result. An exception raised by the call is
+        raised in every waiting task.
+
+        :parameter key: The hashable key that identifies identical calls
+        :parameter function: The coroutine function to call
+        """
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.get_running_loop().create_task(function())
+            self._calls[key] = task
+            task.add_done_callback(functools.partial(self._finish, key))
+
+        return await asyncio.shield(task)
+
+    def _finish(self, key, task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+
+        # Retrieve the exception so the event loop does not log it when every caller was cancelled
+        if not task.cancelled():
+            task.exception()
+
+
+def _was_not_sent(error):
+    # The request never left the client if the connection could not be opened
+    return isinstance(error, (aiohttp.ClientConnectorError, getattr(aiohttp, 'ConnectionTimeoutError', aiohttp.ClientConnectorError)))
+
+
+async def _capture(coroutine):
+    try:
+        return await coroutine
+    except Exception as e:
+        return AsyncClientResponse(None, None, exception=e)
+
+
+class AsyncRESTClient(RESTClient):
+    """The asynchronous version of the RESTClient. Requests are built the same way, but go() is a coroutine that returns an AsyncClientResponse.
+
+    Attributes:
+        _semaphore: (Optional) The semaphore that bounds the number of requests that are in flight at once. Each attempt takes a slot.
+        _session: The aiohttp ClientSession (and connection pool) used to send the request
+
+    """
+
+    __slots__ = ('_semaphore', '_session')
+
+    def __init__(self, session, semaphore=None, codec=None):
+        RESTClient.__init__(self, _NO_TRANSPORT, codec)
+        self._semaphore = semaphore
+        self._session = session
+
+    async def go(self):
+        if self._method not in ('DELETE', 'GET', 'POST', 'PUT'):
+            raise ValueError('The HTTP method must be set to POST, PUT, GET or DELETE prior to calling go()')
+
+        deadline = current_deadline()
+        if self._deadline is not None:
+            deadline = min(deadline, time.time() + self._deadline) if deadline is not None else time.time() + self._deadline
+
+        if self._single_flight is not None:
+            return await self._single_flight.do(self._coalesce_key(), lambda: self._send_with_retries(deadline))
+
+        return await self._send_with_retries(deadline)
+
+    async def _send_with_retries(self, deadline):
+        idempotent = self._idempotent or self._method in ('GET', 'PUT', 'DELETE')
+        policy = self._retry_policy
+        failed_nodes = []
+        attempt = 1
+        while True:
+            node = self._balancer.acquire(self._route_key, failed_nodes) if self._balancer is not None else None
+            started = time.time()
+            status = -1
+            error = None
+            try:
+                client_response = await self._limited_send(deadline, self._url if node is None else node.url + self._url)
+                status = client_response.status
+            except DeadlineExceededError:
+                raise
+            except _ERRORS as e:
+                if policy is None or attempt >= policy.max_attempts or not (idempotent or _was_not_sent(e)):
+                    raise
+
+                error = e
+            finally:
+                if node is not None:
+                    self._balancer.release(node, time.time() - started, 0 <= status < 500)
+                    if status < 0 or status >= 500:
+                        failed_nodes.append(node)
+
+            if error is None:
+                if policy is None or attempt >= policy.max_attempts or not idempotent or client_response.status not in policy.retry_statuses:
+                    return client_response
+
+            delay = policy.delay(attempt)
+            if deadline is not None and time.time() + delay >= deadline:
+                if error is not None:
+                    raise DeadlineExceededError('The deadline passed before the call to [%s] completed' % self._url) from error
+
+                return client_response
+
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def _limited_send(self, deadline, url):
+        if self._semaphore is None:
+            return await self._send(deadline, url)
+
+        if deadline is None:
+            await self._semaphore.acquire()
+        else:
+            try:
+                await asyncio.wait_for(self._semaphore.acquire(), max(0.0, deadline - time.time()))
+            except asyncio.TimeoutError as e:
+                raise DeadlineExceededError('The deadline passed while the call to [%s] waited for a free slot' % url) from e
+
+        try:
+            return await self._send(deadline, url)
+        finally:
+            self._semaphore.release()
+
+    async def _send(self, deadline, url):
+        params = [(name, str(value)) for name, values in self._parameters.items() for value in values]
+        timeout = self._client_timeout(deadline, url)
+        try:
+            if self._request_file is not None:
+                with open(self._request_file, 'rb') as f:
+                    response = await self._session.request(self._method, url, headers=self._headers, params=params, data=f, timeout=timeout)
+            elif self._headers.get('Content-Type') == 'application/json':
+                body = self._codec.dumps(self._request)
+                response = await self._session.request(self._method, url, headers=self._headers, params=params, data=body, timeout=timeout)
+            else:
+                response = await self._session.request(self._method, url, headers=self._headers, params=params, timeout=timeout)
+        except asyncio.TimeoutError as e:
+            if deadline is not None and time.time() >= deadline:
+                raise DeadlineExceededError('The deadline passed before the call to [%s] completed' % url) from e
+
+            raise
+
+        if self._stream_response and 200 <= response.status <= 299:
+            return AsyncClientResponse(response, None, True, codec=self._codec)
+
+        async with response:
+            body = await response.read()
+
+        return AsyncClientResponse(response, body, codec=self._codec)
+
+    def _client_timeout(self, deadline, url):
+        connect, read = self._timeout if isinstance(self._timeout, tuple) else (self._timeout, self._timeout)
+        if deadline is None:
+            return aiohttp.ClientTimeout(total=None, connect=connect, sock_read=read)
+
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise DeadlineExceededError('The deadline passed before the call to [%s] completed' % url)
+
+        return aiohttp.ClientTimeout(total=remaining, connect=connect, sock_read=read)
+
+
+class AsyncClientResponse:
+    """The AsyncClientResponse returned from the the CleanSpeak API by the AsyncCleanSpeakClient. The response body is only decoded when
+    success_response or error_response is first used.
+
+    Attributes:
+        content: The raw (undecoded) response body, or None if it was not read
+        error_response:
+        exception: The exception raised while making the API call, if the call failed before a response was received
+        response: The full aiohttp response object
+        success_response:
+        status: The HTTP status code, or -1 if no response was received
+    """
+
+    __slots__ = ('content', 'exception', 'response', 'status', '_codec', '_decoded', '_error_response', '_streaming', '_success_response')
+
+    def __init__(self, response, body, streaming=False, exception=None, codec=None):
+        self.content = body
+        self.exception = exception
+        self.response = response
+        self.status = response.status if response is not None else -1
+        self._codec = codec if codec is not None else DEFAULT_JSON_CODEC
+        self._decoded = response is None
+        self._error_response = None
+        self._streaming = streaming
+        self._success_response = None
+
+    @property
+    def error_response(self):
+        if not self._decoded:
+            self._decode()
+
+        return self._error_response
+
+    @property
+    def success_response(self):
+        if not self._decoded:
+            self._decode()
+
+        return self._success_response
+
+    def was_successful(self):
+        return 200 <= self.status <= 299 and self.exception is None
+
+    def _decode(self):
+        self._decoded = True
+        if self.status < 200 or self.status > 299:
+            if self.content and self.status != 404:
+                if self.status == 400:
+                    try:
+                        self._error_response = self._codec.loads(self.content)
+                    except ValueError:
+                        self._error_response = None
+                else:
+                    self._error_response = self.response
+        elif not self._streaming:
+            try:
+                self._success_response = self._codec.loads(self.content)
+            except ValueError:
+                self._success_response = None
+
+    async def write_response_to_file(self, file):
+        # The file is written from the default executor so that a slow disk does not block the event loop
+        loop = asyncio.get_running_loop()
+        async with self.response:
+            f = await loop.run_in_executor(None, open, file, 'wb')
+            try:
+                async for chunk in self.response.content.iter_any():
+                    await loop.run_in_executor(None, f.write, chunk)
+            finally:
+                await loop.run_in_executor(None, f.close)
@@ -0,0 +1,223 @@
+#
+# Copyright (c) 2016, Inversoft Inc., All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+# either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+#
+
+import collections
+
+import hashlib
+
+import random
+
+import threading
+
+import time
+
+LEAST_OUTSTANDING = 'least_outstanding'
+EWMA = 'ewma'
+
+NodeStats = collections.namedtuple('NodeStats', ['url', 'healthy', 'outstanding', 'latency', 'requests', 'failures'])
+
+
+class Node:
+    """A CleanSpeak node of a Balancer and what the Balancer knows about it. The counters are updated by the Balancer under its lock.
+
+    Attributes:
+        url: The base URL of the node (i.e. https://cleanspeak-1.example.com)
+        outstanding: The number of requests in flight to the node
+        latency: The exponentially weighted moving average of the node's latency in seconds, or None before the first response
+        requests: The total number of requests sent to the node
+        failures: The number of consecutive failed requests
+        ejected_until: The time (in seconds since the epoch) until which the node is out of rotation, or None if it is healthy
+
+    """
+
+    __slots__ = ('url', 'outstanding', 'latency', 'requests', 'failures', 'ejected_until')
+
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+        self.outstanding = 0
+        self.latency = None
+        self.requests = 0
+        self.failures = 0
+        self.ejected_until = None
+
+    def healthy(self, now):
+        return self.ejected_until is None or self.ejected_until <= now
+
+
+class Balancer:
+    """The Balancer spreads the requests of a CleanSpeakClient over several CleanSpeak nodes, so the client can talk to every node of a cluster
+    directly instead of through a load balancer.
+
+    Each request goes to the better of two randomly chosen healthy nodes ("power of two choices"), which spreads load almost as evenly as
+    comparing every node at a fraction of the cost. With the LEAST_OUTSTANDING policy the better node is the one with fewer requests in flight;
+    with the EWMA policy it is the one with the lower moving average latency weighted by its requests in flight, which steers traffic away from
+    a slow node before it fails outright. A failed request counts as taking at least failure_penalty seconds, so a node that fails fast (i.e.
+    refuses connections) does not look like the fastest one. Requests with a routing key (i.e. the content id of a moderate call) can be routed
+    sticky: the key is mapped to a node with rendezvous hashing, so it keeps going to the same node while that node is healthy and only the keys
+    of an ejected node move elsewhere.
+
+    A node is ejected for eject_time seconds after max_failures consecutive failures (a connection error, a timeout or a 5xx status), or when
+    the background health check cannot reach it. It is re-admitted when a later health check succeeds or the eject_time has passed. When every
+    node is ejected, requests are spread over all of them rather than failing outright.
+
+    Attributes:
+        nodes: The Nodes
+        policy: LEAST_OUTSTANDING or EWMA
+        sticky: True to route requests that have a routing key with rendezvous hashing
+        max_failures: The number of consecutive failures after which a node is ejected
+        eject_time: The number of seconds an ejected node stays out of rotation unless a health check re-admits it sooner
+        decay: The weight of the newest latency in the EWMA (between 0 and 1)
+        failure_penalty: The latency in seconds recorded in the EWMA for a failed request that failed faster than this
+
+    """
+
+    def __init__(self, urls, policy=LEAST_OUTSTANDING, sticky=False, max_failures=3, eject_time=30, decay=0.3, failure_penalty=1.0):
+        if policy not in (LEAST_OUTSTANDING, EWMA):
+            raise ValueError('The policy must be LEAST_OUTSTANDING or EWMA')
+
+        if not urls:
+            raise ValueError('The Balancer needs at least one node')
+
+        self.nodes = [Node(url) for url in urls]
+        self.policy = policy
+        self.sticky = sticky
+        self.max_failures = max_failures
+        self.eject_time = eject_time
+        self.decay = decay
+        self.failure_penalty = failure_penalty
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._health_check = None
+
+    def acquire(self, key=None, exclude=()):
+        """Chooses the node for a request and counts the request as in flight. Every acquire() must be followed by a release().
+
+        :parameter key: (Optional) The routing key of the request, used when the Balancer is sticky
+        :parameter exclude: The nodes that should not be chosen if there is another healthy node (i.e. the nodes a retried request already failed on)
+        :type key: str
+        :type exclude: collection
+        :returns: The Node.
+        """
+        now = time.time()
+        with self._lock:
+            candidates = [node for node in self.nodes if node.healthy(now) and node not in exclude]
+            if not candidates:
+                candidates = [node for node in self.nodes if node.healthy(now)] or self.nodes
+
+            if self.sticky and key is not None:
+                node = max(candidates, key=lambda candidate: _rendezvous_weight(key, candidate.url))
+            elif len(candidates) == 1:
+                node = candidates[0]
+            else:
+                first, second = random.sample(candidates, 2)
+                node = first if self._load(first) <= self._load(second) else second
+
+            node.outstanding += 1
+            node.requests += 1
+            return node
+
+    def release(self, node, seconds, success):
+        """Records the result of a request that was sent to a node.
+
+        :parameter node: The Node returned by acquire()
+        :parameter seconds: The latency of the request
+        :parameter success: False if the request failed because of the node (a connection error, a timeout or a 5xx status)
+        :type node: Node
+        :type seconds: float
+        :type success: bool
+        """
+        if not success:
+            seconds = max(seconds, self.failure_penalty)
+
+        with self._lock:
+            node.outstanding -= 1
+            node.latency = seconds if node.latency is None else node.latency + self.decay * (seconds - node.latency)
+            if success:
+                node.failures = 0
+            else:
+                node.failures += 1
+                if node.failures >= self.max_failures:
+                    node.ejected_until = time.time() + self.eject_time
+
+    def check_health(self, probe):
+        """Probes every node once, ejecting the nodes that fail the probe and re-admitting the ejected nodes that pass it.
+
+        :parameter probe: The function called with the url of a node. It returns True if the node is healthy.
+        :type probe: function
+        """
+        for node in self.nodes:
+            try:
+                healthy = probe(node.url)
+            except Exception:
+                healthy = False
+
+            with self._lock:
+                if healthy:
+                    node.ejected_until = None
+                    node.failures = 0
+                elif node.healthy(time.time()):
+                    node.ejected_until = time.time() + self.eject_time
+
+    def start(self, probe, interval=10):
+        """Starts a background thread that calls check_health() every interval seconds."""
+        if self._thread is not None:
+            return
+
+        self._health_check = (probe, interval)
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, args=(probe, interval), name='cleanspeak-health-check', daemon=True)
+        self._thread.start()
+
+    def after_fork(self):
+        """Resets the Balancer in a child process: the requests in flight belong to the parent and the health check thread did not survive the
+        fork, so the counts are cleared and the thread is started again."""
+        self._lock = threading.Lock()
+        for node in self.nodes:
+            node.outstanding = 0
+
+        if self._thread is not None and not self._stopped.is_set():
+            self._stopped = threading.Event()
+            self._thread = None
+            self.start(*self._health_check)
+
+    def close(self):
+        """Stops the background health check thread."""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def stats(self):
+        """Returns a list with the NodeStats of every node."""
+        now = time.time()
+        with self._lock:
+            return [NodeStats(node.url, node.healthy(now), node.outstanding, node.latency, node.requests, node.failures) for node in self.nodes]
+
+    def _run(self, probe, interval):
+        while not self._stopped.wait(interval):
+            self.check_health(probe)
+
+    def _load(self, node):
+        if self.policy == LEAST_OUTSTANDING:
+            return node.outstanding
+
+        # A node without a latency yet is tried as if it were the fastest one
+        return (node.latency or 0.0) * (node.outstanding + 1)
+
+
+def _rendezvous_weight(key, url):
+    return hashlib.md5(('%s|%s' % (key, url)).encode('utf-8')).digest()
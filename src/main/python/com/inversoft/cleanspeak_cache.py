@@ -0,0 +1,332 @@
+#
+# Copyright (c) 2016, Inversoft Inc., All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+# either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+#
+
+import collections
+
+import hashlib
+
+import json
+
+import sqlite3
+
+import threading
+
+import time
+
+from com.inversoft.cleanspeak_client import CachedResponse, ClientResponse
+
+CacheStats = collections.namedtuple('CacheStats', ['hits', 'misses', 'evictions'])
+
+
+class MemoryCacheBackend:
+    """An in-process LRU cache backend. This is the default backend of the FilterCache.
+
+    Attributes:
+        max_size: The maximum number of entries. The least recently used entry is evicted when it is exceeded.
+
+    """
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the value stored under the key, or None if there is no entry or it has expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            if entry[0] < time.time():
+                del self._entries[key]
+                return None
+
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value, expires):
+        """Stores the value under the key until the expires time (in seconds since the epoch) and returns the number of entries evicted."""
+        with self._lock:
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            evicted = 0
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                evicted += 1
+
+            return evicted
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def after_fork(self):
+        self._lock = threading.Lock()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SQLiteCacheBackend:
+    """A cache backend stored in a SQLite file so that several processes on the same host share the same entries. Put the file on a memory
+    backed file system (i.e. /dev/shm) to keep it in shared memory rather than on disk.
+
+    Attributes:
+        path: The path of the SQLite file
+        max_size: The maximum number of entries. The least recently used entries are evicted when it is exceeded. Counting the entries is not
+            free, so this is checked every eviction_interval writes and the cache may briefly hold a few more entries than this.
+        eviction_interval: The number of writes between checks of the max_size
+
+    """
+
+    def __init__(self, path, max_size=100000, eviction_interval=64):
+        self.path = path
+        self.max_size = max_size
+        self.eviction_interval = eviction_interval
+        self._local = threading.local()
+        self._writes = 0
+        with self._connection() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB, expires REAL, accessed REAL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)')
+
+    def get(self, key):
+        """Returns the value stored under the key, or None if there is no entry or it has expired."""
+        now = time.time()
+        with self._connection() as connection:
+            row = connection.execute('SELECT value, expires FROM cache WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+
+            if row[1] < now:
+                connection.execute('DELETE FROM cache WHERE key = ?', (key,))
+                return None
+
+            connection.execute('UPDATE cache SET accessed = ? WHERE key = ?', (now, key))
+            return row[0]
+
+    def set(self, key, value, expires):
+        """Stores the value under the key until the expires time (in seconds since the epoch) and returns the number of entries evicted."""
+        with self._connection() as connection:
+            connection.execute('INSERT OR REPLACE INTO cache (key, value, expires, accessed) VALUES (?, ?, ?, ?)', (key, value, expires, time.time()))
+            self._writes += 1
+            if self._writes % self.eviction_interval != 0:
+                return 0
+
+            cursor = connection.execute('DELETE FROM cache WHERE key IN '
+                                        '(SELECT key FROM cache ORDER BY accessed LIMIT max(0, (SELECT count(*) FROM cache) - ?))', (self.max_size,))
+            return cursor.rowcount
+
+    def delete(self, key):
+        with self._connection() as connection:
+            connection.execute('DELETE FROM cache WHERE key = ?', (key,))
+
+    def after_fork(self):
+        # A SQLite connection must not be used across a fork, so the child opens its own
+        self._local = threading.local()
+
+    def clear(self):
+        with self._connection() as connection:
+            connection.execute('DELETE FROM cache')
+
+    def __len__(self):
+        return self._connection().execute('SELECT count(*) FROM cache').fetchone()[0]
+
+    def _connection(self):
+        # SQLite connections cannot be shared between threads, so each thread gets its own
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+
+        return connection
+
+
+class FilterCache:
+    """The FilterCache stores the results of the CleanSpeakClient filter() call so that identical requests do not need a round trip. Entries are
+    keyed on a hash of the normalized request body (the request with its keys sorted), expire after the TTL and are evicted in least recently
+    used order once the backend is full. Only successful responses are cached.
+
+    Attributes:
+        backend: The backend that stores the entries. This defaults to a MemoryCacheBackend of max_size entries.
+        ttl: The number of seconds an entry is kept
+
+    """
+
+    def __init__(self, backend=None, max_size=10000, ttl=300):
+        self.backend = backend if backend is not None else MemoryCacheBackend(max_size)
+        self.ttl = ttl
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(request):
+        """Returns the cache key of a filter request."""
+        body = json.dumps(request, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+        return hashlib.sha256(body.encode('utf-8')).hexdigest()
+
+    def get(self, key, codec=None):
+        """Returns the cached ClientResponse for the key, or None if it is not cached. The response is decoded with the codec (a JSONCodec),
+        which defaults to the standard library json module."""
+        body = self.backend.get(key)
+        with self._lock:
+            if body is None:
+                self._misses += 1
+                return None
+
+            self._hits += 1
+
+        return ClientResponse(CachedResponse(200, body), codec=codec)
+
+    def put(self, key, client_response):
+        """Caches the ClientResponse under the key if it was successful."""
+        if client_response.status != 200 or client_response.response is None:
+            return
+
+        evicted = self.backend.set(key, bytes(client_response.response.content), time.time() + self.ttl)
+        if evicted:
+            with self._lock:
+                self._evictions += evicted
+
+    def invalidate(self, request):
+        """Removes the cached response of a filter request."""
+        self.backend.delete(self.key(request))
+
+    def clear(self):
+        """Removes all of the cached responses."""
+        self.backend.clear()
+
+    def after_fork(self):
+        """Replaces the lock in a child process. The entries of a MemoryCacheBackend are copied into the child and are no longer shared with the
+        parent, while those of a SQLiteCacheBackend stay shared by every process."""
+        self._lock = threading.Lock()
+        after_fork = getattr(self.backend, 'after_fork', None)
+        if after_fork is not None:
+            after_fork()
+
+    def stats(self):
+        """Returns the hit, miss and eviction counts as a CacheStats."""
+        with self._lock:
+            return CacheStats(self._hits, self._misses, self._evictions)
+
+
+class EntityCache:
+    """The EntityCache stores the responses of the CleanSpeakClient retrieve_user, retrieve_application, retrieve_applications and
+    retrieve_moderator calls so that repeated lookups do not need a round trip. Successful responses are kept for the ttl and 404 responses
+    (the entity does not exist) for the negative_ttl. The client keeps the cache up to date with its own calls that change these entities:
+    the response of a successful create or update replaces the cached entry and the other calls (i.e. deletes) remove it.
+
+    Changes made by other clients (or other processes, unless they share a SQLiteCacheBackend) are only seen once the entries expire, so the
+    ttl bounds how stale an entry can be.
+
+    Attributes:
+        backend: The backend that stores the entries. This defaults to a MemoryCacheBackend of max_size entries.
+        ttl: The number of seconds a successful response is kept
+        negative_ttl: The number of seconds a 404 response is kept, or 0 to not cache them
+
+    """
+
+    def __init__(self, backend=None, max_size=10000, ttl=60, negative_ttl=10):
+        self.backend = backend if backend is not None else MemoryCacheBackend(max_size)
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._generation = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._lock = threading.Lock()
+
+    @property
+    def generation(self):
+        """A number that changes whenever an entry is invalidated. Pass the generation read before a call to put() so that the response of a
+        call that raced with a change is not cached."""
+        return self._generation
+
+    @staticmethod
+    def key(kind, entity_id=None):
+        """Returns the cache key of an entity (i.e. key('user', user_id)), or of a list of entities when there is no id."""
+        return kind if entity_id is None else '%s:%s' % (kind, entity_id)
+
+    def get(self, key, codec=None):
+        """Returns the cached ClientResponse for the key, or None if it is not cached. The response is decoded with the codec (a JSONCodec),
+        which defaults to the standard library json module."""
+        value = self.backend.get(key)
+        with self._lock:
+            if value is None:
+                self._misses += 1
+                return None
+
+            self._hits += 1
+
+        status, _, body = bytes(value).partition(b'\n')
+        return ClientResponse(CachedResponse(int(status), body), codec=codec)
+
+    def put(self, key, client_response, generation=None):
+        """Caches the ClientResponse under the key if it was successful or a 404. Nothing is cached if the generation is given and an entry has
+        been invalidated since it was read."""
+        if client_response.response is None:
+            return
+
+        if client_response.status == 200:
+            ttl = self.ttl
+        elif client_response.status == 404 and self.negative_ttl > 0:
+            ttl = self.negative_ttl
+        else:
+            return
+
+        if generation is not None and generation != self._generation:
+            return
+
+        body = client_response.response.content if client_response.status == 200 else b''
+        evicted = self.backend.set(key, b'%d\n' % client_response.status + bytes(body), time.time() + ttl)
+        if evicted:
+            with self._lock:
+                self._evictions += evicted
+
+    def invalidate(self, key):
+        """Removes the cached response of an entity."""
+        with self._lock:
+            self._generation += 1
+
+        self.backend.delete(key)
+
+    def clear(self):
+        """Removes all of the cached responses."""
+        with self._lock:
+            self._generation += 1
+
+        self.backend.clear()
+
+    def after_fork(self):
+        """Replaces the lock in a child process. The entries of a MemoryCacheBackend are copied into the child and are no longer shared with the
+        parent, while those of a SQLiteCacheBackend stay shared by every process."""
+        self._lock = threading.Lock()
+        after_fork = getattr(self.backend, 'after_fork', None)
+        if after_fork is not None:
+            after_fork()
+
+    def stats(self):
+        """Returns the hit, miss and eviction counts as a CacheStats."""
+        with self._lock:
+            return CacheStats(self._hits, self._misses, self._evictions)
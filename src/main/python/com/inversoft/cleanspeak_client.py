@@ -14,29 +14,274 @@
 # language governing permissions and limitations under the License.
 #
 
-import requests
+import collections
+
+import concurrent.futures
+
+import hashlib
+
+import json
+
+import os
+
+import threading
+
+import time
+
+import types
+
+import urllib.parse
+
+import weakref
+
+from json.encoder import encode_basestring_ascii as _encode_string
+
+from com.inversoft.cleanspeak_balancer import LEAST_OUTSTANDING, Balancer
+from com.inversoft.cleanspeak_dispatcher import BLOCK, Dispatcher
+from com.inversoft.cleanspeak_resilience import OPEN, CircuitOpenError, ConcurrencyLimitError, DeadlineExceededError, Hedger, RetryPolicy, \
+    current_deadline
+from com.inversoft.cleanspeak_transport import RequestsTransport
+from com.inversoft.cleanspeak_whitelist import LocalWhitelist
+
+_NO_MATCHES = b'{"matches":[]}'
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+
+
+# Shared because json.dumps() creates a new encoder on each call when it is passed any options
+_JSON_ENCODER = json.JSONEncoder(separators=(',', ':'))
+
+
+class JSONCodec:
+    """The JSONCodec encodes request bodies and decodes response bodies. This one uses the standard library json module; pass a different
+    codec (i.e. the OrjsonCodec) to the CleanSpeakClient to use a faster JSON library."""
+
+    def dumps(self, obj):
+        """Returns the JSON encoding of the object as UTF-8 bytes."""
+        return _JSON_ENCODER.encode(obj).encode('utf-8')
+
+    def loads(self, data):
+        """Returns the object decoded from JSON bytes or text. Raises a ValueError if the data is not valid JSON."""
+        return json.loads(data)
+
+
+class OrjsonCodec(JSONCodec):
+    """A JSONCodec that uses the orjson package, which is several times faster than the standard library."""
+
+    def __init__(self):
+        import orjson
+        self._orjson = orjson
+
+    def dumps(self, obj):
+        return self._orjson.dumps(obj)
+
+    def loads(self, data):
+        # orjson.JSONDecodeError is a ValueError
+        return self._orjson.loads(data)
+
+
+DEFAULT_JSON_CODEC = JSONCodec()
+
+DEFAULT_RETRY_POLICY = RetryPolicy()
+
+# The end-points of the API by the name of the method that calls them: (HTTP method, path, True if the request body is JSON)
+_ENDPOINTS = {
+    'filter': ('POST', '/content/item/filter', True),
+    'flag': ('POST', '/content/item/flag', True),
+    'moderate': ('POST', '/content/item/moderate', True),
+    'moderate_update': ('PUT', '/content/item/moderate', True),
+    'action_user': ('POST', '/content/user/action', True),
+    'flag_user': ('POST', '/content/user/flag', True),
+    'delete_all_user_content': ('DELETE', '/content/item', False),
+    'create_user': ('POST', '/content/user', True),
+    'retrieve_user': ('GET', '/content/user', False),
+    'update_user': ('PUT', '/content/user', True),
+    'deleted_user': ('DELETE', '/content/user', False),
+    'retrieve_whitelist': ('GET', '/filter/whitelist', False),
+    'create_application': ('POST', '/system/application', True),
+    'retrieve_application': ('GET', '/system/application', False),
+    'update_application': ('PUT', '/system/application', True),
+    'deleted_application': ('DELETE', '/system/application', False),
+    'create_moderator': ('POST', '/system/user', True),
+    'retrieve_moderator': ('GET', '/system/user', False),
+    'update_moderator': ('PUT', '/system/user', True),
+    'deleted_moderator': ('DELETE', '/system/user', False),
+    'backup': ('GET', '/system/backup', False),
+    'restore': ('POST', '/system/restore', False)
+}
 
 
 class CleanSpeakClient:
     """The CleanSpeakClient provides easy access to the CleanSpeak API.
 
+    All of the API calls made by a client share a single pool of keep-alive connections, so a long-lived client should be reused rather than
+    created per call. The pool is thread-safe. Call close() (or use the client as a context manager) to release the pooled sockets.
+
     Attributes:
-        api_key: A string representing the API used to authenticate the API call to CleanSpeak
-        base_url: A string representing the URL use to access CleanSpeak WebService (i.e. https://foo-cleanspeak-api.inversoft.io)
+        api_key: A string representing the API used to authenticate the API call to CleanSpeak. It is compiled into the headers of the requests
+            when the client is created, so it cannot be changed afterwards.
+        base_url: A string representing the URL use to access CleanSpeak WebService (i.e. https://foo-cleanspeak-api.inversoft.io), or a list
+            of the URLs of the nodes of a CleanSpeak cluster. Requests are then spread over the nodes by a Balancer (see balancer).
+        pool_connections: The number of per-host connection pools to keep (this only applies to the default transport)
+        pool_maxsize: The maximum number of keep-alive connections kept open to a single host (this only applies to the default transport)
+        keep_alive_timeout: (Optional) The number of seconds the pool may sit idle before its connections are discarded and re-opened. Use this
+            when a proxy or the server closes idle connections sooner than the client would notice. This only applies to the default transport.
+        warm_connections: The number of connections to open when the client is created so the first calls do not pay for the handshake
+        bulk_concurrency: The default number of concurrent calls made by the bulk methods (filter_many and moderate_many). This defaults to
+            pool_maxsize; a larger value causes connections to be opened and discarded because they do not fit in the pool.
+        filter_cache: (Optional) A FilterCache that stores the results of the filter() call
+        coalesce_requests: True to share one call between identical filter and retrieve calls that are made at the same time by different
+            threads. Every thread receives the same ClientResponse object.
+        whitelist_fast_path: True to answer filter() calls locally when every word of the content is in the whitelist. This is meant for
+            whitelist-only Applications. See local_whitelist() and LocalWhitelist.allows().
+        spool: (Optional) A Spool that the moderate, flag, action_user and delete_all_user_content calls are written to when they fail
+            because CleanSpeak could not be reached or answered with a 5xx/429 status, so they can be replayed later. Other exceptions are
+            raised. Calls for an id that already has calls in the spool are written to the spool directly to keep them in order. The returned
+            ClientResponse has spooled set to True. The client closes the spool.
+        spool_replay_interval: (Optional) The number of seconds between background replays of the spool. Without it, call replay_spool().
+        json_codec: (Optional) The JSONCodec used to encode requests and decode responses. This defaults to the standard library json module.
+        timeout: The connect and read timeouts of each attempt in seconds, as a (connect, read) tuple or a single number for both. The read
+            timeout bounds each wait for data from CleanSpeak rather than the whole response. None waits forever.
+        deadline: (Optional) The number of seconds each API call may take in total, including its retries. A call that runs out of time raises
+            a DeadlineExceededError. Use cleanspeak_resilience.deadline() to set a deadline for a single call.
+        retry_policy: (Optional) The RetryPolicy of the API calls. This defaults to 3 attempts with jittered exponential backoff. Idempotent
+            calls (GET, PUT, DELETE and filter) are retried after a connection error, a timeout or a 429/502/503/504 status; the other calls
+            are only retried when the connection could not be opened, since the request was then never sent. Pass RetryPolicy(max_attempts=1)
+            to disable retries.
+        hedge_percentile: (Optional) Enables hedging of the filter() call: when CleanSpeak has not answered within this percentile (0-100) of
+            the recent filter latencies, a second request is sent, and whichever answers first is used. See Hedger.
+        balancer: The Balancer that spreads requests over the nodes when base_url is a list of several nodes, otherwise None
+        balance_policy: How the Balancer chooses a node: LEAST_OUTSTANDING or EWMA (see Balancer)
+        sticky_routing: True to send the flag, moderate and moderate_update calls for a content id to the same node while it is healthy
+        health_check_interval: The number of seconds between background health checks of the nodes, or None to only eject nodes that fail
+            requests. A node passes the health check when a GET of the health_check_path answers without a 5xx status.
+        health_check_path: The path requested by the health checks
+        circuit_breaker: (Optional) The CircuitBreaker that stops calls from being made while CleanSpeak is failing. Its state is visible to
+            callers through circuit_breaker.state and circuit_breaker.stats(). Calls made while it is open raise a CircuitOpenError, or return
+            the result of the fallback.
+        fallback: (Optional) The function called instead of CleanSpeak while the circuit_breaker is open. It is called with the HTTP method,
+            the path and the request body of the call and returns the ClientResponse to use (i.e. one without any matches for filter calls).
+        concurrency_limiter: (Optional) The ConcurrencyLimiter that adapts the number of calls in flight to the latency and errors of CleanSpeak.
+            Its limit is visible to callers through concurrency_limiter.stats().
+        metrics: (Optional) The Metrics that record the timings of every API call by end-point and status. Each ClientResponse then holds the
+            RequestTiming of its call. Use metrics.export() to serve the metrics to a Prometheus scraper and metrics.add_hook() for tracing.
+        transport: (Optional) The Transport that sends the HTTP requests and owns the connection pool. This defaults to a RequestsTransport;
+            pass an HTTPClientTransport for a lower overhead per call or an HTTP2Transport to multiplex the calls (see cleanspeak_transport).
+            The client closes the transport.
+        entity_cache: (Optional) An EntityCache that stores the results of the retrieve_user, retrieve_application, retrieve_applications and
+            retrieve_moderator calls. The calls of this client that create, update, delete, flag or action these entities keep it up to date.
+        warm_entity_cache: True to load every application into the entity_cache when the client is created (see warm_entity_cache())
+        whitelist_store: (Optional) A WhitelistFileStore that shares the whitelist of the local_whitelist() with the other processes of the
+            host, so that only one of them retrieves it each refresh interval
+
+    A client may be created before the process forks (i.e. in the master process of a pre-forking web server). Each child then drops the
+    connections, queued calls and in-flight state it inherited, and starts its own background threads, the first time it uses the client (or
+    right after the fork where os.register_at_fork() is available). Calls queued in the Dispatcher and entries waiting to be written to the
+    spool at the time of the fork are left to the parent. A filter_cache or entity_cache with a SQLiteCacheBackend stays shared by every
+    process; a MemoryCacheBackend is copied into each child.
 
     """
-    def __init__(self, api_key, base_url):
+    def __init__(self, api_key, base_url, pool_connections=10, pool_maxsize=10, keep_alive_timeout=None, warm_connections=0,
+                 bulk_concurrency=None, filter_cache=None, coalesce_requests=False, whitelist_fast_path=False, spool=None,
+                 spool_replay_interval=None, json_codec=None, timeout=(10, 60), deadline=None, retry_policy=None, hedge_percentile=None,
+                 balance_policy=LEAST_OUTSTANDING, sticky_routing=False, health_check_interval=10, health_check_path='/', circuit_breaker=None,
+                 fallback=None, concurrency_limiter=None, metrics=None, transport=None, entity_cache=None, warm_entity_cache=False,
+                 whitelist_store=None):
         self.api_key = api_key
         self.base_url = base_url
+        self._base_urls = [base_url] if isinstance(base_url, str) else list(base_url)
+        # Every node needs its own pool, otherwise the pools of the nodes keep evicting each other
+        self.pool_connections = max(pool_connections, len(self._base_urls))
+        self.pool_maxsize = pool_maxsize
+        self.keep_alive_timeout = keep_alive_timeout
+        self.warm_connections = warm_connections
+        self.bulk_concurrency = bulk_concurrency or pool_maxsize
+        self.filter_cache = filter_cache
+        self.entity_cache = entity_cache
+        self.coalesce_requests = coalesce_requests
+        self.whitelist_fast_path = whitelist_fast_path
+        self._single_flight = SingleFlight() if coalesce_requests else None
+        self.spool = spool
+        self.json_codec = json_codec if json_codec is not None else DEFAULT_JSON_CODEC
+        self.metrics = metrics
+        self.timeout = timeout
+        self.deadline = deadline
+        self.retry_policy = retry_policy if retry_policy is not None else DEFAULT_RETRY_POLICY
+        self.hedge_percentile = hedge_percentile
+        self._filter_hedger = Hedger(hedge_percentile) if hedge_percentile is not None else None
+        self.balance_policy = balance_policy
+        self.sticky_routing = sticky_routing
+        self.health_check_interval = health_check_interval
+        self.health_check_path = health_check_path
+        self.balancer = Balancer(self._base_urls, balance_policy, sticky_routing) if len(self._base_urls) > 1 else None
+        self.circuit_breaker = circuit_breaker
+        self.fallback = fallback
+        self.concurrency_limiter = concurrency_limiter
+        self.whitelist_store = whitelist_store
+        self._dispatcher = None
+        self._local_whitelist = None
+        self._replaying = threading.local()
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        _clients.add(self)
+        # Shared by every request, so they are read-only; a request that needs another header copies them (see RESTClient.header())
+        self._headers = types.MappingProxyType({'Authorization': api_key})
+        json_headers = {'Authorization': api_key, 'Content-Type': 'application/json'}
+        route_url = '' if self.balancer is not None else self._base_urls[0]
+        self._routes = {name: Route(method, route_url, path, json_headers if json else self._headers)
+                        for name, (method, path, json) in _ENDPOINTS.items()}
+        if transport is None:
+            transport = RequestsTransport(self.pool_connections, pool_maxsize, keep_alive_timeout, instrumented=metrics is not None)
+
+        self.transport = transport
+
+        if warm_connections > 0:
+            self.warm_up(warm_connections)
+
+        if entity_cache is not None and warm_entity_cache:
+            try:
+                self.warm_entity_cache()
+            except Exception:
+                # Best-effort like warm_up(); the applications are then cached as they are retrieved
+                pass
+
+        if spool is not None and spool_replay_interval:
+            spool.start(self._replay_call, spool_replay_interval)
+
+        if self.balancer is not None and health_check_interval:
+            self.balancer.start(self._probe, health_check_interval)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
     def filter(self, filter_request):
-        """Calls CleanSpeak to filter content. This calls CleanSpeak's /content/item/filter end-point.
+        """Calls CleanSpeak to filter content. This calls CleanSpeak's /content/item/filter end-point. If the client has a filter_cache, a cached
+        response is returned when there is one. If the whitelist_fast_path is enabled and the content only contains whitelisted words, a
+        response without any matches is returned without calling CleanSpeak. Filtering is idempotent, so the call is retried and may be hedged
+        (see hedge_percentile).
 
         :parameter filter_request: The filter request that is converted to JSON and sent to CleanSpeak (see the docs for more information)
         :type filter_request: object
         :returns: A ClientResponse object that contains the response information from the API call.
         """
-        return self.start().uri('/content/item/filter').request(filter_request).post().go()
+        if self.whitelist_fast_path and self.local_whitelist().allows(filter_request):
+            return ClientResponse(CachedResponse(200, _NO_MATCHES), codec=self.json_codec)
+
+        if self.filter_cache is None:
+            return self._start('filter').request(filter_request).idempotent().hedge(self._filter_hedger) \
+                .coalesce(self._single_flight).go()
+
+        key = self.filter_cache.key(filter_request)
+        client_response = self.filter_cache.get(key, self.json_codec)
+        if client_response is None:
+            client_response = self._start('filter').request(filter_request).idempotent() \
+                .hedge(self._filter_hedger).coalesce(self._single_flight).go()
+            self.filter_cache.put(key, client_response)
+
+        return client_response
 
     def flag(self, content_id, flag_request):
         """Calls CleanSpeak to indicate that a user has flagged another user's content (also known as reporting and often used to allow users to
@@ -48,7 +293,9 @@ class CleanSpeakClient:
         :type flag_request: object
         :returns: A ClientResponse object that contains the response information from the API call.
         """
-        return self.start().uri('/content/item/flag').url_segment(content_id).request(flag_request).post().go()
+        return self._spool_on_failure('flag', content_id, (content_id, flag_request),
+                                      lambda: self._start('flag', content_id).route_key(content_id).request(flag_request)
+                                      .go())
 
     def moderate(self, content_id, moderate_request):
         """Calls CleanSpeak to moderate a piece of content according to the Application rules defined via the Management Interface. This calls
@@ -60,7 +307,43 @@ class CleanSpeakClient:
         :type moderate_request: object
         :returns: A ClientResponse object that contains the response information from the API call.
         """
-        return self.start().uri('/content/item/moderate').url_segment(content_id).request(moderate_request).post().go()
+        return self._spool_on_failure('moderate', content_id, (content_id, moderate_request),
+                                      lambda: self._start('moderate', content_id).route_key(content_id)
+                                      .request(moderate_request).go())
+
+    def prepare_moderate(self, content):
+        """Returns a PreparedModerateRequest for moderate requests that only differ by the content of their parts, their sender and their create
+        instant (i.e. the chat messages of one Application). The rest of the request is encoded once, which makes moderate_prepared() cheaper
+        than moderate() when there are many messages.
+
+        :parameter content: The content of the moderate request without the senderId, the createInstant and the content of the parts (i.e.
+            {'applicationId': application_id, 'parts': [{'name': 'message', 'type': 'text'}]})
+        :type content: dict
+        :returns: The PreparedModerateRequest.
+        """
+        return PreparedModerateRequest(content, self.json_codec)
+
+    def moderate_prepared(self, content_id, prepared, parts, sender_id, create_instant=None):
+        """Calls CleanSpeak to moderate a piece of content like moderate() does, using a request prepared by prepare_moderate(). This calls
+        CleanSpeak's /content/item/moderate end-point.
+
+        :parameter content_id: (Optional) The id of the piece of content. This is only valid for persistent content Applications (see the docs for more information)
+        :parameter prepared: The PreparedModerateRequest
+        :parameter parts: The content of the parts of the request, in the order of the parts of the prepared request. A single string may be
+            passed when there is only one part.
+        :parameter sender_id: The id of the user that sent the content
+        :parameter create_instant: (Optional) The instant the content was created in milliseconds since the epoch. This defaults to now.
+        :type content_id: uuid
+        :type prepared: PreparedModerateRequest
+        :type parts: list
+        :type sender_id: uuid
+        :type create_instant: int
+        :returns: A ClientResponse object that contains the response information from the API call.
+        """
+        body = prepared.encode(parts, sender_id, create_instant if create_instant is not None else int(time.time() * 1000))
+        # A spooled call is replayed with moderate(), so the request is only decoded if the call fails
+        return self._spool_on_failure('moderate', content_id, lambda: (content_id, self.json_codec.loads(body)),
+                                      lambda: self._start('moderate', content_id).route_key(content_id).encoded_request(body).go())
 
     def moderate_update(self, content_id, moderate_request):
         """Calls CleanSpeak to update and re-moderate a piece of content that was updated externally by the user or a moderator. This re-moderates the
@@ -72,7 +355,7 @@ class CleanSpeakClient:
         :type moderate_request: object
         :returns: A ClientResponse object that contains the response information from the API call.
         """
-        return self.start().uri('/content/item/moderate').url_segment(content_id).request(moderate_request).put().go()
+        return self._start('moderate_update', content_id).route_key(content_id).request(moderate_request).go()
 
     def action_user(self, user_id, action_request):
         """Calls CleanSpeak to notify it that a user was actioned outside of the CleanSpeak Management Interface. This calls CleanSpeak's
@@ -84,7 +367,8 @@ class CleanSpeakClient:
         :type action_request: object
         :returns: A ClientResponse object that contains the response information from the API call.
         """
-        return self.start().uri('/content/user/action').url_segment(user_id).request(action_request).post().go()
+        return self._write_through('user', user_id, lambda: self._spool_on_failure('action_user', user_id, (user_id, action_request),
+                                   lambda: self._start('action_user', user_id).request(action_request).go()), refresh=False)
 
     def flag_user(self, user_id, flag_request):
         """Calls CleanSpeak to indicate that a user has flagged another user for some type of inappropriate behavior. This calls CleanSpeak's
@@ -96,7 +380,7 @@ class CleanSpeakClient:
         :type flag_request: object
         :returns: A ClientResponse object that contains the response information from the API call.
         """
-        return self.start().uri('/content/user/flag').url_segment(user_id).request(flag_request).post().go()
+        return self._write_through('user', user_id, lambda: self._start('flag_user', user_id).request(flag_request).go(), refresh=False)
 
     def delete_all_user_content(self, user_id):
         """Calls CleanSpeak to delete all of the content generated by a single user. This is helpful for COPPA compliance. This calls CleanSpeak's
@@ -106,7 +390,8 @@ class CleanSpeakClient:
         :type user_id: uuid
         :returns: A ClientResponse object that contains the response information from the API call.
         """
-        return self.start().uri('/content/item').url_segment(user_id).delete().go()
+        return self._spool_on_failure('delete_all_user_content', user_id, (user_id,),
+                                      lambda: self._start('delete_all_user_content', user_id).go())
 
     def create_user(self, user_id, user_request):
         """Calls CleanSpeak to create a user that will generate content (or already has). This stores the user details in CleanSpeak so that they are
@@ -118,16 +403,17 @@ class CleanSpeakClient:
         :type user_request: object
         :returns: A ClientResponse object that contains the response information from the API call.
         """
-        return self.start().uri('/content/user').url_segment(user_id).request(user_request).post().go()
+        return self._write_through('user', user_id, lambda: self._start('create_user', user_id).request(user_request).go())
 
     def retrieve_user(self, user_id):
-        """Calls CleanSpeak to retrieve a user. This calls CleanSpeak's /content/user end-point.
+        """Calls CleanSpeak to retrieve a user. This calls CleanSpeak's /content/user end-point. If the client has an entity_cache, a cached
+        response is returned when there is one.
 
         :parameter user_id: The id of the user being retrieved (see the docs for more information).
         :type user_id: uuid
         :returns: A ClientResponse object that contains the response information from the API call.
         """
-        return self.start().uri('/content/user').url_segment(user_id).get().go()
+        return self._read_through('user', user_id, lambda: self._start('retrieve_user', user_id).coalesce(self._single_flight).go())
 
     def update_user(self, user_id, user_request):
         """Calls CleanSpeak to update a user that was previously created. This updates the user details in CleanSpeak so that they are
@@ -139,7 +425,7 @@ class CleanSpeakClient:
         :type user_request: object
         :returns: A ClientResponse object that contains the response information from the API call.
         """
-        return self.start().uri('/content/user').url_segment(user_id).request(user_request).put().go()
+        return self._write_through('user', user_id, lambda: self._start('update_user', user_id).request(user_request).go())
 
     def deleted_user(self, user_id):
         """Calls CleanSpeak to delete a user. This calls CleanSpeak's /content/user end-point.
@@ -148,7 +434,7 @@ class CleanSpeakClient:
         :type user_id: uuid
         :returns: A ClientResponse object that contains the response information from the API call.
         """
-        return self.start().uri('/content/user').url_segment(user_id).delete().go()
+        return self._write_through('user', user_id, lambda: self._start('deleted_user', user_id).go(), refresh=False)
 
     def retrieve_whitelist(self):
         """Calls CleanSpeak to retrieve the entire whitelist filter configuration. This is useful if your want to use a suggestion interface that
@@ -156,7 +442,7 @@ class CleanSpeakClient:
 
         :returns: A ClientResponse object that contains the response information from the API call.
         """
-        return self.start().uri('/filter/whitelist').get().go()
+        return self._start('retrieve_whitelist').coalesce(self._single_flight).go()
 
     def create_application(self, application_id, application_request):
         """Calls CleanSpeak to create an application that content will be generated in. This calls CleanSpeak's /system/application end-point.
@@ -167,23 +453,27 @@ class CleanSpeakClient:
         :type application_request: object
         :returns: A ClientResponse object that contains the response information from the API call.
         """
-        return self.start().uri('/system/application').url_segment(application_id).request(application_request).post().go()
+        return self._write_through('application', application_id,
+                                   lambda: self._start('create_application', application_id).request(application_request).go())
 
     def retrieve_application(self, application_id):
-        """Calls CleanSpeak to retrieve an application. This calls CleanSpeak's /system/application end-point.
+        """Calls CleanSpeak to retrieve an application. This calls CleanSpeak's /system/application end-point. If the client has an entity_cache, a cached
+        response is returned when there is one.
 
         :parameter application_id: The id of the application being retrieved (see the docs for more information).
         :type application_id: uuid
         :returns: A ClientResponse object that contains the response information from the API call.
         """
-        return self.start().uri('/system/application').url_segment(application_id).get().go()
+        return self._read_through('application' if application_id is not None else 'applications', application_id,
+                                  lambda: self._start('retrieve_application', application_id).coalesce(self._single_flight).go())
 
     def retrieve_applications(self):
-        """Calls CleanSpeak to retrieve all of the applications. This calls CleanSpeak's /system/application end-point.
+        """Calls CleanSpeak to retrieve all of the applications. This calls CleanSpeak's /system/application end-point. If the client has an entity_cache, a cached
+        response is returned when there is one.
 
         :returns: A ClientResponse object that contains the response information from the API call.
         """
-        return self.start().uri('/system/application').get().go()
+        return self._read_through('applications', None, lambda: self._start('retrieve_application').coalesce(self._single_flight).go())
 
     def update_application(self, application_id, application_request):
         """Calls CleanSpeak to update an application that was previously created. This calls CleanSpeak's /system/application end-point.
@@ -194,7 +484,8 @@ class CleanSpeakClient:
         :type application_request: object
         :returns: A ClientResponse object that contains the response information from the API call.
         """
-        return self.start().uri('/system/application').url_segment(application_id).request(application_request).put().go()
+        return self._write_through('application', application_id,
+                                   lambda: self._start('update_application', application_id).request(application_request).go())
 
     def deleted_application(self, application_id):
         """Calls CleanSpeak to delete an application. This calls CleanSpeak's /system/application end-point.
@@ -203,7 +494,7 @@ class CleanSpeakClient:
         :type application_id: uuid
         :returns: A ClientResponse object that contains the response information from the API call.
         """
-        return self.start().uri('/system/application').url_segment(application_id).delete().go()
+        return self._write_through('application', application_id, lambda: self._start('deleted_application', application_id).go(), refresh=False)
 
     def create_moderator(self, moderator_id, moderator_request):
         """Calls CleanSpeak to create an admin/moderator that will have access to the CleanSpeak Management Interface. This calls CleanSpeak's
@@ -215,17 +506,18 @@ class CleanSpeakClient:
         :type moderator_request: object
         :returns: A ClientResponse object that contains the response information from the API call.
         """
-        return self.start().uri('/system/user').url_segment(moderator_id).request(moderator_request).post().go()
+        return self._write_through('moderator', moderator_id, lambda: self._start('create_moderator', moderator_id).request(moderator_request).go())
 
     def retrieve_moderator(self, moderator_id):
         """Calls CleanSpeak to retrieve an admin/moderator that has access to the CleanSpeak Management Interface. This calls CleanSpeak's
-        /system/user end-point.
+        /system/user end-point. If the client has an entity_cache, a cached response is returned when there is one.
 
         :parameter moderator_id: The id of the admin/moderator being retrieved (see the docs for more information).
         :type moderator_id: uuid
         :returns: A ClientResponse object that contains the response information from the API call.
         """
-        return self.start().uri('/system/user').url_segment(moderator_id).get().go()
+        return self._read_through('moderator', moderator_id,
+                                  lambda: self._start('retrieve_moderator', moderator_id).coalesce(self._single_flight).go())
 
     def update_moderator(self, moderator_id, moderator_request):
         """Calls CleanSpeak to update an admin/moderator that will have access to the CleanSpeak Management Interface. This calls CleanSpeak's
@@ -237,7 +529,7 @@ class CleanSpeakClient:
         :type moderator_request: object
         :returns: A ClientResponse object that contains the response information from the API call.
         """
-        return self.start().uri('/system/user').url_segment(moderator_id).request(moderator_request).put().go()
+        return self._write_through('moderator', moderator_id, lambda: self._start('update_moderator', moderator_id).request(moderator_request).go())
 
     def deleted_moderator(self, moderator_id):
         """Calls CleanSpeak to delete an admin/moderator that will have access to the CleanSpeak Management Interface. This calls CleanSpeak's
@@ -247,7 +539,7 @@ class CleanSpeakClient:
         :type moderator_id: uuid
         :returns: A ClientResponse object that contains the response information from the API call.
         """
-        return self.start().uri('/system/user').url_segment(moderator_id).delete().go()
+        return self._write_through('moderator', moderator_id, lambda: self._start('deleted_moderator', moderator_id).go(), refresh=False)
 
     def backup(self):
         """Calls CleanSpeak to download a backup of the database as a ZIP file. This calls CleanSpeak's /system/backup end-point.
@@ -256,77 +548,751 @@ class CleanSpeakClient:
 
         :returns: A ClientResponse object that contains the response information from the API call.
         """
-        return self.start().uri('/system/backup').stream_response().get().go()
-
-    def restore(self, file):
-        """Calls CleanSpeak to restore the database from a backup ZIP file. This calls CleanSpeak's /system/restore end-point.
+        return self._start('backup').stream_response().go()
+
+    def backup_to_file(self, file, chunk_size=DEFAULT_CHUNK_SIZE, progress=None, resume=True):
+        """Calls CleanSpeak to download a backup of the database as a ZIP file and writes it to a file. This calls CleanSpeak's /system/backup
+        end-point.
+
+        If the file already holds part of the backup (i.e. from an interrupted download) and resume is True, only the rest is requested using a
+        Range header. If the server does not support ranges the whole backup is downloaded again. If the file already holds the whole backup
+        the server answers with a 416 status and the transfer holds the checksum of the file.
+
+        :parameter file: The path of the file to write the backup to
+        :parameter chunk_size: The number of bytes read from the network and written to the file at once
+        :parameter progress: (Optional) A function called with the number of bytes written so far and the total number of bytes (or None if it
+            is not known) after each chunk
+        :parameter resume: True to resume a partial download
+        :type file: str
+        :type chunk_size: int
+        :type progress: function
+        :type resume: bool
+        :returns: A ClientResponse object that contains the response information from the API call. When the backup was written, its transfer
+            holds the size and SHA-256 checksum of the whole file.
+        """
+        offset = os.path.getsize(file) if resume and os.path.exists(file) else 0
+        rest_client = self._start('backup').stream_response()
+        if offset > 0:
+            rest_client.header('Range', 'bytes=%d-' % offset)
+
+        client_response = rest_client.go()
+        if client_response.status == 206:
+            client_response.transfer = client_response.write_response_to_file(file, chunk_size, progress, append=True)
+        elif client_response.status == 416 and offset > 0:
+            # The file already holds the whole backup
+            client_response.response.close()
+            digest, size = _checksum_file(file, chunk_size)
+            client_response.transfer = TransferStats(size, digest.hexdigest(), 0, 0.0)
+        elif client_response.was_successful():
+            client_response.transfer = client_response.write_response_to_file(file, chunk_size, progress)
+
+        return client_response
+
+    def restore(self, file, chunk_size=DEFAULT_CHUNK_SIZE, progress=None):
+        """Calls CleanSpeak to restore the database from a backup ZIP file. This calls CleanSpeak's /system/restore end-point. The file is
+        streamed in chunks, so memory use does not depend on its size.
 
         :parameter file: The backup ZIP file to restore from.
+        :parameter chunk_size: The number of bytes read from the file and sent at once
+        :parameter progress: (Optional) A function called with the number of bytes sent so far and the size of the file after each chunk
         :type file: file
-        :returns: A ClientResponse object that contains the response information from the API call.
+        :type chunk_size: int
+        :type progress: function
+        :returns: A ClientResponse object that contains the response information from the API call. Its transfer holds the size and SHA-256
+            checksum of what was sent.
+        """
+        # CleanSpeak only answers once the restore is complete, so the read timeout does not apply to this call
+        connect_timeout = self.timeout[0] if isinstance(self.timeout, tuple) else self.timeout
+        client_response = self._start('restore').content_type('application/octet-stream').timeout((connect_timeout, None)) \
+            .request_from_file(file, chunk_size, progress).go()
+        # The restore replaces every user, application and moderator
+        if self.entity_cache is not None:
+            self.entity_cache.clear()
+
+        return client_response
+
+    def filter_many(self, filter_requests, concurrency=None):
+        """Filters many pieces of content concurrently using the filter() method. Errors are captured rather than raised, so a failed call
+        results in a ClientResponse whose exception is set.
+
+        :parameter filter_requests: An iterable of filter requests (see filter())
+        :parameter concurrency: (Optional) The number of calls to make at once. This defaults to the bulk_concurrency of the client.
+        :type filter_requests: iterable
+        :type concurrency: int
+        :returns: A list of ClientResponse objects in the same order as the requests.
         """
-        return self.start().uri('/system/restore').post().content_type('application/octet-stream').request_from_file(file).go()
+        return self._call_many(self.filter, [(filter_request,) for filter_request in filter_requests], concurrency)
+
+    def moderate_many(self, moderate_requests, concurrency=None):
+        """Moderates many pieces of content concurrently using the moderate() method. Errors are captured rather than raised, so a failed call
+        results in a ClientResponse whose exception is set.
+
+        :parameter moderate_requests: An iterable of (content_id, moderate_request) pairs (see moderate())
+        :parameter concurrency: (Optional) The number of calls to make at once. This defaults to the bulk_concurrency of the client.
+        :type moderate_requests: iterable
+        :type concurrency: int
+        :returns: A list of ClientResponse objects in the same order as the requests.
+        """
+        return self._call_many(self.moderate, [tuple(pair) for pair in moderate_requests], concurrency)
+
+    def filter_stream(self, filter_requests, window=None, ordered=False, checkpoint=None, progress=None):
+        """Filters an iterable of content (of any size) with a fixed number of calls in flight. See StreamPipeline for the details.
+
+        :parameter filter_requests: An iterable of filter requests (see filter()). It is consumed lazily.
+        :parameter window: (Optional) The number of calls to keep in flight. This defaults to the bulk_concurrency of the client.
+        :parameter ordered: True to yield the results in input order, False to yield them as they complete.
+        :parameter checkpoint: (Optional) The path of a checkpoint file used to resume an interrupted run.
+        :parameter progress: (Optional) A function called with the number of results and the elapsed seconds as the run proceeds.
+        :type filter_requests: iterable
+        :type window: int
+        :type ordered: bool
+        :type checkpoint: str
+        :type progress: function
+        :returns: A generator of StreamResult objects (index, item, response).
+        """
+        from com.inversoft.cleanspeak_stream import StreamPipeline
+        pipeline = StreamPipeline(self.filter, window or self.bulk_concurrency, ordered, checkpoint, progress=progress)
+        return pipeline.run(filter_requests)
+
+    def moderate_stream(self, moderate_requests, window=None, ordered=False, checkpoint=None, progress=None):
+        """Moderates an iterable of content (of any size) with a fixed number of calls in flight. See StreamPipeline for the details.
+
+        :parameter moderate_requests: An iterable of (content_id, moderate_request) pairs (see moderate()). It is consumed lazily.
+        :parameter window: (Optional) The number of calls to keep in flight. This defaults to the bulk_concurrency of the client.
+        :parameter ordered: True to yield the results in input order, False to yield them as they complete.
+        :parameter checkpoint: (Optional) The path of a checkpoint file used to resume an interrupted run.
+        :parameter progress: (Optional) A function called with the number of results and the elapsed seconds as the run proceeds.
+        :type moderate_requests: iterable
+        :type window: int
+        :type ordered: bool
+        :type checkpoint: str
+        :type progress: function
+        :returns: A generator of StreamResult objects (index, item, response).
+        """
+        from com.inversoft.cleanspeak_stream import StreamPipeline
+        pipeline = StreamPipeline(lambda pair: self.moderate(*pair), window or self.bulk_concurrency, ordered, checkpoint, progress=progress)
+        return pipeline.run(moderate_requests)
+
+    def sync_users(self, users, index, concurrency=None, rate=None, delete=False, max_delete_ratio=0.1, progress=None):
+        """Makes the users in CleanSpeak match the users passed in, only calling CleanSpeak for the users that were added, changed or removed
+        since the last sync with the same index. See Sync for the details.
+
+        :parameter users: An iterable of (user_id, user_request) pairs (see create_user()). It is consumed lazily.
+        :parameter index: The FingerprintIndex that records the users sent to CleanSpeak
+        :parameter concurrency: (Optional) The number of calls to make at once. This defaults to the bulk_concurrency of the client.
+        :parameter rate: (Optional) The maximum number of calls per second
+        :parameter delete: True to delete the users in the index that are not passed in
+        :parameter max_delete_ratio: The largest share of the users in the index that may be deleted. More deletes than that (or any
+            deletes when no users are passed in) are refused, see Sync.
+        :parameter progress: (Optional) A function called with the number of calls made and the elapsed seconds as the sync proceeds
+        :type users: iterable
+        :type index: FingerprintIndex
+        :type concurrency: int
+        :type rate: float
+        :type delete: bool
+        :type max_delete_ratio: float
+        :type progress: function
+        :returns: A SyncReport.
+        """
+        from com.inversoft.cleanspeak_sync import Sync
+        return Sync(self, index, 'user', concurrency, rate, delete, max_delete_ratio).run(users, progress)
+
+    def sync_applications(self, applications, index, concurrency=None, rate=None, delete=False, max_delete_ratio=0.1, progress=None):
+        """Makes the applications in CleanSpeak match the applications passed in, only calling CleanSpeak for the applications that were added,
+        changed or removed since the last sync with the same index. See Sync for the details.
+
+        :parameter applications: An iterable of (application_id, application_request) pairs (see create_application()). It is consumed lazily.
+        :parameter index: The FingerprintIndex that records the applications sent to CleanSpeak
+        :parameter concurrency: (Optional) The number of calls to make at once. This defaults to the bulk_concurrency of the client.
+        :parameter rate: (Optional) The maximum number of calls per second
+        :parameter delete: True to delete the applications in the index that are not passed in
+        :parameter max_delete_ratio: The largest share of the applications in the index that may be deleted. More deletes than that (or any
+            deletes when no applications are passed in) are refused, see Sync.
+        :parameter progress: (Optional) A function called with the number of calls made and the elapsed seconds as the sync proceeds
+        :type applications: iterable
+        :type index: FingerprintIndex
+        :type concurrency: int
+        :type rate: float
+        :type delete: bool
+        :type max_delete_ratio: float
+        :type progress: function
+        :returns: A SyncReport.
+        """
+        from com.inversoft.cleanspeak_sync import Sync
+        return Sync(self, index, 'application', concurrency, rate, delete, max_delete_ratio).run(applications, progress)
+
+    def dispatcher(self, queue_size=1000, workers=4, policy=BLOCK):
+        """Returns a Dispatcher that makes calls (i.e. flag, flag_user, action_user, create_user and update_user) in the background using this
+        client, so that the caller does not wait for them. The Dispatcher is created the first time this is called; later calls return the same
+        Dispatcher. It is flushed when the client is closed.
+
+        :parameter queue_size: The maximum number of calls waiting in the queue
+        :parameter workers: The number of worker threads
+        :parameter policy: What happens when the queue is full (BLOCK, DROP_OLDEST or REJECT, see Dispatcher)
+        :type queue_size: int
+        :type workers: int
+        :type policy: str
+        :returns: The Dispatcher.
+        """
+        self._check_fork()
+        with self._lock:
+            if self._dispatcher is None:
+                self._dispatcher = Dispatcher(self, queue_size, workers, policy)
+
+            return self._dispatcher
+
+    def local_whitelist(self, refresh_interval=300):
+        """Returns a LocalWhitelist that compiles the retrieve_whitelist() response into an in-memory index and keeps it up to date in the
+        background. The whitelist is retrieved the first time this is called; later calls return the same LocalWhitelist.
+
+        :parameter refresh_interval: The number of seconds between refreshes of the whitelist
+        :type refresh_interval: int
+        :returns: The LocalWhitelist.
+        """
+        self._check_fork()
+        with self._lock:
+            created = self._local_whitelist is None
+            if created:
+                self._local_whitelist = LocalWhitelist(self, refresh_interval, self.whitelist_store)
+
+        # Started outside of the lock because the refresh makes an API call
+        if created:
+            self._local_whitelist.start()
+
+        return self._local_whitelist
+
+    def replay_spool(self, rate=None):
+        """Replays the calls in the spool once (see Spool.replay()).
+
+        :parameter rate: (Optional) The maximum number of calls per second
+        :type rate: float
+        :returns: A ReplayResult with the number of calls sent, the number that failed, the number left in the spool and the number moved
+            to the dead letters.
+        """
+        return self.spool.replay(self._replay_call, rate=rate)
+
+    def close(self):
+        """Flushes the Dispatcher (if there is one), closes all of the pooled connections and stops any background threads. The client should
+        not be used after it has been closed."""
+        if self._dispatcher is not None:
+            self._dispatcher.close()
+
+        if self._local_whitelist is not None:
+            self._local_whitelist.close()
+
+        if self.spool is not None:
+            self.spool.close()
+
+        if self._filter_hedger is not None:
+            self._filter_hedger.close()
+
+        if self.balancer is not None:
+            self.balancer.close()
+
+        self.transport.close()
+
+    def warm_entity_cache(self):
+        """Loads every application into the entity_cache with a single retrieve_applications() call, so that the retrieve_application() and
+        retrieve_applications() calls that follow are answered from the cache.
+
+        :returns: The number of applications that were cached.
+        """
+        cache = self.entity_cache
+        generation = cache.generation
+        client_response = self._start('retrieve_application').go()
+        cache.put(cache.key('applications'), client_response, generation)
+        if client_response.status != 200 or not client_response.success_response:
+            return 0
+
+        applications = client_response.success_response.get('applications') or []
+        for application in applications:
+            response = ClientResponse(CachedResponse(200, self.json_codec.dumps({'application': application})), codec=self.json_codec)
+            cache.put(cache.key('application', application['id']), response, generation)
+
+        return len(applications)
+
+    def warm_up(self, count):
+        """Opens connections to CleanSpeak ahead of time and places them in the pool. This is best-effort; connections that cannot be opened are
+        skipped and will be opened on demand instead.
+
+        :parameter count: The number of connections to open to each node. This is capped at pool_maxsize.
+        :type count: int
+        """
+        for base_url in self._base_urls:
+            self.transport.warm_up(base_url, count)
 
     def start(self):
-        return RESTClient().authorization(self.api_key).url(self.base_url)
+        self._check_fork()
+        rest_client = RESTClient(self.transport, self.json_codec, self._headers)
+        if self.balancer is not None:
+            rest_client.balance(self.balancer).url('')
+        else:
+            rest_client.url(self._base_urls[0])
+
+        return rest_client.timeout(self.timeout).deadline(self.deadline).retry(self.retry_policy) \
+            .circuit_breaker(self.circuit_breaker, self.fallback).limit(self.concurrency_limiter).instrument(self.metrics)
+
+    def _after_fork(self):
+        # The pid is updated first so that the calls made while the components are reset do not reset them again
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._replaying = threading.local()
+        for component in (self.transport, self._dispatcher, self._local_whitelist, self.spool, self._filter_hedger, self.balancer,
+                          self.circuit_breaker, self.concurrency_limiter, self.metrics, self.filter_cache, self.entity_cache, self._single_flight):
+            after_fork = getattr(component, 'after_fork', None)
+            if after_fork is not None:
+                after_fork()
+
+    def _check_fork(self):
+        # Covers the forks that do not run the os.register_at_fork() hooks (i.e. those made by C extensions)
+        if self._pid != os.getpid():
+            self._after_fork()
+
+    def _start(self, endpoint, segment=None):
+        return self.start().route(self._routes[endpoint], segment)
+
+    def _probe(self, base_url):
+        response = self.transport.send('GET', base_url + self.health_check_path, {}, None, None, self.timeout, False)
+        response.close()
+        return response.status_code < 500
+
+    def _read_through(self, kind, entity_id, call):
+        cache = self.entity_cache
+        if cache is None:
+            return call()
+
+        key = cache.key(kind, entity_id)
+        client_response = cache.get(key, self.json_codec)
+        if client_response is None:
+            generation = cache.generation
+            client_response = call()
+            cache.put(key, client_response, generation)
+
+        return client_response
+
+    def _write_through(self, kind, entity_id, call, refresh=True):
+        cache = self.entity_cache
+        if cache is None:
+            return call()
+
+        keys = [cache.key(kind, entity_id)] if entity_id is not None else []
+        if kind == 'application':
+            keys.append(cache.key('applications'))
+
+        for key in keys:
+            cache.invalidate(key)
+
+        client_response = call()
+        # Invalidated again because a lookup made while the call was in flight may have cached the old entity
+        for key in keys:
+            cache.invalidate(key)
+
+        # The response of a create or update holds the entity the same way the response of a retrieve does
+        if refresh and entity_id is not None and client_response.status == 200:
+            cache.put(keys[0], client_response)
+
+        return client_response
+
+    def _replay_call(self, method, args):
+        self._replaying.active = True
+        try:
+            return getattr(self, method)(*args)
+        except self._retryable_errors() as e:
+            # Kept in the spool; any other exception moves the call to the dead letters
+            return ClientResponse(None, exception=e)
+        finally:
+            self._replaying.active = False
+
+    def _retryable_errors(self):
+        return tuple(self.transport.errors) + (CircuitOpenError, ConcurrencyLimitError, DeadlineExceededError)
+
+    def _spool_on_failure(self, method, key, args, call):
+        if self.spool is None or getattr(self._replaying, 'active', False):
+            return call()
+
+        if self.spool.has_pending(key):
+            client_response = ClientResponse(None)
+        else:
+            try:
+                client_response = call()
+            except self._retryable_errors() as e:
+                # Only failures to reach CleanSpeak are spooled; a programming error (i.e. a TypeError) is raised to the caller
+                client_response = ClientResponse(None, exception=e)
+
+            if client_response.response is not None and client_response.status < 500 and client_response.status != 429:
+                return client_response
+
+        self.spool.append(method, args() if callable(args) else args, key)
+        client_response.spooled = True
+        return client_response
+
+    def _call_many(self, method, arguments, concurrency):
+        if not arguments:
+            return []
+
+        workers = min(concurrency or self.bulk_concurrency, len(arguments))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(lambda args: _capture(method, *args), arguments))
+
+
+# The clients of this process, so that each child process can reset them right after a fork (see CleanSpeakClient._after_fork())
+_clients = weakref.WeakSet()
+
+
+def _after_fork_in_child():
+    for client in list(_clients):
+        if client._pid != os.getpid():
+            client._after_fork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+class SingleFlight:
+    """The SingleFlight makes sure that only one call for a given key is in flight at once. Threads that ask for a key that is already in flight
+    wait for that call and receive its result (the same object) instead of making their own call.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, function):
+        """Calls the function, or waits for the call already in flight for the key, and returns its result. An exception raised by the call is
+        raised in every waiting thread.
+
+        :parameter key: The hashable key that identifies identical calls
+        :parameter function: The function to call
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = concurrent.futures.Future()
+                self._calls[key] = future
+
+        if not leader:
+            return future.result()
+
+        try:
+            result = function()
+        except BaseException as e:
+            self._finish(key)
+            future.set_exception(e)
+            raise
+
+        self._finish(key)
+        future.set_result(result)
+        return result
+
+    def after_fork(self):
+        """Forgets the calls in flight in a child process; they were made by threads of the parent that do not exist in the child."""
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def _finish(self, key):
+        with self._lock:
+            del self._calls[key]
+
+
+def _capture(method, *args):
+    try:
+        return method(*args)
+    except Exception as e:
+        return ClientResponse(None, exception=e)
+
+
+def _cap_timeout(timeout, remaining):
+    if isinstance(timeout, tuple):
+        return tuple(remaining if value is None else min(value, remaining) for value in timeout)
+
+    return remaining if timeout is None else min(timeout, remaining)
 
 
 class RESTClient:
     """The RestClient used to build API calls to CleanSpeak.
 
     Attributes:
-        _headers: The headers
+        _balancer: (Optional) The Balancer that chooses the node each attempt is sent to. The url is then only the path of the request.
+        _breaker: (Optional) The CircuitBreaker that decides whether the request may be sent
+        _codec: The JSONCodec used to encode the request body and decode the response
+        _deadline: (Optional) The number of seconds the request may take in total, including its retries
+        _endpoint: The uri of the request without the url segments (i.e. the ids), used to label its metrics
+        _fallback: (Optional) The function called instead of sending the request when the CircuitBreaker is open
+        _headers: The headers. These may be shared with other requests, in which case they are read-only and copied by header() before they are
+            changed.
+        _hedger: (Optional) The Hedger used to send a second copy of the request when the first one is slow
+        _idempotent: True if the request may be sent more than once. GET, PUT and DELETE requests always are.
+        _limiter: (Optional) The ConcurrencyLimiter that each attempt takes a slot from
+        _metrics: (Optional) The Metrics that record the timings of each attempt
         _method: The method
         _request: The request body
+        _request_body: (Optional) The request body already encoded as JSON bytes (see encoded_request())
+        _retry_policy: (Optional) The RetryPolicy of the request
+        _route_key: (Optional) The key used to route the request to the same node as other requests with the key (see Balancer)
+        _single_flight: (Optional) The SingleFlight used to share the response of identical requests that are in flight at the same time
+        _timeout: The connect and read timeouts of each attempt
+        _transport: The Transport used to send the request. When this is None a shared RequestsTransport is used.
         _url: The url
 
     """
 
-    def __init__(self):
-        self._headers = {}
+    __slots__ = ('_balancer', '_breaker', '_codec', '_deadline', '_endpoint', '_fallback', '_headers', '_hedger', '_idempotent', '_limiter',
+                 '_method', '_metrics', '_parameters', '_request', '_request_body', '_request_file', '_request_file_chunk_size', '_request_file_progress', '_retry_policy', '_route_key',
+                 '_single_flight', '_stream_response', '_timeout', '_transport', '_url')
+
+    def __init__(self, transport=None, codec=None, headers=None):
+        self._balancer = None
+        self._breaker = None
+        self._codec = codec if codec is not None else DEFAULT_JSON_CODEC
+        self._deadline = None
+        self._endpoint = None
+        self._fallback = None
+        self._headers = headers if headers is not None else {}
+        self._hedger = None
+        self._idempotent = False
+        self._limiter = None
         self._method = None
+        self._metrics = None
         self._parameters = {}
         self._request = None
+        self._request_body = None
         self._request_file = None
+        self._request_file_chunk_size = DEFAULT_CHUNK_SIZE
+        self._request_file_progress = None
+        self._retry_policy = None
+        self._route_key = None
+        self._single_flight = None
         self._stream_response = False
+        self._timeout = None
+        self._transport = transport if transport is not None else _default_transport()
         self._url = None
 
     def authorization(self, key):
-        self._headers['Authorization'] = key
+        return self.header('Authorization', key)
+
+    def balance(self, balancer):
+        """Sends each attempt of the request to a node chosen by the Balancer, so that a retry can fail over to another node. The url must then
+        be set to the path of the request only."""
+        self._balancer = balancer
+        return self
+
+    def circuit_breaker(self, breaker, fallback=None):
+        """Only sends the request when the CircuitBreaker allows it. Otherwise the fallback is called with the method, the path of the url and
+        the request body and its result is returned, or a CircuitOpenError is raised if there is no fallback. Passing None leaves the request as is.
+        """
+        self._breaker = breaker
+        self._fallback = fallback
+        return self
+
+    def coalesce(self, single_flight):
+        """Shares the response of this request with identical requests that are in flight at the same time. This must only be used for
+        idempotent requests. Passing None leaves the request as is.
+        """
+        self._single_flight = single_flight
         return self
 
     def content_type(self, content_type):
-        self._headers['Content-Type'] = content_type
+        return self.header('Content-Type', content_type)
+
+    def deadline(self, seconds):
+        """Limits the total time of the request, including its retries, to a number of seconds. None leaves it unlimited (unless the caller is
+        inside of a cleanspeak_resilience.deadline() block)."""
+        self._deadline = seconds
         return self
 
     def delete(self):
         self._method = 'DELETE'
         return self
 
+    def encoded_request(self, body):
+        """Sets a request body that is already encoded as JSON bytes (i.e. by a PreparedModerateRequest)."""
+        if self._headers.get('Content-Type') != 'application/json':
+            self.content_type('application/json')
+
+        self._request_body = body
+        return self
+
+    def header(self, name, value):
+        if type(self._headers) is not dict:
+            self._headers = dict(self._headers)
+
+        self._headers[name] = value
+        return self
+
     def get(self):
         self._method = 'GET'
         return self
 
     def go(self):
-        if self._method == 'DELETE':
-            return ClientResponse(requests.delete(self._url, headers=self._headers, params=self._parameters))
-        elif self._method == 'GET' and self._stream_response:
-            return ClientResponse(requests.get(self._url, headers=self._headers, params=self._parameters, stream=True), True)
-        elif self._method == 'GET':
-            return ClientResponse(requests.get(self._url, headers=self._headers, params=self._parameters, stream=False))
-        elif self._method == 'POST' and self._headers['Content-Type'] == 'application/json':
-            return ClientResponse(requests.post(self._url, data=None, json=self._request, headers=self._headers, params=self._parameters))
-        elif self._method == 'PUT' and self._headers['Content-Type'] == 'application/json':
-            return ClientResponse(requests.put(self._url, data=None, json=self._request, headers=self._headers, params=self._parameters))
-        elif self._method == 'POST' and self._request_file is not None:
-            with open(self._request_file, 'rb') as f:
-                return ClientResponse(requests.post(self._url, data=f, headers=self._headers, params=self._parameters))
-        elif self._method == 'PUT' and self._request_file is not None:
+        if self._single_flight is not None:
+            return self._single_flight.do(self._coalesce_key(), self._send_hedged)
+
+        return self._send_hedged()
+
+    def hedge(self, hedger):
+        """Sends a second copy of this request when the first one is slow (see Hedger). This must only be used for idempotent requests. Passing
+        None leaves the request as is.
+        """
+        self._hedger = hedger
+        return self
+
+    def idempotent(self):
+        """Marks a POST request as idempotent, so that it is retried like GET, PUT and DELETE requests."""
+        self._idempotent = True
+        return self
+
+    def retry(self, retry_policy):
+        """Retries the request according to the RetryPolicy. Requests that are not idempotent are only retried when the connection could not
+        be opened. Passing None sends the request once.
+        """
+        self._retry_policy = retry_policy
+        return self
+
+    def timeout(self, timeout):
+        """Sets the connect and read timeouts of each attempt, as a (connect, read) tuple or a single number for both."""
+        self._timeout = timeout
+        return self
+
+    def _send_hedged(self):
+        deadline = current_deadline()
+        if self._deadline is not None:
+            deadline = min(deadline, time.time() + self._deadline) if deadline is not None else time.time() + self._deadline
+
+        if self._hedger is not None:
+            return self._hedger.run(lambda: self._send_with_retries(deadline))
+
+        return self._send_with_retries(deadline)
+
+    def _send_with_retries(self, deadline):
+        idempotent = self._idempotent or self._method in ('GET', 'PUT', 'DELETE')
+        policy = self._retry_policy
+        transport = self._transport
+        failed_nodes = []
+        attempt = 1
+        while True:
+            timeout = self._timeout
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise DeadlineExceededError('The deadline passed before the call to [%s] completed' % self._url)
+
+                timeout = _cap_timeout(timeout, remaining)
+
+            if self._breaker is not None and not self._breaker.allow():
+                if self._fallback is not None:
+                    return self._fallback(self._method, urllib.parse.urlsplit(self._url).path, self._request)
+
+                raise CircuitOpenError('The circuit breaker is open, so the call to [%s] was not made' % self._url)
+
+            if self._limiter is not None:
+                try:
+                    self._limiter.acquire(deadline)
+                except BaseException:
+                    # The call is not made (i.e. a ConcurrencyLimitError), so its outcome is never recorded
+                    if self._breaker is not None:
+                        self._breaker.cancel()
+                    raise
+
+            node = self._balancer.acquire(self._route_key, failed_nodes) if self._balancer is not None else None
+            timing = self._metrics.start(self._method, self._endpoint or self._url) if self._metrics is not None else None
+            started = time.time()
+            status = -1
+            error = None
+            try:
+                client_response = self._go(timeout, self._url if node is None else node.url + self._url, timing)
+                client_response.timing = timing
+                status = client_response.status
+            except transport.errors as e:
+                if policy is None or attempt >= policy.max_attempts or not (idempotent or transport.was_not_sent(e)):
+                    raise
+
+                error = e
+            finally:
+                seconds = time.time() - started
+                overloaded = status < 0 or status >= 500 or status == 429
+                if self._breaker is not None:
+                    self._breaker.record(not overloaded)
+
+                if self._limiter is not None:
+                    self._limiter.release(seconds, overloaded)
+
+                if node is not None:
+                    self._balancer.release(node, seconds, 0 <= status < 500)
+                    if status < 0 or status >= 500:
+                        failed_nodes.append(node)
+
+                if timing is not None:
+                    self._metrics.finish(timing, status, client_response if status >= 0 else None)
+
+            if error is None:
+                if policy is None or attempt >= policy.max_attempts or not idempotent or client_response.status not in policy.retry_statuses:
+                    return client_response
+
+            # Retrying only adds to the load of a server that the circuit breaker has given up on
+            if self._breaker is not None and self._breaker.state == OPEN:
+                if error is not None:
+                    raise error
+
+                return client_response
+
+            delay = policy.delay(attempt)
+            if deadline is not None and time.time() + delay >= deadline:
+                if error is not None:
+                    raise DeadlineExceededError('The deadline passed before the call to [%s] completed' % self._url) from error
+
+                return client_response
+
+            if error is None:
+                # Release the connection back to the pool before waiting
+                client_response.response.close()
+
+            time.sleep(delay)
+            attempt += 1
+
+    def _coalesce_key(self):
+        body = json.dumps(self._request, sort_keys=True) if self._request is not None else None
+        parameters = tuple(sorted((name, tuple(values)) for name, values in self._parameters.items()))
+        return self._method, self._url, body, parameters
+
+    def _encode(self, timing):
+        if timing is None:
+            return self._codec.dumps(self._request)
+
+        started = time.perf_counter()
+        body = self._codec.dumps(self._request)
+        timing.serialize = time.perf_counter() - started
+        return body
+
+    def _go(self, timeout=None, url=None, timing=None):
+        url = url if url is not None else self._url
+        if self._method in ('DELETE', 'GET'):
+            response = self._transport.send(self._method, url, self._headers, self._parameters, None, timeout, self._stream_response)
+            return ClientResponse(response, self._stream_response, codec=self._codec)
+        elif self._method in ('POST', 'PUT') and self._headers['Content-Type'] == 'application/json':
+            body = self._request_body if self._request_body is not None else self._encode(timing)
+            return ClientResponse(self._transport.send(self._method, url, self._headers, self._parameters, body, timeout, False), codec=self._codec)
+        elif self._method in ('POST', 'PUT') and self._request_file is not None:
             with open(self._request_file, 'rb') as f:
-                return ClientResponse(requests.put(self._url, data=f, headers=self._headers, params=self._parameters))
+                upload = _UploadStream(f, self._request_file_chunk_size, self._request_file_progress)
+                response = self._transport.send(self._method, url, self._headers, self._parameters, upload, timeout, False)
+                client_response = ClientResponse(response, codec=self._codec)
+                client_response.transfer = upload.stats()
+                return client_response
         else:
             raise ValueError('The HTTP method must be set to POST, PUT, GET or DELETE prior to calling go()')
 
+    def instrument(self, metrics):
+        """Records the timings of each attempt of the request in the Metrics. Passing None leaves the request as is."""
+        self._metrics = metrics
+        return self
+
+    def limit(self, limiter):
+        """Takes a slot from the ConcurrencyLimiter for each attempt of the request. Passing None leaves the request as is."""
+        self._limiter = limiter
+        return self
+
     def post(self):
         self._method = 'POST'
         return self
@@ -336,12 +1302,33 @@ class RESTClient:
         return self
 
     def request(self, request):
-        self.content_type('application/json')
+        if self._headers.get('Content-Type') != 'application/json':
+            self.content_type('application/json')
+
         self._request = request
         return self
 
-    def request_from_file(self, file):
+    def request_from_file(self, file, chunk_size=DEFAULT_CHUNK_SIZE, progress=None):
         self._request_file = file
+        self._request_file_chunk_size = chunk_size
+        self._request_file_progress = progress
+        return self
+
+    def route(self, route, segment=None):
+        """Sets the method, url and headers of the request from a precompiled Route, followed by an optional url segment (i.e. an id)."""
+        self._method = route.method
+        self._endpoint = route.endpoint
+        self._headers = route.headers
+        if segment is None:
+            self._url = route.url
+        else:
+            self._url = route.prefix + (segment if type(segment) is str else str(segment))
+
+        return self
+
+    def route_key(self, key):
+        """Sets the key used to route the request when the Balancer is sticky. Passing None leaves the request as is."""
+        self._route_key = key
         return self
 
     def stream_response(self):
@@ -349,11 +1336,14 @@ class RESTClient:
         return self
 
     def uri(self, uri):
+        if self._endpoint is None:
+            self._endpoint = uri
+
         if self._url is None:
             return self
 
         if self._url.endswith('/') and uri.startswith('/'):
-            self._url += uri[:1]
+            self._url += uri[1:]
         else:
             self._url += uri
 
@@ -385,40 +1375,319 @@ class RESTClient:
         return self
 
 
+_shared_transport = None
+
+_shared_transport_lock = threading.Lock()
+
+
+def _default_transport():
+    # Created on first use so that the requests library is only imported when it is needed
+    global _shared_transport
+    if _shared_transport is None:
+        with _shared_transport_lock:
+            if _shared_transport is None:
+                _shared_transport = RequestsTransport()
+
+    return _shared_transport
+
+
+class Route:
+    """A precompiled end-point of the API. The url of each request to the end-point is the url of the route, or its prefix followed by an
+    id, rather than being built up one segment at a time.
+
+    Attributes:
+        method: The HTTP method
+        endpoint: The path of the end-point (i.e. /content/item/moderate)
+        url: The full url of the end-point. This is only the path when the requests are balanced over several nodes.
+        prefix: The url followed by a slash, to which the id of a request is appended
+        headers: The read-only headers shared by the requests to the end-point
+
+    """
+
+    __slots__ = ('method', 'endpoint', 'url', 'prefix', 'headers')
+
+    def __init__(self, method, base_url, endpoint, headers):
+        self.method = method
+        self.endpoint = endpoint
+        self.url = (base_url[:-1] if base_url.endswith('/') else base_url) + endpoint
+        self.prefix = self.url + '/'
+        self.headers = types.MappingProxyType(dict(headers))
+
+
+class PreparedModerateRequest:
+    """A moderate request whose static part (i.e. the applicationId, the names and types of the parts and the location) is encoded once. Each
+    request then only encodes the content of its parts, its sender id and its create instant and splices them into the encoded static part.
+    Create one with CleanSpeakClient.prepare_moderate().
+
+    Attributes:
+        content: The content of the request without the senderId, the createInstant and the content of the parts
+
+    """
+
+    __slots__ = ('content', '_codec', '_part_count', '_pieces', '_slots')
+
+    def __init__(self, content, codec=None):
+        self.content = content
+        self._codec = codec if codec is not None else DEFAULT_JSON_CODEC
+        template = dict(content)
+        template['parts'] = [dict(part) for part in content.get('parts', ())]
+        self._part_count = len(template['parts'])
+        if self._part_count == 0:
+            raise ValueError('The content of a prepared moderate request must have at least one part')
+
+        # Each value that changes is encoded as a marker string, and the encoded request is then split on the markers
+        for i, part in enumerate(template['parts']):
+            part['content'] = '__cleanspeak_slot_%d__' % i
+
+        template['senderId'] = '__cleanspeak_slot_%d__' % self._part_count
+        template['createInstant'] = '__cleanspeak_slot_%d__' % (self._part_count + 1)
+        encoded = self._codec.dumps({'content': template})
+        markers = [self._codec.dumps('__cleanspeak_slot_%d__' % slot) for slot in range(self._part_count + 2)]
+        self._pieces = []
+        self._slots = []
+        start = 0
+        for index, slot in sorted((encoded.index(marker), slot) for slot, marker in enumerate(markers)):
+            self._pieces.append(encoded[start:index])
+            self._slots.append(slot)
+            start = index + len(markers[slot])
+
+        self._pieces.append(encoded[start:])
+
+    def encode(self, parts, sender_id, create_instant):
+        """Returns the request encoded as JSON bytes.
+
+        :parameter parts: The content of the parts, in the order of the parts of the request (or a single string when there is one part)
+        :parameter sender_id: The id of the user that sent the content
+        :parameter create_instant: The instant the content was created in milliseconds since the epoch
+        """
+        if type(parts) is str:
+            parts = (parts,)
+
+        if len(parts) != self._part_count:
+            raise ValueError('The prepared moderate request has %d parts but %d were given' % (self._part_count, len(parts)))
+
+        # Strings encode the same way with any codec, so the fast standard library string encoder is used
+        values = [_encode_string(part).encode('ascii') for part in parts]
+        values.append(_encode_string(sender_id if type(sender_id) is str else str(sender_id)).encode('ascii'))
+        values.append(str(int(create_instant)).encode('ascii'))
+        pieces = self._pieces
+        encoded = [pieces[0]]
+        for i, slot in enumerate(self._slots):
+            encoded.append(values[slot])
+            encoded.append(pieces[i + 1])
+
+        return b''.join(encoded)
+
+
 class ClientResponse:
-    """The ClientResponse returned from the the CleanSpeak API.
+    """The ClientResponse returned from the the CleanSpeak API. The response body is only decoded when success_response or error_response is
+    first used, so callers that only check the status do not pay for decoding.
 
     Attributes:
+        content: The raw (undecoded) response body, or None if no response was received
         error_response:
-        exception:
+        exception: The exception raised while making the API call, if the call failed before a response was received
         response: The full response object
+        spooled: True if the call failed and was written to the client's spool to be replayed later
         success_response:
-        status:
+        status: The HTTP status code, or -1 if no response was received
+        timing: The RequestTiming of the call if the client has Metrics, otherwise None
+        transfer: The TransferStats of a file upload or download, if there was one
     """
 
-    def __init__(self, response, streaming=False):
-        self.error_response = None
-        self.exception = None
+    __slots__ = ('exception', 'response', 'spooled', 'status', 'timing', 'transfer', '_codec', '_decoded', '_error_response', '_streaming',
+                 '_success_response')
+
+    def __init__(self, response, streaming=False, exception=None, codec=None):
+        self.exception = exception
         self.response = response
-        self.success_response = None
-        self.status = response.status_code
+        self.spooled = False
+        self.status = response.status_code if response is not None else -1
+        self.timing = None
+        self.transfer = None
+        self._codec = codec if codec is not None else DEFAULT_JSON_CODEC
+        self._decoded = response is None
+        self._error_response = None
+        self._streaming = streaming
+        self._success_response = None
+
+    @property
+    def content(self):
+        return self.response.content if self.response is not None else None
+
+    @property
+    def error_response(self):
+        if not self._decoded:
+            self._decode()
+
+        return self._error_response
+
+    @error_response.setter
+    def error_response(self, error_response):
+        self._decode()
+        self._error_response = error_response
+
+    @property
+    def success_response(self):
+        if not self._decoded:
+            self._decode()
+
+        return self._success_response
+
+    @success_response.setter
+    def success_response(self, success_response):
+        self._decode()
+        self._success_response = success_response
+
+    def was_successful(self):
+        return 200 <= self.status <= 299 and self.exception is None
+
+    def _decode(self):
+        if self._decoded:
+            return
 
+        started = time.perf_counter() if self.timing is not None else None
+        error_response = None
+        success_response = None
         if self.status < 200 or self.status > 299:
             if self.response.content is not None and self.status != 404:
                 if self.status == 400:
-                    self.error_response = self.response.json()
+                    try:
+                        error_response = self._codec.loads(self.response.content)
+                    except ValueError:
+                        pass
                 else:
-                    self.error_response = self.response
-        elif not streaming:
+                    error_response = self.response
+        elif not self._streaming:
             try:
-                self.success_response = self.response.json()
+                success_response = self._codec.loads(self.response.content)
             except ValueError:
-                self.success_response = None
+                pass
+
+        # A coalesced response is shared by several threads, so it is only marked as decoded once the result is in place. Threads that race
+        # here decode the same body and assign equal results.
+        self._error_response = error_response
+        self._success_response = success_response
+        if not self._decoded:
+            self._decoded = True
+            if started is not None:
+                self.timing.decoded(time.perf_counter() - started)
+
+    def write_response_to_file(self, file, chunk_size=DEFAULT_CHUNK_SIZE, progress=None, append=False):
+        """Writes the streamed response (i.e. of the backup() call) to a file, computing its SHA-256 checksum along the way.
+
+        :parameter file: The path of the file to write
+        :parameter chunk_size: The number of bytes read from the network and written to the file at once
+        :parameter progress: (Optional) A function called with the number of bytes written so far and the total number of bytes (or None if it
+            is not known) after each chunk
+        :parameter append: True to append to the file. The checksum then covers the existing content of the file as well.
+        :type file: str
+        :type chunk_size: int
+        :type progress: function
+        :type append: bool
+        :returns: The TransferStats of the file.
+        """
+        started = time.time()
+        if append and os.path.exists(file):
+            digest, written = _checksum_file(file, chunk_size)
+        else:
+            digest, written = hashlib.sha256(), 0
 
-    def was_successful(self):
-        return 200 <= self.status <= 299 and self.exception is None
+        length = self.response.headers.get('Content-Length')
+        total = written + int(length) if length is not None else None
+        transferred = 0
+        with open(file, 'ab' if append else 'wb') as f:
+            for chunk in self.response.iter_content(chunk_size):
+                f.write(chunk)
+                digest.update(chunk)
+                transferred += len(chunk)
+                if progress is not None:
+                    progress(written + transferred, total)
+
+        return TransferStats(written + transferred, digest.hexdigest(), transferred, time.time() - started)
+
+
+class TransferStats(collections.namedtuple('TransferStats', ['size', 'sha256', 'transferred', 'seconds'])):
+    """The result of a file upload or download.
+
+    Attributes:
+        size: The size of the file in bytes
+        sha256: The hex SHA-256 checksum of the file
+        transferred: The number of bytes that went over the network (this is less than the size when a download was resumed)
+        seconds: The number of seconds the transfer took
+    """
+    __slots__ = ()
+
+    @property
+    def megabytes_per_second(self):
+        return self.transferred / 1048576.0 / self.seconds if self.seconds > 0 else 0.0
+
+
+def _checksum_file(file, chunk_size):
+    digest = hashlib.sha256()
+    size = 0
+    with open(file, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+            size += len(chunk)
+
+    return digest, size
+
+
+class _UploadStream:
+    """A file wrapper handed to the HTTP layer for uploads. It reads the file in large chunks and checksums and reports each chunk as it is sent.
+    It has a length so the upload is sent with a Content-Length rather than chunked transfer encoding."""
+
+    def __init__(self, file, chunk_size, progress):
+        self._file = file
+        self._chunk_size = chunk_size
+        self._progress = progress
+        self._digest = hashlib.sha256()
+        self._sent = 0
+        self._started = time.time()
+        self._size = os.fstat(file.fileno()).st_size
+
+    def __len__(self):
+        return self._size - self._sent
+
+    def read(self, size=-1):
+        chunk = self._file.read(max(size, self._chunk_size) if size is not None and size >= 0 else -1)
+        if chunk:
+            self._digest.update(chunk)
+            self._sent += len(chunk)
+            if self._progress is not None:
+                self._progress(self._sent, self._size)
+
+        return chunk
+
+    def stats(self):
+        return TransferStats(self._sent, self._digest.hexdigest(), self._sent, time.time() - self._started)
+
+
+class CachedResponse:
+    """A stand-in for the HTTP response of a call that was answered without going to CleanSpeak (i.e. from a cache). It provides the parts of
+    the requests response that the ClientResponse uses.
+
+    Attributes:
+        status_code: The HTTP status code
+        content: The response body
+        headers: The response headers
+
+    """
+
+    def __init__(self, status_code, content, headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers if headers is not None else {'Content-Type': 'application/json'}
+
+    def __iter__(self):
+        return iter([self.content])
+
+    def iter_content(self, chunk_size=1, decode_unicode=False):
+        return iter([self.content])
+
+    def json(self, **kwargs):
+        return json.loads(self.content, **kwargs)
 
-    def write_response_to_file(self, file):
-        with open(file, 'wb') as f:
-            for chunk in self.response:
-                f.write(chunk)
\ No newline at end of file
+    def close(self):
+        pass
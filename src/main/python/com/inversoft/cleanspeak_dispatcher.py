@@ -0,0 +1,235 @@
+#
+# Copyright (c) 2016, Inversoft Inc., All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+# either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+#
+
+import atexit
+
+import collections
+
+import concurrent.futures
+
+import threading
+
+import weakref
+
+BLOCK = 'block'
+DROP_OLDEST = 'drop_oldest'
+REJECT = 'reject'
+
+
+# The Dispatchers that are still open, which are flushed when the interpreter exits. The set does not keep a Dispatcher alive.
+_dispatchers = weakref.WeakSet()
+
+
+def _close_dispatchers():
+    for dispatcher in list(_dispatchers):
+        dispatcher.close()
+
+
+atexit.register(_close_dispatchers)
+
+
+class DispatcherFullError(Exception):
+    """Raised when a call is rejected, or set on the future of a call that is dropped, because the Dispatcher queue is full."""
+    pass
+
+
+class Dispatcher:
+    """The Dispatcher makes CleanSpeakClient calls in the background so that the caller does not wait for them. Calls are placed in a bounded
+    in-memory queue that is drained by a pool of worker threads, each of which takes a batch of calls off the queue at a time and makes them
+    over the client's pooled connections. Every call returns a future that resolves to the ClientResponse for callers that need the answer.
+
+    Queued calls are flushed when the Dispatcher is closed, including when the interpreter exits.
+
+    Attributes:
+        client: The CleanSpeakClient used to make the calls
+        queue_size: The maximum number of calls waiting in the queue
+        workers: The number of worker threads
+        policy: What happens when the queue is full: BLOCK waits for room, DROP_OLDEST drops the oldest queued call (its future fails with a
+            DispatcherFullError) and REJECT raises a DispatcherFullError
+        batch_size: The maximum number of calls a worker takes off the queue at once
+
+    """
+
+    def __init__(self, client, queue_size=1000, workers=4, policy=BLOCK, batch_size=32):
+        if policy not in (BLOCK, DROP_OLDEST, REJECT):
+            raise ValueError('The policy must be BLOCK, DROP_OLDEST or REJECT')
+
+        self.client = client
+        self.queue_size = queue_size
+        self.workers = workers
+        self.policy = policy
+        self.batch_size = batch_size
+        self._queue = collections.deque()
+        self._unfinished = 0
+        self._closed = False
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._finished = threading.Condition(self._lock)
+        self._threads = []
+        self._start_workers()
+        _dispatchers.add(self)
+
+    def action_user(self, user_id, action_request):
+        """Queues a CleanSpeakClient action_user() call and returns a future of its ClientResponse."""
+        return self.submit('action_user', user_id, action_request)
+
+    def create_user(self, user_id, user_request):
+        """Queues a CleanSpeakClient create_user() call and returns a future of its ClientResponse."""
+        return self.submit('create_user', user_id, user_request)
+
+    def flag(self, content_id, flag_request):
+        """Queues a CleanSpeakClient flag() call and returns a future of its ClientResponse."""
+        return self.submit('flag', content_id, flag_request)
+
+    def flag_user(self, user_id, flag_request):
+        """Queues a CleanSpeakClient flag_user() call and returns a future of its ClientResponse."""
+        return self.submit('flag_user', user_id, flag_request)
+
+    def update_user(self, user_id, user_request):
+        """Queues a CleanSpeakClient update_user() call and returns a future of its ClientResponse."""
+        return self.submit('update_user', user_id, user_request)
+
+    def submit(self, method, *args):
+        """Queues a call to a CleanSpeakClient method.
+
+        :parameter method: The name of the CleanSpeakClient method (i.e. flag)
+        :parameter args: The arguments of the method
+        :type method: str
+        :returns: A concurrent.futures.Future of the ClientResponse. If the call raises, the future holds the exception.
+        """
+        future = concurrent.futures.Future()
+        dropped = None
+        with self._lock:
+            if len(self._queue) >= self.queue_size and not self._closed:
+                if self.policy == REJECT:
+                    raise DispatcherFullError('The Dispatcher queue is full')
+                elif self.policy == DROP_OLDEST:
+                    dropped = self._queue.popleft()[0]
+                    self._unfinished -= 1
+                else:
+                    while len(self._queue) >= self.queue_size and not self._closed:
+                        self._not_full.wait()
+
+            if self._closed:
+                raise RuntimeError('The Dispatcher has been closed')
+
+            self._queue.append((future, method, args))
+            self._unfinished += 1
+            self._not_empty.notify()
+
+        # Failed outside of the lock because it runs the callbacks of the future
+        if dropped is not None:
+            dropped.set_exception(DispatcherFullError('The call was dropped because the Dispatcher queue was full'))
+
+        return future
+
+    def flush(self, timeout=None):
+        """Waits until every queued call has been made.
+
+        :parameter timeout: (Optional) The maximum number of seconds to wait
+        :type timeout: float
+        :returns: True if the queue was flushed, False if the timeout expired first.
+        """
+        with self._lock:
+            return self._finished.wait_for(lambda: self._unfinished == 0, timeout)
+
+    def close(self, flush=True, timeout=None):
+        """Stops the Dispatcher. No more calls can be queued after this.
+
+        :parameter flush: True to make the queued calls before stopping, False to cancel them
+        :parameter timeout: (Optional) The maximum number of seconds to wait for the queued calls
+        :type flush: bool
+        :type timeout: float
+        """
+        if flush:
+            self.flush(timeout)
+
+        with self._lock:
+            self._closed = True
+            cancelled = [entry[0] for entry in self._queue]
+            self._queue.clear()
+            self._unfinished -= len(cancelled)
+            self._not_empty.notify_all()
+            self._not_full.notify_all()
+            self._finished.notify_all()
+
+        for future in cancelled:
+            future.cancel()
+
+        for thread in self._threads:
+            if thread is not threading.current_thread():
+                thread.join(timeout)
+
+        _dispatchers.discard(self)
+
+    def after_fork(self):
+        """Resets the Dispatcher in a child process. The queued calls belong to the parent, which makes them, so the child drops them; its
+        worker threads did not survive the fork and are started again."""
+        self._queue = collections.deque()
+        self._unfinished = 0
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._finished = threading.Condition(self._lock)
+        self._threads = []
+        if not self._closed:
+            self._start_workers()
+
+    def pending(self):
+        """Returns the number of calls that are queued or being made."""
+        with self._lock:
+            return self._unfinished
+
+    def _start_workers(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name='cleanspeak-dispatcher-%d' % i, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._queue and not self._closed:
+                    self._not_empty.wait()
+
+                if not self._queue:
+                    return
+
+                # Leave work for the other workers rather than draining the queue into a single batch
+                size = max(1, min(self.batch_size, len(self._queue) // self.workers))
+                batch = [self._queue.popleft() for _ in range(size)]
+                self._not_full.notify_all()
+
+            try:
+                for future, method, args in batch:
+                    if future.set_running_or_notify_cancel():
+                        try:
+                            future.set_result(getattr(self.client, method)(*args))
+                        except Exception as e:
+                            future.set_exception(e)
+                        except BaseException as e:
+                            future.set_exception(e)
+                            raise
+            finally:
+                # A BaseException (i.e. SystemExit) ends the worker; the rest of its batch is cancelled so that flush() does not wait for it
+                for future, _, _ in batch:
+                    future.cancel()
+
+                with self._lock:
+                    self._unfinished -= len(batch)
+                    if self._unfinished == 0:
+                        self._finished.notify_all()
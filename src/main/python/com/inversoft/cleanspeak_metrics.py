@@ -0,0 +1,259 @@
+#
+# Copyright (c) 2016, Inversoft Inc., All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+# either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+#
+
+import bisect
+
+import threading
+
+import time
+
+import weakref
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+PHASES = ('connect', 'serialize', 'ttfb', 'read', 'decode', 'total')
+
+# The connections opened (and the seconds spent opening them) by each thread, updated by the transports (see record_connect())
+_connects = threading.local()
+
+
+class RequestTiming:
+    """The timings of one attempt of an API call. Every time is in seconds; a phase that did not happen is 0.
+
+    Attributes:
+        method: The HTTP method
+        endpoint: The path of the end-point without any ids (i.e. /content/item/moderate)
+        status: The HTTP status, or -1 if no response was received
+        new_connection: True if a new connection was opened for the request, False if a pooled connection was reused
+        connect: The time spent opening the connection (including the TLS handshake)
+        serialize: The time spent encoding the request body
+        ttfb: The time from sending the request until the response headers were received (including connect)
+        read: The time spent reading the response body
+        decode: The time spent decoding the response body. Decoding is lazy, so this is only known once the response has been used.
+        total: The total time of the attempt, not including decode
+
+    """
+
+    __slots__ = ('method', 'endpoint', 'status', 'new_connection', 'connect', 'serialize', 'ttfb', 'read', 'decode', 'total', '_connects',
+                 '_metrics', '_started')
+
+    def __init__(self, metrics, method, endpoint):
+        self.method = method
+        self.endpoint = endpoint
+        self.status = -1
+        self.new_connection = False
+        self.connect = 0.0
+        self.serialize = 0.0
+        self.ttfb = 0.0
+        self.read = 0.0
+        self.decode = 0.0
+        self.total = 0.0
+        self._connects = (getattr(_connects, 'count', 0), getattr(_connects, 'seconds', 0.0))
+        self._metrics = metrics
+        self._started = time.perf_counter()
+
+    def decoded(self, seconds):
+        """Records the time spent decoding the response body."""
+        self.decode = seconds
+        self._metrics.observe('decode', self.endpoint, self.status, seconds)
+
+    def __repr__(self):
+        return 'RequestTiming(%s %s %d total=%.6f)' % (self.method, self.endpoint, self.status, self.total)
+
+
+class Metrics:
+    """Latency histograms and counters of the API calls made by a CleanSpeakClient, labeled by end-point, method and status.
+
+    Recording is kept off of any lock: each thread records into its own shard, and snapshot() adds the shards up. A snapshot taken while calls
+    are being recorded may therefore miss the last few of them, but never blocks the callers. The shard of a thread that has ended is folded
+    into a shared one, so short-lived threads (i.e. those of filter_many()) do not pile up. Instrumentation only happens when a Metrics is
+    passed to the client; without one the only cost on each call is a check for None.
+
+    Attributes:
+        buckets: The upper bounds (in seconds) of the histogram buckets
+        prefix: The prefix of the exported metric names
+
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, prefix='cleanspeak_client'):
+        self.buckets = tuple(buckets)
+        self.prefix = prefix
+        self._hooks = []
+        self._retired = _Shard()
+        self._shards = [self._retired]
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def add_hook(self, hook):
+        """Adds a function that is called with the RequestTiming of every attempt once it completes (i.e. to feed a tracing system). Exceptions
+        raised by a hook are ignored so that tracing can never fail an API call."""
+        self._hooks = self._hooks + [hook]
+
+    def remove_hook(self, hook):
+        self._hooks = [existing for existing in self._hooks if existing is not hook]
+
+    def start(self, method, endpoint):
+        """Returns the RequestTiming of an attempt that is about to start."""
+        return RequestTiming(self, method, endpoint)
+
+    def finish(self, timing, status, client_response=None):
+        """Completes the RequestTiming of an attempt, records it and calls the hooks."""
+        timing.total = time.perf_counter() - timing._started
+        timing.status = status
+        count, seconds = getattr(_connects, 'count', 0), getattr(_connects, 'seconds', 0.0)
+        timing.new_connection = count > timing._connects[0]
+        timing.connect = seconds - timing._connects[1]
+        response = client_response.response if client_response is not None else None
+        elapsed = getattr(response, 'elapsed', None)
+        if elapsed is not None:
+            timing.ttfb = elapsed.total_seconds()
+            timing.read = max(0.0, timing.total - timing.serialize - timing.ttfb)
+
+        shard = self._shard()
+        key = (timing.endpoint, timing.method, status)
+        shard.counters[key] = shard.counters.get(key, 0) + 1
+        if timing.new_connection:
+            shard.connections[timing.endpoint] = shard.connections.get(timing.endpoint, 0) + 1
+
+        for phase in PHASES:
+            # The response is decoded lazily, so its time is recorded by decoded()
+            if phase != 'decode':
+                self._observe(shard, phase, timing.endpoint, status, getattr(timing, phase))
+
+        for hook in self._hooks:
+            try:
+                hook(timing)
+            except Exception:
+                pass
+
+    def after_fork(self):
+        """Starts over in a child process, so that the calls recorded by the parent are not exported twice."""
+        self._retired = _Shard()
+        self._shards = [self._retired]
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def observe(self, phase, endpoint, status, seconds):
+        """Records a time in the histogram of a phase of an end-point and status (-1 if there was no response)."""
+        self._observe(self._shard(), phase, endpoint, status, seconds)
+
+    def snapshot(self):
+        """Adds up the shards of every thread.
+
+        :returns: A dict with 'requests' ({(endpoint, method, status): count}), 'new_connections' ({endpoint: count}) and 'latency'
+            ({(phase, endpoint, status): (bucket counts, sum, count)}, where the bucket counts are not cumulative).
+        """
+        merged = _Shard()
+        with self._lock:
+            for shard in self._shards:
+                merged.add(shard)
+
+        return {
+            'requests': merged.counters,
+            'new_connections': merged.connections,
+            'latency': {key: (tuple(value[:-2]), value[-2], value[-1]) for key, value in merged.histograms.items()}
+        }
+
+    def export(self):
+        """Returns the metrics in the Prometheus text exposition format."""
+        snapshot = self.snapshot()
+        lines = ['# HELP %s_requests_total The number of API calls (attempts) made.' % self.prefix,
+                 '# TYPE %s_requests_total counter' % self.prefix]
+        for (endpoint, method, status), value in sorted(snapshot['requests'].items()):
+            lines.append('%s_requests_total{endpoint="%s",method="%s",status="%d"} %d' % (self.prefix, _escape(endpoint), method, status, value))
+
+        lines.append('# HELP %s_new_connections_total The number of connections opened.' % self.prefix)
+        lines.append('# TYPE %s_new_connections_total counter' % self.prefix)
+        for endpoint, value in sorted(snapshot['new_connections'].items()):
+            lines.append('%s_new_connections_total{endpoint="%s"} %d' % (self.prefix, _escape(endpoint), value))
+
+        lines.append('# HELP %s_seconds The time spent in each phase of the API calls.' % self.prefix)
+        lines.append('# TYPE %s_seconds histogram' % self.prefix)
+        for (phase, endpoint, status), (buckets, total, count) in sorted(snapshot['latency'].items()):
+            labels = 'endpoint="%s",phase="%s",status="%d"' % (_escape(endpoint), phase, status)
+            cumulative = 0
+            for bound, value in zip(self.buckets + (float('inf'),), buckets):
+                cumulative += value
+                lines.append('%s_seconds_bucket{%s,le="%s"} %d' % (self.prefix, labels, '+Inf' if bound == float('inf') else repr(bound), cumulative))
+
+            lines.append('%s_seconds_sum{%s} %.9f' % (self.prefix, labels, total))
+            lines.append('%s_seconds_count{%s} %d' % (self.prefix, labels, count))
+
+        return '\n'.join(lines) + '\n'
+
+    def _observe(self, shard, phase, endpoint, status, seconds):
+        key = (phase, endpoint, status)
+        histogram = shard.histograms.get(key)
+        if histogram is None:
+            # The buckets, then the +Inf bucket, the sum and the count
+            histogram = shard.histograms[key] = [0] * (len(self.buckets) + 3)
+
+        histogram[bisect.bisect_left(self.buckets, seconds)] += 1
+        histogram[-2] += seconds
+        histogram[-1] += 1
+
+    def _retire(self, shard):
+        with self._lock:
+            self._retired.add(shard)
+            self._shards.remove(shard)
+
+    def _shard(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._local.shard = _Shard()
+            with self._lock:
+                self._shards.append(shard)
+
+            weakref.finalize(threading.current_thread(), self._retire, shard)
+
+        return shard
+
+
+class _Shard:
+    __slots__ = ('connections', 'counters', 'histograms')
+
+    def __init__(self):
+        self.connections = {}
+        self.counters = {}
+        self.histograms = {}
+
+    def add(self, other):
+        # Copied first because the thread that owns the other shard may be recording into it
+        for key, value in list(other.counters.items()):
+            self.counters[key] = self.counters.get(key, 0) + value
+
+        for key, value in list(other.connections.items()):
+            self.connections[key] = self.connections.get(key, 0) + value
+
+        for key, histogram in list(other.histograms.items()):
+            merged = self.histograms.get(key)
+            if merged is None:
+                merged = self.histograms[key] = [0] * len(histogram)
+
+            for i, value in enumerate(list(histogram)):
+                merged[i] += value
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def record_connect(started):
+    """Records that the current thread opened a connection, which started at the given time.perf_counter(). This is called by the transports
+    (see cleanspeak_transport) so that the RequestTiming can tell a new connection from a reused one."""
+    _connects.count = getattr(_connects, 'count', 0) + 1
+    _connects.seconds = getattr(_connects, 'seconds', 0.0) + time.perf_counter() - started
+
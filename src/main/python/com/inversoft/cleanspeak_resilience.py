@@ -0,0 +1,467 @@
+#
+# Copyright (c) 2016, Inversoft Inc., All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+# either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+#
+
+import collections
+
+import concurrent.futures
+
+import contextlib
+
+import contextvars
+
+import random
+
+import threading
+
+import time
+
+_deadline = contextvars.ContextVar('cleanspeak_deadline', default=None)
+
+
+class DeadlineExceededError(TimeoutError):
+    """Raised when an API call does not complete before its deadline."""
+    pass
+
+
+@contextlib.contextmanager
+def deadline(seconds):
+    """Sets a deadline for the API calls made inside of the with block (by the current thread or asyncio task). Each call, including all of its
+    retries, fails with a DeadlineExceededError once the deadline has passed, and each attempt's connect and read timeouts are shortened so
+    that they do not run past it. A nested deadline can only shorten the outer one.
+
+    :parameter seconds: The number of seconds from now
+    :type seconds: float
+    """
+    at = time.time() + seconds
+    current = _deadline.get()
+    token = _deadline.set(at if current is None else min(at, current))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def current_deadline():
+    """Returns the deadline (in seconds since the epoch) set by the innermost deadline() block, or None."""
+    return _deadline.get()
+
+
+class RetryPolicy:
+    """The RetryPolicy controls how idempotent API calls are retried after a connection error, a timeout or a retryable status. The delay before
+    each retry is drawn uniformly between zero and an exponentially growing cap ("full jitter"), so that clients retrying at the same time
+    spread out instead of hitting CleanSpeak in waves.
+
+    Attributes:
+        max_attempts: The maximum number of attempts, including the first one
+        backoff: The cap of the delay before the first retry, in seconds. It doubles with every retry.
+        max_backoff: The largest cap of the delay, in seconds
+        retry_statuses: The HTTP statuses that are retried
+
+    """
+
+    def __init__(self, max_attempts=3, backoff=0.05, max_backoff=2.0, retry_statuses=(429, 502, 503, 504)):
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.retry_statuses = frozenset(retry_statuses)
+
+    def delay(self, retry):
+        """Returns the number of seconds to wait before the retry (1 for the first retry)."""
+        return random.uniform(0, min(self.max_backoff, self.backoff * (2 ** (retry - 1))))
+
+
+class Hedger:
+    """The Hedger sends a second copy of a request when the first one has not answered within a percentile of the recently observed latency,
+    and returns whichever answer arrives first. This trades a few percent of extra requests for a much lower tail latency when a single request
+    is stuck (i.e. on a slow CleanSpeak node). It must only be used for idempotent requests.
+
+    Until enough latencies were observed the request is simply made on the calling thread. After that the first request is made on a thread of
+    its own while the calling thread waits for it, so the Hedger does not limit how many calls are made at once and the delay is measured from
+    the moment the request starts. Only the second copies are sent from a pool of max_workers threads.
+
+    Attributes:
+        percentile: The latency percentile (0-100) after which the second request is sent
+        min_delay: The minimum number of seconds to wait before hedging
+        min_samples: The number of latency samples required before hedging starts
+        window: The number of recent latencies kept
+
+    """
+
+    def __init__(self, percentile=95, min_delay=0.005, min_samples=20, window=1000, max_workers=32):
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.min_samples = min_samples
+        self.window = window
+        self.hedged = 0
+        self._latencies = collections.deque(maxlen=window)
+        self._delay = None
+        self._samples = 0
+        self.max_workers = max_workers
+        self._init_threads()
+
+    def _init_threads(self):
+        self._lock = threading.Lock()
+        self._closed = False
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='cleanspeak-hedge')
+
+    def delay(self):
+        """Returns the number of seconds after which a request is hedged, or None if there are not enough samples yet."""
+        return self._delay
+
+    def record(self, seconds):
+        """Records the latency of a request."""
+        with self._lock:
+            self._latencies.append(seconds)
+            self._samples += 1
+            # Sorting the window is cheap but not free, so the percentile is only recomputed every few samples
+            if len(self._latencies) >= self.min_samples and (self._delay is None or self._samples % 16 == 0):
+                ordered = sorted(self._latencies)
+                index = min(len(ordered) - 1, int(len(ordered) * self.percentile / 100.0))
+                self._delay = max(self.min_delay, ordered[index])
+
+    def run(self, call):
+        """Calls the function, hedging it if it is slow, and returns the first result. If the first call to finish raised, the other one is
+        waited for; if both raised, the first exception is raised."""
+        delay = self._delay
+        if delay is None or self._closed:
+            return self._timed(call)
+
+        first = concurrent.futures.Future()
+        thread = threading.Thread(target=contextvars.copy_context().run, args=(self._run_into, first, call), name='cleanspeak-hedge-first',
+                                  daemon=True)
+        thread.start()
+        try:
+            return first.result(timeout=delay)
+        except concurrent.futures.TimeoutError:
+            pass
+
+        with self._lock:
+            if self._closed:
+                second = None
+            else:
+                self.hedged += 1
+                second = self._executor.submit(contextvars.copy_context().run, self._timed, call)
+
+        if second is None:
+            return first.result()
+
+        pending = {first, second}
+        error = None
+        while pending:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in (first, second):
+                if future not in done:
+                    continue
+
+                if future.exception() is None:
+                    return future.result()
+
+                error = error or future.exception()
+
+        raise error
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+
+        self._executor.shutdown(wait=False)
+
+    def after_fork(self):
+        """Replaces the lock and the thread pool in a child process, since the threads of the pool did not survive the fork."""
+        self._init_threads()
+
+    def _run_into(self, future, call):
+        try:
+            future.set_result(self._timed(call))
+        except BaseException as e:
+            future.set_exception(e)
+
+    def _timed(self, call):
+        started = time.time()
+        result = call()
+        self.record(time.time() - started)
+        return result
+
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+BreakerStats = collections.namedtuple('BreakerStats', ['state', 'calls', 'failures', 'rejected', 'opened'])
+
+LimiterStats = collections.namedtuple('LimiterStats', ['limit', 'in_flight', 'waiting', 'rejected'])
+
+
+class CircuitOpenError(Exception):
+    """Raised when an API call is not made because the CircuitBreaker is open."""
+    pass
+
+
+class ConcurrencyLimitError(Exception):
+    """Raised when an API call could not get a slot from the ConcurrencyLimiter before its deadline or the limiter's max_wait."""
+    pass
+
+
+class CircuitBreaker:
+    """The CircuitBreaker stops API calls from being made while CleanSpeak is failing, so that an overloaded server gets room to recover and
+    callers fail fast instead of waiting on timeouts.
+
+    The breaker starts CLOSED and tracks the outcome of the last window calls. When at least minimum_calls of them were made and the share that
+    failed (a connection error, a timeout, a 5xx or a 429 status) reaches the failure_rate, it turns OPEN and rejects every call for open_time
+    seconds. It then turns HALF_OPEN and lets half_open_calls trial calls through: if they all succeed it closes again, and if one of them fails
+    it opens again.
+
+    Attributes:
+        failure_rate: The share of failed calls (between 0 and 1) at which the breaker opens
+        minimum_calls: The number of calls in the window required before the breaker can open
+        window: The number of recent calls tracked
+        open_time: The number of seconds the breaker stays open before trial calls are let through
+        half_open_calls: The number of trial calls that must succeed to close the breaker
+
+    """
+
+    def __init__(self, failure_rate=0.5, minimum_calls=20, window=100, open_time=30, half_open_calls=5):
+        self.failure_rate = failure_rate
+        self.minimum_calls = minimum_calls
+        self.window = window
+        self.open_time = open_time
+        self.half_open_calls = half_open_calls
+        self._outcomes = collections.deque(maxlen=window)
+        self._failures = 0
+        self._state = CLOSED
+        self._opened = None
+        self._trials = 0
+        self._successes = 0
+        self._rejected = 0
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        """The state of the breaker: CLOSED, OPEN or HALF_OPEN."""
+        with self._lock:
+            self._update()
+            return self._state
+
+    def allow(self):
+        """Returns True if a call may be made. In the HALF_OPEN state this counts the call as a trial, so its outcome must be recorded."""
+        with self._lock:
+            self._update()
+            if self._state == CLOSED:
+                return True
+
+            if self._state == HALF_OPEN and self._trials < self.half_open_calls:
+                self._trials += 1
+                return True
+
+            self._rejected += 1
+            return False
+
+    def cancel(self):
+        """Gives back the trial slot of a call that was allowed but not made (i.e. because it could not get a concurrency slot), so that a
+        HALF_OPEN breaker still gets to record half_open_calls trial calls."""
+        with self._lock:
+            if self._state == HALF_OPEN and self._trials > 0:
+                self._trials -= 1
+
+    def record(self, success):
+        """Records the outcome of a call that was allowed."""
+        with self._lock:
+            if self._state == HALF_OPEN:
+                if not success:
+                    self._open()
+                else:
+                    self._successes += 1
+                    if self._successes >= self.half_open_calls:
+                        self._state = CLOSED
+                        self._outcomes.clear()
+                        self._failures = 0
+                return
+
+            if len(self._outcomes) == self._outcomes.maxlen and not self._outcomes[0]:
+                self._failures -= 1
+
+            self._outcomes.append(success)
+            if not success:
+                self._failures += 1
+                if self._state == CLOSED and len(self._outcomes) >= self.minimum_calls and \
+                        self._failures >= self.failure_rate * len(self._outcomes):
+                    self._open()
+
+    def reset(self):
+        """Closes the breaker and forgets the recorded calls."""
+        with self._lock:
+            self._state = CLOSED
+            self._outcomes.clear()
+            self._failures = 0
+
+    def stats(self):
+        """Returns the state, the number of calls in the window, how many of them failed, the number of calls rejected and the time the breaker
+        last opened (or None) as BreakerStats."""
+        with self._lock:
+            self._update()
+            return BreakerStats(self._state, len(self._outcomes), self._failures, self._rejected, self._opened)
+
+    def after_fork(self):
+        """Replaces the lock in a child process. The trial calls of a half open breaker belong to the parent, so they are forgotten."""
+        self._lock = threading.Lock()
+        self._trials = 0
+        self._successes = 0
+
+    def _open(self):
+        self._state = OPEN
+        self._opened = time.time()
+
+    def _update(self):
+        if self._state == OPEN and time.time() - self._opened >= self.open_time:
+            self._state = HALF_OPEN
+            self._trials = 0
+            self._successes = 0
+
+
+class ConcurrencyLimiter:
+    """The ConcurrencyLimiter caps the number of API calls in flight and adapts the cap to what CleanSpeak can handle, in the way TCP adapts its
+    congestion window (additive increase, multiplicative decrease). Every call that succeeds without a sign of congestion raises the limit by
+    1/limit, so the limit grows by about one per round of calls. A sign of congestion (a connection error, a timeout, a 5xx or a 429 status, or
+    a latency above latency_tolerance times the baseline latency) multiplies the limit by backoff_ratio, at most once per round of calls so that
+    a burst of slow calls only counts once. The baseline is the lowest recent latency; it drifts up slowly so that the limiter follows a server
+    whose normal latency changes.
+
+    Calls beyond the limit wait for a slot, for at most max_wait seconds (or until their deadline).
+
+    Attributes:
+        limit: The current limit
+        min_limit: The lowest limit
+        max_limit: The highest limit
+        backoff_ratio: The factor the limit is multiplied by on congestion
+        latency_tolerance: How many times the baseline latency a call may take before it counts as congestion
+        max_wait: (Optional) The maximum number of seconds a call waits for a slot before a ConcurrencyLimitError is raised
+
+    """
+
+    def __init__(self, initial_limit=20, min_limit=1, max_limit=200, backoff_ratio=0.9, latency_tolerance=2.0, max_wait=None):
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff_ratio = backoff_ratio
+        self.latency_tolerance = latency_tolerance
+        self.max_wait = max_wait
+        self._baseline = None
+        self._decreased = 0.0
+        self._in_flight = 0
+        self._waiting = 0
+        self._rejected = 0
+        self._lock = threading.Lock()
+        self._available = threading.Condition(self._lock)
+
+    def acquire(self, deadline=None):
+        """Waits for a slot and takes it. Every acquire() must be followed by a release().
+
+        :parameter deadline: (Optional) The time (in seconds since the epoch) after which to stop waiting
+        :type deadline: float
+        """
+        with self._lock:
+            if self._in_flight < int(self.limit):
+                self._in_flight += 1
+                return
+
+            until = deadline
+            if self.max_wait is not None:
+                until = min(until, time.time() + self.max_wait) if until is not None else time.time() + self.max_wait
+
+            self._waiting += 1
+            try:
+                while self._in_flight >= int(self.limit):
+                    remaining = until - time.time() if until is not None else None
+                    if remaining is not None and remaining <= 0:
+                        self._rejected += 1
+                        raise ConcurrencyLimitError('Timed out waiting for one of the [%d] concurrent call slots' % int(self.limit))
+
+                    self._available.wait(remaining)
+            finally:
+                self._waiting -= 1
+
+            self._in_flight += 1
+
+    def release(self, seconds, overloaded):
+        """Releases a slot and adapts the limit.
+
+        :parameter seconds: The latency of the call
+        :parameter overloaded: True if the call failed in a way that shows CleanSpeak is overloaded
+        :type seconds: float
+        :type overloaded: bool
+        """
+        with self._lock:
+            self._in_flight -= 1
+            if not overloaded:
+                if self._baseline is None or seconds < self._baseline:
+                    self._baseline = seconds
+                else:
+                    self._baseline += (seconds - self._baseline) * 0.01
+
+                overloaded = seconds > self.latency_tolerance * self._baseline
+
+            now = time.time()
+            if overloaded:
+                # The calls that were in flight together with this one saw the same congestion
+                if now - self._decreased >= seconds:
+                    self.limit = max(self.min_limit, self.limit * self.backoff_ratio)
+                    self._decreased = now
+            else:
+                self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+
+            self._available.notify_all()
+
+    def stats(self):
+        """Returns the current limit, the number of calls in flight and waiting, and the number of calls that gave up waiting as LimiterStats."""
+        with self._lock:
+            return LimiterStats(int(self.limit), self._in_flight, self._waiting, self._rejected)
+
+    def after_fork(self):
+        """Replaces the lock in a child process. The calls in flight and waiting belong to the parent, so they are forgotten."""
+        self._lock = threading.Lock()
+        self._available = threading.Condition(self._lock)
+        self._in_flight = 0
+        self._waiting = 0
+
+
+class RateLimiter:
+    """The RateLimiter is a token bucket that caps the rate of API calls (i.e. those of a bulk job, so that it does not crowd out the traffic of
+    the application). Tokens are added at rate per second up to burst; acquire() takes one and blocks until it is available. Callers that have
+    to wait reserve their token first, so they are let through in the order they arrived. It is thread-safe.
+
+    Attributes:
+        rate: The number of calls per second
+        burst: The number of calls that may be made at once after an idle period
+
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Takes a token, waiting until one is available."""
+        with self._lock:
+            now = time.time()
+            self._tokens = min(float(self.burst), self._tokens + (now - self._updated) * self.rate) - 1
+            self._updated = now
+            wait = -self._tokens / self.rate
+
+        if wait > 0:
+            time.sleep(wait)
@@ -0,0 +1,286 @@
+#
+# Copyright (c) 2016, Inversoft Inc., All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+# either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+#
+
+import collections
+
+import json
+
+import sqlite3
+
+import threading
+
+import time
+
+ReplayResult = collections.namedtuple('ReplayResult', ['sent', 'failed', 'remaining', 'dead_lettered'])
+
+DeadLetter = collections.namedtuple('DeadLetter', ['key', 'method', 'args', 'attempts', 'error'])
+
+
+class Spool:
+    """The Spool is a durable, append-only log of CleanSpeakClient calls that failed so that they can be replayed once CleanSpeak is available
+    again. It is stored in a SQLite file.
+
+    Appends use group commit: callers hand their entry to a single writer thread and wait until it is committed, and the writer commits (and
+    syncs to disk) everything that arrived since its last commit in one transaction. Many threads appending at once therefore share one sync.
+
+    Entries are replayed in the order they were appended. When the replay of an entry fails, the later entries with the same key (i.e. the same
+    content or user id) are held back so that the calls for a key are always made in order.
+
+    Attributes:
+        path: The path of the SQLite file
+        max_attempts: (Optional) The number of failed replays after which a call is moved to the dead letters. By default a call that fails
+            because CleanSpeak cannot be reached is kept until it succeeds.
+
+    """
+
+    def __init__(self, path, max_attempts=None):
+        self.path = path
+        self.max_attempts = max_attempts
+        self._keys = collections.Counter()
+        self._batch = []
+        self._closed = False
+        self._lock = threading.Lock()
+        self._has_batch = threading.Condition(self._lock)
+        self._stopped = threading.Event()
+        self._replay_lock = threading.Lock()
+        self._replay_thread = None
+
+        connection = self._connect()
+        connection.execute('CREATE TABLE IF NOT EXISTS spool (seq INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT, method TEXT, args TEXT, '
+                           'attempts INTEGER DEFAULT 0, created REAL)')
+        connection.execute('CREATE TABLE IF NOT EXISTS dead_letters (seq INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT, method TEXT, args TEXT, '
+                           'attempts INTEGER, created REAL, error TEXT)')
+        connection.commit()
+        for key, count in connection.execute('SELECT key, count(*) FROM spool GROUP BY key'):
+            self._keys[key] = count
+        connection.close()
+
+        self._writer = threading.Thread(target=self._write, name='cleanspeak-spool-writer', daemon=True)
+        self._writer.start()
+
+    def append(self, method, args, key=None):
+        """Appends a call to the spool and waits until it is durable.
+
+        :parameter method: The name of the CleanSpeakClient method (i.e. moderate)
+        :parameter args: The arguments of the method. They must be JSON serializable; ids are stored as strings.
+        :parameter key: (Optional) The key whose calls must be replayed in order (i.e. the content id)
+        :type method: str
+        :type args: list
+        :type key: str
+        """
+        key = str(key) if key is not None else None
+        entry = (key, method, json.dumps(list(args), default=str), time.time())
+        waiter = _Waiter()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError('The Spool has been closed')
+
+            self._batch.append((entry, waiter))
+            self._keys[key] += 1
+            self._has_batch.notify()
+
+        waiter.committed.wait()
+        if waiter.error is not None:
+            raise waiter.error
+
+    def has_pending(self, key):
+        """Returns True if the spool holds calls for the key. New calls for the key should be appended rather than made, to keep them in order."""
+        return key is not None and self._keys[str(key)] > 0
+
+    def __len__(self):
+        with self._lock:
+            return sum(self._keys.values())
+
+    def replay(self, call, batch_size=100, rate=None):
+        """Makes one pass over the spool and replays the calls in the order they were appended. A call that succeeds is removed from the spool. A
+        call that CleanSpeak rejects as invalid (a 4xx status other than 408 and 429) or that raises an exception will never succeed, so it is
+        moved to the dead letters (see dead_letters()), as is a call that failed max_attempts times. Any other failure leaves the call, and every
+        later call with the same key, in the spool for the next pass. Only one replay runs at a time; a second one waits for the first.
+
+        :parameter call: The function called with the method name and the list of arguments of each entry. It returns a ClientResponse, which
+            has no response (see ClientResponse.exception) when the call should be retried later (i.e. CleanSpeak could not be reached).
+        :parameter batch_size: The number of entries read from the spool at once
+        :parameter rate: (Optional) The maximum number of calls per second
+        :type call: function
+        :type batch_size: int
+        :type rate: float
+        :returns: A ReplayResult with the number of calls sent, the number that failed, the number left in the spool and the number moved to
+            the dead letters.
+        """
+        with self._replay_lock:
+            return self._replay(call, batch_size, rate)
+
+    def dead_letters(self):
+        """Returns the calls that were given up on, oldest first, as DeadLetter tuples."""
+        connection = self._connect()
+        try:
+            rows = connection.execute('SELECT key, method, args, attempts, error FROM dead_letters ORDER BY seq').fetchall()
+        finally:
+            connection.close()
+
+        return [DeadLetter(key, method, json.loads(args), attempts, error) for key, method, args, attempts, error in rows]
+
+    def _replay(self, call, batch_size, rate):
+        connection = self._connect()
+        held = set()
+        sent = 0
+        failed = 0
+        dead = 0
+        last_seq = 0
+        interval = 1.0 / rate if rate else 0
+        try:
+            while not self._stopped.is_set():
+                rows = connection.execute('SELECT seq, key, method, args, attempts FROM spool WHERE seq > ? ORDER BY seq LIMIT ?',
+                                          (last_seq, batch_size)).fetchall()
+                if not rows:
+                    break
+
+                for seq, key, method, args, attempts in rows:
+                    last_seq = seq
+                    if key is not None and key in held:
+                        continue
+
+                    started = time.time()
+                    error = None
+                    try:
+                        client_response = call(method, json.loads(args))
+                        done = client_response.was_successful()
+                        if not done:
+                            rejected = client_response.response is not None and 400 <= client_response.status < 500 and \
+                                client_response.status not in (408, 429)
+                            error = 'HTTP status %d' % client_response.status if client_response.response is not None else \
+                                repr(client_response.exception)
+                    except Exception as e:
+                        done = False
+                        rejected = True
+                        error = repr(e)
+
+                    sent += 1
+                    if done or rejected or (self.max_attempts is not None and attempts + 1 >= self.max_attempts):
+                        with connection:
+                            if not done:
+                                connection.execute('INSERT INTO dead_letters (key, method, args, attempts, created, error) '
+                                                   'SELECT key, method, args, attempts + 1, created, ? FROM spool WHERE seq = ?', (error, seq))
+                                dead += 1
+
+                            connection.execute('DELETE FROM spool WHERE seq = ?', (seq,))
+                        with self._lock:
+                            # The entry may have been spooled by another process
+                            if self._keys[key] > 0:
+                                self._keys[key] -= 1
+                    else:
+                        failed += 1
+                        held.add(key)
+                        with connection:
+                            connection.execute('UPDATE spool SET attempts = attempts + 1 WHERE seq = ?', (seq,))
+
+                    if interval:
+                        time.sleep(max(0.0, interval - (time.time() - started)))
+        finally:
+            connection.close()
+
+        return ReplayResult(sent, failed, len(self), dead)
+
+    def start(self, call, interval=30, batch_size=100, rate=None):
+        """Starts a background thread that replays the spool (see replay()) every interval seconds."""
+        if self._replay_thread is not None:
+            return
+
+        def run():
+            while not self._stopped.wait(interval):
+                # Checked in the file because other processes (i.e. forked workers) may have spooled calls too
+                if self._stored() > 0:
+                    self.replay(call, batch_size, rate)
+
+        self._replay_thread = threading.Thread(target=run, name='cleanspeak-spool-replay', daemon=True)
+        self._replay_thread.start()
+
+    def after_fork(self):
+        """Resets the Spool in a child process. The entries waiting for the writer belong to the parent, which writes them, and the writer thread
+        did not survive the fork, so it is started again. The background replay is left to the parent so that calls are not replayed twice by
+        several processes; it replays the calls spooled by every process."""
+        self._batch = []
+        self._lock = threading.Lock()
+        self._has_batch = threading.Condition(self._lock)
+        self._replay_lock = threading.Lock()
+        self._replay_thread = None
+        if not self._closed:
+            self._writer = threading.Thread(target=self._write, name='cleanspeak-spool-writer', daemon=True)
+            self._writer.start()
+
+    def close(self):
+        """Stops the background replay thread and the writer. Entries that were already appended are kept in the file."""
+        self._stopped.set()
+        if self._replay_thread is not None:
+            self._replay_thread.join()
+            self._replay_thread = None
+
+        with self._lock:
+            self._closed = True
+            self._has_batch.notify()
+
+        self._writer.join()
+
+    def _stored(self):
+        connection = self._connect()
+        try:
+            return connection.execute('SELECT count(*) FROM spool').fetchone()[0]
+        finally:
+            connection.close()
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=FULL')
+        return connection
+
+    def _write(self):
+        connection = self._connect()
+        try:
+            while True:
+                with self._lock:
+                    while not self._batch and not self._closed:
+                        self._has_batch.wait()
+
+                    if not self._batch:
+                        return
+
+                    batch = self._batch
+                    self._batch = []
+
+                error = None
+                try:
+                    with connection:
+                        connection.executemany('INSERT INTO spool (key, method, args, created) VALUES (?, ?, ?, ?)', [entry for entry, _ in batch])
+                except sqlite3.Error as e:
+                    error = e
+                    with self._lock:
+                        for entry, _ in batch:
+                            self._keys[entry[0]] -= 1
+
+                for _, waiter in batch:
+                    waiter.error = error
+                    waiter.committed.set()
+        finally:
+            connection.close()
+
+
+class _Waiter:
+    __slots__ = ('committed', 'error')
+
+    def __init__(self):
+        self.committed = threading.Event()
+        self.error = None
@@ -0,0 +1,279 @@
+#
+# Copyright (c) 2016, Inversoft Inc., All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+# either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+#
+
+import argparse
+
+import collections
+
+import concurrent.futures
+
+import itertools
+
+import json
+
+import os
+
+import sys
+
+import time
+
+from com.inversoft.cleanspeak_client import CleanSpeakClient, ClientResponse
+
+StreamResult = collections.namedtuple('StreamResult', ['index', 'item', 'response'])
+
+Checkpoint = collections.namedtuple('Checkpoint', ['watermark', 'completed', 'data'])
+
+
+class StreamPipeline:
+    """The StreamPipeline pushes an iterable of items through an API call while keeping a fixed number of calls in flight. Items are pulled from
+    the iterable only as slots free up, so memory use does not depend on the size of the input.
+
+    Progress can be checkpointed to a file. The checkpoint records the items that have been handed to the caller: every item before a watermark,
+    and the items after it that completed ahead of an earlier one. A run that is interrupted and restarted with the same input and checkpoint
+    skips all of them and resumes where it stopped; only the items that were in flight, or handed back since the last checkpoint was written,
+    are sent again. The checkpoint may also hold the caller's own state at the time it was written (see checkpoint_data), i.e. the length of
+    the output written so far, so the caller can discard the output of the results that will be handed back again.
+
+    Attributes:
+        call: The function called with each item. It returns a ClientResponse.
+        window: The maximum number of items that are in flight, waiting to be handed back in order, or handed back ahead of an earlier item that
+            is still in flight. This also bounds the size of the checkpoint.
+        ordered: True to hand results back in input order, False to hand them back as they complete
+        checkpoint: (Optional) The path of the checkpoint file
+        checkpoint_interval: The number of results between checkpoint writes
+        checkpoint_data: (Optional) A function called each time the checkpoint is written, whose JSON serializable result is stored with it
+        progress: (Optional) A function called with the number of results handed back and the elapsed seconds as the run proceeds
+        progress_interval: The number of seconds between calls to the progress function
+
+    """
+
+    def __init__(self, call, window=32, ordered=False, checkpoint=None, checkpoint_interval=100, progress=None, progress_interval=5.0,
+                 checkpoint_data=None):
+        self.call = call
+        self.window = window
+        self.ordered = ordered
+        self.checkpoint = checkpoint
+        self.checkpoint_interval = checkpoint_interval
+        self.checkpoint_data = checkpoint_data
+        self.progress = progress
+        self.progress_interval = progress_interval
+
+    def load_checkpoint(self):
+        """Returns the Checkpoint (watermark, completed and data) written by a previous run, or None if there is no checkpoint."""
+        if self.checkpoint is None or not os.path.exists(self.checkpoint):
+            return None
+
+        with open(self.checkpoint) as f:
+            state = json.loads(f.read().strip() or '0')
+
+        # The checkpoints of earlier versions only hold the watermark
+        if isinstance(state, int):
+            return Checkpoint(state, frozenset(), None)
+
+        return Checkpoint(state['watermark'], frozenset(state['completed']), state.get('data'))
+
+    def read_checkpoint(self):
+        """Returns the number of items that a previous run completed, or 0 if there is no checkpoint."""
+        checkpoint = self.load_checkpoint()
+        return checkpoint.watermark + len(checkpoint.completed) if checkpoint is not None else 0
+
+    def run(self, items):
+        """Runs the items through the call and yields a StreamResult for each of them. Failed calls are captured in the response (see
+        ClientResponse.exception) rather than raised.
+
+        :parameter items: The items to run. If a checkpoint exists, the items it records as complete are skipped.
+        :type items: iterable
+        :returns: A generator of StreamResult objects.
+        """
+        checkpoint = self.load_checkpoint()
+        start = checkpoint.watermark if checkpoint is not None else 0
+        # The items after the watermark that were handed back count as complete, so the watermark moves past them
+        completed = set(checkpoint.completed) if checkpoint is not None else set()
+        iterator = ((index, item) for index, item in itertools.islice(enumerate(items), start, None) if index not in completed)
+        pending = {}
+        buffered = {}
+        watermark = start
+        next_index = start
+        count = 0
+        started = time.time()
+        last_progress = started
+
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.window)
+        try:
+            while True:
+                while len(pending) + len(buffered) + len(completed) < self.window:
+                    entry = next(iterator, None)
+                    if entry is None:
+                        break
+
+                    pending[executor.submit(self._call, entry[1])] = entry
+
+                if not pending:
+                    break
+
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                ready = []
+                for future in done:
+                    index, item = pending.pop(future)
+                    result = StreamResult(index, item, future.result())
+                    if self.ordered:
+                        buffered[index] = result
+                    else:
+                        ready.append(result)
+
+                # The items an unordered run completed after its watermark are not run again, so they are not waited for either
+                while next_index in buffered or next_index in completed:
+                    if next_index in buffered:
+                        ready.append(buffered.pop(next_index))
+
+                    next_index += 1
+
+                for result in ready:
+                    yield result
+
+                    # The result only counts as complete once the caller has asked for the next one
+                    count += 1
+                    completed.add(result.index)
+                    while watermark in completed:
+                        completed.remove(watermark)
+                        watermark += 1
+
+                    if self.checkpoint is not None and count % self.checkpoint_interval == 0:
+                        self._write_checkpoint(watermark, completed)
+
+                now = time.time()
+                if self.progress is not None and now - last_progress >= self.progress_interval:
+                    self.progress(count, now - started)
+                    last_progress = now
+        finally:
+            executor.shutdown(wait=True)
+            if self.checkpoint is not None:
+                self._write_checkpoint(watermark, completed)
+
+        if self.progress is not None:
+            self.progress(count, time.time() - started)
+
+    def _call(self, item):
+        try:
+            return self.call(item)
+        except Exception as e:
+            return ClientResponse(None, exception=e)
+
+    def _write_checkpoint(self, watermark, completed):
+        state = {'watermark': watermark, 'completed': sorted(completed)}
+        if self.checkpoint_data is not None:
+            state['data'] = self.checkpoint_data()
+
+        temp = self.checkpoint + '.tmp'
+        with open(temp, 'w') as f:
+            f.write(json.dumps(state))
+
+        os.replace(temp, self.checkpoint)
+
+
+def main(args=None):
+    """Moderates or filters a JSONL file with CleanSpeak and writes one JSON result per line. For the moderate command each input line is a
+    moderate request, and an optional top-level contentId field is removed from it and used as the id of the content.
+
+    Run it with: python -m com.inversoft.cleanspeak_stream --api-key KEY --url URL moderate --input chat.jsonl --output results.jsonl
+    """
+    parser = argparse.ArgumentParser(description='Stream a JSONL file through the CleanSpeak filter or moderate API.')
+    parser.add_argument('command', choices=['filter', 'moderate'])
+    parser.add_argument('--api-key', required=True)
+    parser.add_argument('--url', required=True, help='The CleanSpeak WebService URL')
+    parser.add_argument('--input', default='-', help='The JSONL file to read, or - for stdin')
+    parser.add_argument('--output', default='-', help='The JSONL file to write the results to, or - for stdout')
+    parser.add_argument('--window', type=int, default=32, help='The number of requests to keep in flight')
+    parser.add_argument('--ordered', action='store_true', help='Write the results in input order')
+    parser.add_argument('--checkpoint', help='The checkpoint file used to resume an interrupted run')
+    parser.add_argument('--progress-interval', type=float, default=5.0, help='The number of seconds between throughput reports')
+    options = parser.parse_args(args)
+
+    def report(count, elapsed):
+        sys.stderr.write('%d items in %.1fs (%.1f/s)\n' % (count, elapsed, count / elapsed if elapsed > 0 else 0.0))
+
+    with CleanSpeakClient(options.api_key, options.url, pool_maxsize=options.window) as client:
+        if options.command == 'filter':
+            call = client.filter
+        else:
+            call = _moderate_line(client)
+
+        # The length of the output that holds the results recorded by the checkpoint
+        written = [0]
+
+        def output_length():
+            target.flush()
+            return written[0]
+
+        pipeline = StreamPipeline(call, options.window, options.ordered, options.checkpoint, progress=report,
+                                  progress_interval=options.progress_interval, checkpoint_data=output_length)
+        checkpoint = pipeline.load_checkpoint()
+        source = sys.stdin if options.input == '-' else open(options.input)
+        if options.output == '-':
+            target = sys.stdout
+        elif checkpoint is None:
+            target = open(options.output, 'w')
+        else:
+            # The results handed back after the checkpoint was written are handed back again, so their lines are removed
+            target = open(options.output, 'a')
+            if checkpoint.data is not None:
+                target.truncate(checkpoint.data)
+                written[0] = checkpoint.data
+            else:
+                written[0] = target.tell()
+
+        results = pipeline.run(json.loads(line) for line in source if line.strip())
+        try:
+            for result in results:
+                line = json.dumps(_result_json(result)) + '\n'
+                target.write(line)
+                # json.dumps() escapes every non-ASCII character, so the length of the line is its length in bytes
+                written[0] += len(line)
+        finally:
+            # Writes the last checkpoint while the output is still open
+            results.close()
+            if source is not sys.stdin:
+                source.close()
+            if target is not sys.stdout:
+                target.close()
+
+    return 0
+
+
+def _moderate_line(client):
+    def call(line):
+        request = dict(line)
+        content_id = request.pop('contentId', None)
+        return client.moderate(content_id, request)
+
+    return call
+
+
+def _result_json(result):
+    response = result.response
+    output = {'index': result.index, 'status': response.status}
+    if response.exception is not None:
+        output['error'] = str(response.exception)
+    elif response.success_response is not None:
+        output['response'] = response.success_response
+    elif isinstance(response.error_response, dict):
+        output['error'] = response.error_response
+
+    return output
+
+
+if __name__ == '__main__':
+    sys.exit(main())
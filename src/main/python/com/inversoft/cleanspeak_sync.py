@@ -0,0 +1,289 @@
+#
+# Copyright (c) 2016, Inversoft Inc., All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+# either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+#
+
+import collections
+
+import hashlib
+
+import itertools
+
+import json
+
+import sqlite3
+
+from com.inversoft.cleanspeak_resilience import RateLimiter
+from com.inversoft.cleanspeak_stream import StreamPipeline
+
+CREATE = 'create'
+UPDATE = 'update'
+DELETE = 'delete'
+
+SyncReport = collections.namedtuple('SyncReport', ['created', 'updated', 'deleted', 'unchanged', 'failed', 'failures', 'refused_deletes'])
+
+SyncFailure = collections.namedtuple('SyncFailure', ['id', 'action', 'response'])
+
+# The CleanSpeakClient methods that create, update and delete each kind of record
+_METHODS = {
+    'user': ('create_user', 'update_user', 'deleted_user'),
+    'application': ('create_application', 'update_application', 'deleted_application')
+}
+
+
+class FingerprintIndex:
+    """A compact on-disk index of the records last sent to CleanSpeak by a Sync, stored in a SQLite file. Each record is kept as its id and a
+    16 byte fingerprint (a BLAKE2 hash of its JSON with the keys sorted), so a record that has not changed since the last sync can be skipped
+    without keeping a copy of it.
+
+    The index is used by one Sync at a time. It is only updated once CleanSpeak has accepted a change, so a sync that is interrupted or whose
+    calls fail is simply completed by the next one.
+
+    Attributes:
+        path: The path of the SQLite file
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('CREATE TABLE IF NOT EXISTS fingerprints (kind TEXT, id TEXT, fingerprint BLOB, run INTEGER, '
+                                 'PRIMARY KEY (kind, id)) WITHOUT ROWID')
+        self._connection.commit()
+
+    @staticmethod
+    def fingerprint(record):
+        """Returns the fingerprint of a record (i.e. a user request)."""
+        body = json.dumps(record, sort_keys=True, separators=(',', ':'), ensure_ascii=False, default=str)
+        return hashlib.blake2b(body.encode('utf-8'), digest_size=16).digest()
+
+    def count(self, kind):
+        """Returns the number of records of a kind in the index."""
+        return self._connection.execute('SELECT count(*) FROM fingerprints WHERE kind = ?', (kind,)).fetchone()[0]
+
+    def clear(self, kind=None):
+        """Removes the records of a kind, or every record, so that the next sync sends all of them."""
+        with self._connection:
+            if kind is None:
+                self._connection.execute('DELETE FROM fingerprints')
+            else:
+                self._connection.execute('DELETE FROM fingerprints WHERE kind = ?', (kind,))
+
+    def close(self):
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _next_run(self, kind):
+        return self._connection.execute('SELECT coalesce(max(run), 0) + 1 FROM fingerprints WHERE kind = ?', (kind,)).fetchone()[0]
+
+    def _lookup(self, kind, ids, run):
+        # Marks the records as seen by the run, so that the ones that are not seen can be deleted at the end
+        placeholders = ','.join('?' * len(ids))
+        found = dict(self._connection.execute('SELECT id, fingerprint FROM fingerprints WHERE kind = ? AND id IN (%s)' % placeholders,
+                                              [kind] + ids))
+        self._connection.executemany('UPDATE fingerprints SET run = ? WHERE kind = ? AND id = ?', [(run, kind, id) for id in found])
+        return found
+
+    def _unseen(self, kind, run):
+        return [row[0] for row in self._connection.execute('SELECT id FROM fingerprints WHERE kind = ? AND run < ?', (kind, run))]
+
+    def _store(self, kind, entity_id, fingerprint, run):
+        self._connection.execute('INSERT OR REPLACE INTO fingerprints (kind, id, fingerprint, run) VALUES (?, ?, ?, ?)',
+                                 (kind, entity_id, fingerprint, run))
+
+    def _remove(self, kind, entity_id):
+        self._connection.execute('DELETE FROM fingerprints WHERE kind = ? AND id = ?', (kind, entity_id))
+
+    def _commit(self):
+        self._connection.commit()
+
+
+class Sync:
+    """The Sync keeps the users or applications of CleanSpeak in step with a source of truth (i.e. an account database). It is given every
+    record that should exist, compares each of them with the FingerprintIndex and only calls CleanSpeak for the records that were added,
+    changed or (optionally) removed since the last sync. The calls are made concurrently through a StreamPipeline, so the records are read
+    lazily and memory use does not depend on their number, and may be capped to a rate.
+
+    A record that is not in the index is created, and updated instead if CleanSpeak answers that it already exists (a 409, or a 400 with a
+    duplicate error, i.e. because the record was created before the index existed). A record whose update answers 404 is created.
+
+    Deleting is off by default. When it is on, a source that is empty or cut short would otherwise delete most of CleanSpeak, so the deletes
+    are refused (and counted in the refused_deletes of the report) when the run saw no records at all, or when they would remove more than
+    max_delete_ratio of the records in the index.
+
+    Attributes:
+        client: The CleanSpeakClient used to make the calls
+        index: The FingerprintIndex
+        kind: The kind of record: 'user' or 'application'
+        concurrency: The number of calls in flight at once
+        rate: (Optional) The maximum number of calls per second
+        delete: True to delete the records that are in the index but were not passed to run()
+        max_delete_ratio: The largest share (between 0 and 1) of the records in the index that a run may delete
+        batch_size: The number of records looked up in the index at once
+
+    """
+
+    def __init__(self, client, index, kind, concurrency=None, rate=None, delete=False, max_delete_ratio=0.1, batch_size=500):
+        if kind not in _METHODS:
+            raise ValueError('Unknown kind [%s], expected one of %s' % (kind, sorted(_METHODS)))
+
+        self.client = client
+        self.index = index
+        self.kind = kind
+        self.concurrency = concurrency or client.bulk_concurrency
+        self.rate = rate
+        self.delete = delete
+        self.max_delete_ratio = max_delete_ratio
+        self.batch_size = batch_size
+        self._create, self._update, self._delete = (getattr(client, name) for name in _METHODS[kind])
+        self._rate_limiter = RateLimiter(rate) if rate else None
+
+    def run(self, records, progress=None):
+        """Sends the changes in the records to CleanSpeak and records them in the index.
+
+        :parameter records: An iterable of (id, request) pairs, where the request is the one passed to create_user() or update_user() (or their
+            application counterparts). Every id must be unique.
+        :parameter progress: (Optional) A function called with the number of calls made and the elapsed seconds as the run proceeds
+        :type records: iterable
+        :type progress: function
+        :returns: A SyncReport with the number of records created, updated, deleted, unchanged and failed, a SyncFailure (id, action and
+            ClientResponse) for each failure, and the number of deletes refused by the max_delete_ratio.
+        """
+        run = self.index._next_run(self.kind)
+        indexed = self.index.count(self.kind)
+        state = _RunState()
+        changes = self._changes(records, run, state)
+        if self.delete:
+            changes = itertools.chain(changes, self._deletes(run, indexed, state))
+
+        failures = []
+        pipeline = StreamPipeline(self._call, self.concurrency, progress=progress)
+        try:
+            for count, result in enumerate(pipeline.run(changes), 1):
+                change = result.item
+                if not result.response.was_successful() and not (change.action == DELETE and result.response.status == 404):
+                    failures.append(SyncFailure(change.id, change.action, result.response))
+                    continue
+
+                state.counts[change.action] += 1
+                if change.action == DELETE:
+                    self.index._remove(self.kind, change.id)
+                else:
+                    self.index._store(self.kind, change.id, change.fingerprint, run)
+
+                if count % self.batch_size == 0:
+                    self.index._commit()
+        finally:
+            self.index._commit()
+
+        return SyncReport(state.counts[CREATE], state.counts[UPDATE], state.counts[DELETE], state.unchanged, len(failures), failures,
+                          state.refused_deletes)
+
+    def _changes(self, records, run, state):
+        iterator = iter(records)
+        while True:
+            batch = {}
+            for entity_id, request in itertools.islice(iterator, self.batch_size):
+                batch[str(entity_id)] = request
+
+            if not batch:
+                return
+
+            state.seen += len(batch)
+            known = self.index._lookup(self.kind, list(batch), run)
+            self.index._commit()
+            for entity_id, request in batch.items():
+                fingerprint = self.index.fingerprint(request)
+                previous = known.get(entity_id)
+                if previous is None:
+                    yield _Change(CREATE, entity_id, request, fingerprint)
+                elif previous != fingerprint:
+                    yield _Change(UPDATE, entity_id, request, fingerprint)
+                else:
+                    state.unchanged += 1
+
+    def _deletes(self, run, indexed, state):
+        # Only read once every record has been looked up, since the lookups mark the records that are kept
+        unseen = self.index._unseen(self.kind, run)
+        if unseen and (state.seen == 0 or len(unseen) > self.max_delete_ratio * indexed):
+            state.refused_deletes = len(unseen)
+            return
+
+        for entity_id in unseen:
+            yield _Change(DELETE, entity_id, None, None)
+
+    def _call(self, change):
+        if change.action == DELETE:
+            return self._limited(self._delete, change.id)
+
+        if change.action == CREATE:
+            client_response = self._limited(self._create, change.id, change.request)
+            if _already_exists(client_response):
+                change.action = UPDATE
+                client_response = self._limited(self._update, change.id, change.request)
+        else:
+            client_response = self._limited(self._update, change.id, change.request)
+            if client_response.status == 404:
+                change.action = CREATE
+                client_response = self._limited(self._create, change.id, change.request)
+
+        return client_response
+
+    def _limited(self, method, *args):
+        if self._rate_limiter is not None:
+            self._rate_limiter.acquire()
+
+        return method(*args)
+
+
+class _Change:
+    # The action is changed when the call falls back from a create to an update or the other way around
+    __slots__ = ('action', 'id', 'request', 'fingerprint')
+
+    def __init__(self, action, entity_id, request, fingerprint):
+        self.action = action
+        self.id = entity_id
+        self.request = request
+        self.fingerprint = fingerprint
+
+
+class _RunState:
+    __slots__ = ('counts', 'refused_deletes', 'seen', 'unchanged')
+
+    def __init__(self):
+        self.counts = {CREATE: 0, UPDATE: 0, DELETE: 0}
+        self.refused_deletes = 0
+        self.seen = 0
+        self.unchanged = 0
+
+
+def _already_exists(client_response):
+    if client_response.status == 409:
+        return True
+
+    if client_response.status != 400 or not isinstance(client_response.error_response, dict):
+        return False
+
+    # i.e. {"fieldErrors": {"user.id": [{"code": "[duplicate]user.id", ...}]}}
+    errors = list(client_response.error_response.get('generalErrors') or [])
+    for field_errors in (client_response.error_response.get('fieldErrors') or {}).values():
+        errors.extend(field_errors)
+
+    return any('duplicate' in str(error.get('code', '')).lower() for error in errors if isinstance(error, dict))
@@ -0,0 +1,523 @@
+#
+# Copyright (c) 2016, Inversoft Inc., All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+# either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+#
+
+import collections
+
+import datetime
+
+import threading
+
+import time
+
+from com.inversoft.cleanspeak_metrics import record_connect
+
+# The connect timeout of the connections opened by warm_up()
+_WARM_UP_TIMEOUT = 10
+
+# The methods whose requests may be processed more than once
+_IDEMPOTENT_METHODS = frozenset(['DELETE', 'GET', 'HEAD', 'OPTIONS', 'PUT'])
+
+
+class TransportError(IOError):
+    """Raised by the HTTPClientTransport when a request fails before a response is received."""
+
+
+class ConnectError(TransportError):
+    """Raised by the HTTPClientTransport when the connection cannot be opened. The request was then never sent."""
+
+
+class TransportTimeout(TransportError):
+    """Raised by the HTTPClientTransport when CleanSpeak does not answer within the read timeout."""
+
+
+class Transport:
+    """The Transport sends the HTTP requests of a CleanSpeakClient and owns its pool of connections. Pass one to the CleanSpeakClient to pick
+    the HTTP library used for a deployment:
+
+        RequestsTransport: The requests library (the default). It supports proxies and the certificate settings of the environment.
+        HTTPClientTransport: A lean pool of standard library http.client connections. It does not import requests at all and has a lower
+            overhead per call, which matters for the high volume filter and moderate calls.
+        HTTP2Transport: The httpx library with HTTP/2, which multiplexes every call over a few connections. It requires the httpx and h2
+            packages.
+
+    The response returned by send() has a status_code, the content (the body as bytes), the headers (with a case-insensitive get()),
+    iter_content(chunk_size) to stream the body, close() and the elapsed time until the response headers were received (a timedelta).
+
+    Attributes:
+        errors: The exceptions raised by send() when no response was received. The RESTClient retries these.
+
+    """
+
+    errors = ()
+
+    def send(self, method, url, headers, params, body, timeout, stream):
+        """Sends a request and returns the response.
+
+        :parameter method: The HTTP method
+        :parameter url: The full url of the request without its query string
+        :parameter headers: A dict of the request headers
+        :parameter params: A dict of the query parameters, whose values are lists
+        :parameter body: (Optional) The request body, as bytes or a file-like object with a length (i.e. an upload)
+        :parameter timeout: The connect and read timeouts, as a (connect, read) tuple or a single number for both. None waits forever.
+        :parameter stream: True to leave the body of the response unread so that it can be streamed with iter_content()
+        """
+        raise NotImplementedError()
+
+    def was_not_sent(self, error):
+        """Returns True if one of the errors happened before the request was sent (i.e. while opening the connection), so that it can be
+        retried even if it is not idempotent."""
+        return False
+
+    def warm_up(self, base_url, count):
+        """Opens up to count connections to a server ahead of time and places them in the pool. This is best-effort."""
+        pass
+
+    def after_fork(self):
+        """Called in a child process after a fork. The pooled connections are shared with the parent, so a transport must stop using them and
+        open its own. It may close its copies of their sockets, which leaves the parent's open, but must not shut them down or write to them."""
+        pass
+
+    def close(self):
+        """Closes all of the pooled connections."""
+        pass
+
+
+class RequestsTransport(Transport):
+    """A Transport that uses a requests Session. The requests library is only imported when the transport is created.
+
+    Attributes:
+        pool_connections: The number of per-host connection pools to keep
+        pool_maxsize: The maximum number of keep-alive connections kept open to a single host
+        keep_alive_timeout: (Optional) The number of seconds the pool may sit idle before its connections are discarded and re-opened
+        instrumented: True to record the connections that are opened in the Metrics of the client (see InstrumentedHTTPAdapter)
+
+    """
+
+    def __init__(self, pool_connections=10, pool_maxsize=10, keep_alive_timeout=None, instrumented=False):
+        import requests
+        from urllib3.exceptions import ConnectTimeoutError
+        self._requests = requests
+        self._connect_timeout_error = ConnectTimeoutError
+        self.errors = (requests.ConnectionError, requests.Timeout)
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.keep_alive_timeout = keep_alive_timeout
+        self.instrumented = instrumented
+        self._last_used = time.time()
+        self._lock = threading.Lock()
+        self._session = self._new_session()
+
+    def send(self, method, url, headers, params, body, timeout, stream):
+        return self._acquire_session().request(method, url, params=params, data=body, headers=headers, timeout=timeout, stream=stream)
+
+    def was_not_sent(self, error):
+        # The request never left the client if the connection could not be opened
+        if isinstance(error, self._requests.exceptions.ConnectTimeout):
+            return True
+
+        reason = getattr(error.args[0], 'reason', None) if error.args else None
+        return isinstance(reason, self._connect_timeout_error)
+
+    def warm_up(self, base_url, count):
+        # Resolve the pool the same way Session.send() does, otherwise the warm connections end up in a pool that is never used
+        session = self._session
+        settings = session.merge_environment_settings(base_url, {}, None, None, None)
+        adapter = session.get_adapter(base_url)
+        if hasattr(adapter, 'get_connection_with_tls_context'):
+            request = self._requests.Request('GET', base_url).prepare()
+            pool = adapter.get_connection_with_tls_context(request, settings['verify'], settings['proxies'], settings['cert'])
+        else:
+            pool = adapter.get_connection(base_url, settings['proxies'])
+
+        connections = [pool._get_conn() for _ in range(min(count, self.pool_maxsize))]
+        for connection in connections:
+            try:
+                connection.connect()
+            except Exception:
+                connection.close()
+
+        for connection in connections:
+            pool._put_conn(connection)
+
+    def after_fork(self):
+        # The old session is abandoned rather than closed, its sockets belong to the parent
+        self._lock = threading.Lock()
+        self._last_used = time.time()
+        self._session = self._new_session()
+
+    def close(self):
+        with self._lock:
+            self._session.close()
+
+    def _acquire_session(self):
+        now = time.time()
+        if self.keep_alive_timeout is not None and now - self._last_used > self.keep_alive_timeout:
+            with self._lock:
+                if now - self._last_used > self.keep_alive_timeout:
+                    # In-flight requests keep their connection, it is simply not returned to the old pool
+                    old_session = self._session
+                    self._session = self._new_session()
+                    old_session.close()
+
+        self._last_used = now
+        return self._session
+
+    def _new_session(self):
+        adapter_class = _instrumented_adapter_class() if self.instrumented else self._requests.adapters.HTTPAdapter
+        adapter = adapter_class(pool_connections=self.pool_connections, pool_maxsize=self.pool_maxsize)
+        session = self._requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+
+class HTTPClientTransport(Transport):
+    """A Transport built directly on pooled http.client connections. It skips the request preparation, hooks and environment lookups of the
+    requests library, so each call costs less CPU, and it does not import requests at all. It does not support proxies.
+
+    A pooled connection that the server has closed in the meantime is detected when the request is sent. If the request could not be written,
+    the server never received it, so it is sent again on a new connection. If the server closed the connection without answering, it may have
+    processed the request, so it is only sent again for idempotent methods (GET, PUT, DELETE, HEAD and OPTIONS); for other methods a
+    TransportError is raised and the caller's retry policy decides.
+
+    Attributes:
+        pool_maxsize: The maximum number of keep-alive connections kept open to a single host
+        keep_alive_timeout: (Optional) The number of seconds a connection may sit idle in the pool before it is discarded
+        ssl_context: (Optional) The ssl.SSLContext of HTTPS connections. This defaults to ssl.create_default_context().
+
+    """
+
+    def __init__(self, pool_maxsize=10, keep_alive_timeout=None, ssl_context=None):
+        import http.client
+        import urllib.parse
+        self._http = http.client
+        self._urllib = urllib.parse
+        self.errors = (TransportError,)
+        self.pool_maxsize = pool_maxsize
+        self.keep_alive_timeout = keep_alive_timeout
+        self.ssl_context = ssl_context
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def send(self, method, url, headers, params, body, timeout, stream):
+        scheme, netloc, path, query, _ = self._urllib.urlsplit(url)
+        if params:
+            encoded = self._urllib.urlencode(params, doseq=True)
+            query = query + '&' + encoded if query else encoded
+
+        target = (path or '/') + ('?' + query if query else '')
+        connect_timeout, read_timeout = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+        if body is not None and not isinstance(body, (bytes, bytearray)):
+            # Sent with a Content-Length rather than chunked transfer encoding
+            headers = dict(headers, **{'Content-Length': str(len(body))})
+
+        key = (scheme, netloc)
+        while True:
+            connection, reused = self._acquire(key, connect_timeout)
+            started = time.perf_counter()
+            written = False
+            try:
+                connection.sock.settimeout(read_timeout)
+                connection.request(method, target, body, headers)
+                written = True
+                response = connection.getresponse()
+            except (self._http.RemoteDisconnected, ConnectionResetError, BrokenPipeError) as e:
+                connection.close()
+                # A pooled connection the server already closed. Once the request was written it may have been processed, so it is only sent
+                # again if that is harmless; an upload cannot be rewound, so only bytes are sent again.
+                if reused and (not written or method in _IDEMPOTENT_METHODS) and (body is None or isinstance(body, (bytes, bytearray))):
+                    continue
+
+                raise TransportError('The request to [%s] failed: %s' % (url, e)) from e
+            except TimeoutError as e:
+                connection.close()
+                raise TransportTimeout('CleanSpeak did not answer [%s] within %s seconds' % (url, read_timeout)) from e
+            except (OSError, self._http.HTTPException) as e:
+                connection.close()
+                raise TransportError('The request to [%s] failed: %s' % (url, e)) from e
+
+            elapsed = datetime.timedelta(seconds=time.perf_counter() - started)
+            return _HTTPClientResponse(self, key, connection, response, stream, elapsed)
+
+    def was_not_sent(self, error):
+        return isinstance(error, ConnectError)
+
+    def warm_up(self, base_url, count):
+        scheme, netloc = self._urllib.urlsplit(base_url)[:2]
+        connections = []
+        for _ in range(min(count, self.pool_maxsize)):
+            try:
+                connections.append(self._connect((scheme, netloc), _WARM_UP_TIMEOUT))
+            except ConnectError:
+                break
+
+        for connection in connections:
+            self._release((scheme, netloc), connection)
+
+    def after_fork(self):
+        # Closing the inherited connections only releases the child's copies of their sockets; the parent keeps using them
+        pools = self._pools
+        self._lock = threading.Lock()
+        self._pools = {}
+        for pool in pools.values():
+            for connection, _ in pool:
+                connection.close()
+
+    def close(self):
+        with self._lock:
+            pools = list(self._pools.values())
+            self._pools.clear()
+
+        for pool in pools:
+            for connection, _ in pool:
+                connection.close()
+
+    def _acquire(self, key, connect_timeout):
+        now = time.time()
+        with self._lock:
+            pool = self._pools.get(key)
+            while pool:
+                # The most recently used connection is the least likely to have been closed by the server
+                connection, last_used = pool.pop()
+                if self.keep_alive_timeout is None or now - last_used <= self.keep_alive_timeout:
+                    return connection, True
+
+                connection.close()
+
+        return self._connect(key, connect_timeout), False
+
+    def _connect(self, key, connect_timeout):
+        scheme, netloc = key
+        if scheme == 'https':
+            if self.ssl_context is None:
+                import ssl
+                self.ssl_context = ssl.create_default_context()
+
+            connection = self._http.HTTPSConnection(netloc, timeout=connect_timeout, context=self.ssl_context)
+        else:
+            connection = self._http.HTTPConnection(netloc, timeout=connect_timeout)
+
+        started = time.perf_counter()
+        try:
+            connection.connect()
+        except OSError as e:
+            connection.close()
+            raise ConnectError('Unable to connect to [%s://%s]: %s' % (scheme, netloc, e)) from e
+        finally:
+            record_connect(started)
+
+        return connection
+
+    def _release(self, key, connection):
+        with self._lock:
+            pool = self._pools.get(key)
+            if pool is None:
+                pool = self._pools[key] = collections.deque()
+
+            if len(pool) < self.pool_maxsize:
+                pool.append((connection, time.time()))
+                return
+
+        connection.close()
+
+
+class _HTTPClientResponse:
+    """The response of the HTTPClientTransport. Its connection is returned to the pool once the body has been read."""
+
+    __slots__ = ('elapsed', 'headers', 'status_code', '_connection', '_content', '_key', '_response', '_transport')
+
+    def __init__(self, transport, key, connection, response, stream, elapsed):
+        self.elapsed = elapsed
+        self.headers = response.headers
+        self.status_code = response.status
+        self._connection = connection
+        self._content = None
+        self._key = key
+        self._response = response
+        self._transport = transport
+        if not stream:
+            self._read()
+
+    @property
+    def content(self):
+        if self._content is None:
+            self._read()
+
+        return self._content
+
+    def iter_content(self, chunk_size=1, decode_unicode=False):
+        if self._content is not None:
+            yield self._content
+            return
+
+        try:
+            chunk = self._response.read(chunk_size)
+            while chunk:
+                yield chunk
+                chunk = self._response.read(chunk_size)
+        except (OSError, self._transport._http.HTTPException) as e:
+            self.close()
+            raise TransportError('Reading the response failed: %s' % e) from e
+
+        self._content = b''
+        self._done()
+
+    def close(self):
+        # A body that was not read leaves the connection in an unknown state, so it is not reused
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def _read(self):
+        try:
+            self._content = self._response.read()
+        except (OSError, self._transport._http.HTTPException) as e:
+            self.close()
+            raise TransportError('Reading the response failed: %s' % e) from e
+
+        self._done()
+
+    def _done(self):
+        if self._connection is None:
+            return
+
+        if self._response.will_close:
+            self._connection.close()
+        else:
+            self._transport._release(self._key, self._connection)
+
+        self._connection = None
+
+
+class HTTP2Transport(Transport):
+    """A Transport that uses the httpx library with HTTP/2, so that concurrent calls share a few multiplexed connections rather than each
+    taking a connection from the pool. It requires the httpx and h2 packages (pip install httpx[http2]); an ImportError is raised when the
+    transport is created without them. A server that does not support HTTP/2 is spoken to with HTTP/1.1.
+
+    Attributes:
+        max_connections: The maximum number of connections open at once
+        keep_alive_timeout: (Optional) The number of seconds an idle connection is kept open
+
+    """
+
+    def __init__(self, max_connections=10, keep_alive_timeout=None):
+        import httpx
+        self._httpx = httpx
+        self.errors = (httpx.TransportError,)
+        self.max_connections = max_connections
+        self.keep_alive_timeout = keep_alive_timeout
+        limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections, keepalive_expiry=keep_alive_timeout)
+        self._client = httpx.Client(http2=True, limits=limits)
+
+    def send(self, method, url, headers, params, body, timeout, stream):
+        connect_timeout, read_timeout = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+        content = body
+        if body is not None and not isinstance(body, (bytes, bytearray)):
+            headers = dict(headers, **{'Content-Length': str(len(body))})
+            content = iter(lambda: body.read(65536), b'')
+
+        request = self._client.build_request(method, url, headers=headers, params=params, content=content,
+                                             timeout=self._httpx.Timeout(read_timeout, connect=connect_timeout))
+        # Always sent as a stream so that the elapsed time stops at the response headers, like it does for the other transports
+        started = time.perf_counter()
+        response = self._client.send(request, stream=True)
+        elapsed = datetime.timedelta(seconds=time.perf_counter() - started)
+        if not stream:
+            try:
+                response.read()
+            finally:
+                response.close()
+
+        return _HTTP2Response(response, elapsed)
+
+    def was_not_sent(self, error):
+        return isinstance(error, (self._httpx.ConnectError, self._httpx.ConnectTimeout))
+
+    def after_fork(self):
+        limits = self._httpx.Limits(max_connections=self.max_connections, max_keepalive_connections=self.max_connections,
+                                    keepalive_expiry=self.keep_alive_timeout)
+        self._client = self._httpx.Client(http2=True, limits=limits)
+
+    def close(self):
+        self._client.close()
+
+
+class _HTTP2Response:
+    """Adapts an httpx response to the response of a Transport."""
+
+    __slots__ = ('elapsed', 'headers', 'status_code', '_response')
+
+    def __init__(self, response, elapsed):
+        self.elapsed = elapsed
+        self.headers = response.headers
+        self.status_code = response.status_code
+        self._response = response
+
+    @property
+    def content(self):
+        return self._response.read()
+
+    def iter_content(self, chunk_size=1, decode_unicode=False):
+        return self._response.iter_bytes(chunk_size)
+
+    def close(self):
+        self._response.close()
+
+
+_adapter_class = None
+
+
+def _instrumented_adapter_class():
+    # Built on first use so that requests and urllib3 are only imported by the RequestsTransport
+    global _adapter_class
+    if _adapter_class is None:
+        import requests
+        from urllib3.connection import HTTPConnection, HTTPSConnection
+        from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+        class _TimedHTTPConnection(HTTPConnection):
+            def connect(self):
+                started = time.perf_counter()
+                try:
+                    super().connect()
+                finally:
+                    record_connect(started)
+
+        class _TimedHTTPSConnection(HTTPSConnection):
+            def connect(self):
+                started = time.perf_counter()
+                try:
+                    super().connect()
+                finally:
+                    record_connect(started)
+
+        class _TimedHTTPConnectionPool(HTTPConnectionPool):
+            ConnectionCls = _TimedHTTPConnection
+
+        class _TimedHTTPSConnectionPool(HTTPSConnectionPool):
+            ConnectionCls = _TimedHTTPSConnection
+
+        class InstrumentedHTTPAdapter(requests.adapters.HTTPAdapter):
+            """An HTTPAdapter whose connections record when they are opened and how long that takes, so that the RequestTiming can tell a new
+            connection from a reused one."""
+
+            def init_poolmanager(self, *args, **kwargs):
+                super().init_poolmanager(*args, **kwargs)
+                self.poolmanager.pool_classes_by_scheme = {'http': _TimedHTTPConnectionPool, 'https': _TimedHTTPSConnectionPool}
+
+        _adapter_class = InstrumentedHTTPAdapter
+
+    return _adapter_class
@@ -0,0 +1,343 @@
+#
+# Copyright (c) 2016, Inversoft Inc., All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+# either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+#
+
+import bisect
+
+import collections
+
+import json
+
+import os
+
+import threading
+
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+_PUNCTUATION = '.,!?;:\'"()[]{}-'
+
+# Single letters are left to CleanSpeak by the fast path, since they can spell out a word that is not whitelisted (i.e. "f u c k")
+_FAST_PATH_MIN_WORD_LENGTH = 2
+
+WhitelistStats = collections.namedtuple('WhitelistStats', ['local', 'remote'])
+
+
+class WhitelistIndex:
+    """A compiled, read-only index of the whitelist returned by the CleanSpeakClient retrieve_whitelist() call. Words are case-folded and stored
+    both in a hash set (for membership checks) and in a sorted array (for prefix suggestions using a binary search), so every lookup runs in C
+    rather than walking Python objects.
+
+    Attributes:
+        size: The number of words in the index
+    """
+
+    __slots__ = ('_set', '_sorted', 'size')
+
+    def __init__(self, words):
+        folded = set(word.casefold() for word in words if word)
+        self._set = frozenset(folded)
+        self._sorted = tuple(sorted(folded))
+        self.size = len(self._sorted)
+
+    @classmethod
+    def from_response(cls, success_response):
+        """Compiles the success response of the retrieve_whitelist() call.
+
+        :parameter success_response: The decoded JSON response
+        :type success_response: dict
+        :returns: A WhitelistIndex.
+        """
+        entries = success_response.get('whitelist', success_response) if isinstance(success_response, dict) else success_response
+        if isinstance(entries, dict):
+            entries = entries.get('entries') or entries.get('words') or []
+
+        words = []
+        for entry in entries:
+            if isinstance(entry, dict):
+                entry = entry.get('word') or entry.get('text')
+
+            if isinstance(entry, str):
+                words.append(entry)
+
+        return cls(words)
+
+    def __contains__(self, word):
+        return word.casefold() in self._set
+
+    def __len__(self):
+        return self.size
+
+    def words(self):
+        """Returns the case-folded words of the index in alphabetical order."""
+        return self._sorted
+
+    def is_whitelisted(self, text, min_word_length=1):
+        """Returns True if every word of the text is in the whitelist. Words are separated by white space and may be surrounded by punctuation;
+        anything else (i.e. punctuation inside of a word) makes the word unknown. Text without any words is not considered whitelisted.
+
+        :parameter text: The text to check
+        :parameter min_word_length: The length below which a word is treated as unknown even if it is whitelisted
+        :type text: str
+        :type min_word_length: int
+        :returns: True if the text only contains whitelisted words.
+        """
+        found = False
+        for token in text.split():
+            word = token.strip(_PUNCTUATION)
+            if not word:
+                continue
+
+            if len(word) < min_word_length or word.casefold() not in self._set:
+                return False
+
+            found = True
+
+        return found
+
+    def suggest(self, prefix, limit=10):
+        """Returns the whitelisted words that start with the prefix, in alphabetical order.
+
+        :parameter prefix: The prefix typed so far
+        :parameter limit: The maximum number of suggestions
+        :type prefix: str
+        :type limit: int
+        :returns: A list of words.
+        """
+        prefix = prefix.casefold()
+        start = bisect.bisect_left(self._sorted, prefix)
+        suggestions = []
+        for word in self._sorted[start:start + limit]:
+            if not word.startswith(prefix):
+                break
+
+            suggestions.append(word)
+
+        return suggestions
+
+
+class WhitelistFileStore:
+    """Shares the whitelist between the processes of a host (i.e. the forked workers of a web server) through a local file, so that only one of
+    them calls CleanSpeak each refresh_interval and the others load its copy. Put the file on a memory backed file system (i.e. /dev/shm) to keep
+    it in shared memory rather than on disk. The file is replaced atomically, so a reader never sees a partially written whitelist; writers are
+    serialized with an advisory lock on a second file (path + '.lock') where the platform supports it.
+
+    Attributes:
+        path: The path of the file
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self, max_age):
+        """Returns the words stored in the file, or None if there is no file, it cannot be read or it was saved more than max_age seconds ago."""
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                stored = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if not isinstance(stored, dict) or time.time() - stored.get('refreshed', 0) > max_age:
+            return None
+
+        return stored.get('words')
+
+    def save(self, words):
+        """Replaces the words stored in the file."""
+        temporary = '%s.%d.tmp' % (self.path, os.getpid())
+        with open(temporary, 'w', encoding='utf-8') as f:
+            json.dump({'words': list(words), 'refreshed': time.time()}, f, ensure_ascii=False, separators=(',', ':'))
+
+        os.replace(temporary, self.path)
+
+    def lock(self):
+        """Returns a context manager that holds the lock of the file, which only one process at a time may hold."""
+        return _FileLock(self.path + '.lock')
+
+
+class _FileLock:
+    def __init__(self, path):
+        self._path = path
+        self._file = None
+
+    def __enter__(self):
+        if fcntl is not None:
+            self._file = open(self._path, 'a')
+            fcntl.flock(self._file, fcntl.LOCK_EX)
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._file is not None:
+            # Closing the file releases the lock
+            self._file.close()
+            self._file = None
+
+
+class LocalWhitelist:
+    """Keeps a WhitelistIndex of the CleanSpeak whitelist up to date. The index is rebuilt from the retrieve_whitelist() call on an interval by a
+    background thread and swapped in atomically, so readers never see a partially built index and never wait for the network.
+
+    With a WhitelistFileStore, the processes of a host share a single copy of the whitelist: a refresh loads the copy saved by another process
+    when it is less than refresh_interval seconds old, and otherwise retrieves the whitelist while holding the lock of the store and saves it
+    for the others. Each process still builds its own index.
+
+    Attributes:
+        client: The CleanSpeakClient used to retrieve the whitelist
+        refresh_interval: The number of seconds between refreshes
+        store: (Optional) The WhitelistFileStore shared with the other processes
+        index: The current WhitelistIndex, or None if the whitelist has not been retrieved yet
+        last_refresh: The time (in seconds since the epoch) of the last successful refresh, or None
+        last_error: The exception (or unsuccessful ClientResponse) of the last failed refresh, or None
+
+    """
+
+    def __init__(self, client, refresh_interval=300, store=None):
+        self.client = client
+        self.refresh_interval = refresh_interval
+        self.store = store
+        self.index = None
+        self.last_refresh = None
+        self.last_error = None
+        self._local = 0
+        self._remote = 0
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def allows(self, filter_request):
+        """Returns True if the filter request can be answered locally as having no matches. This is only the case for a request that contains
+        nothing but content in which every word is whitelisted and at least two characters long; any other request (including one with filter
+        options, or content with single letters that could spell out another word) is left to CleanSpeak. The answer is counted in the stats().
+
+        :parameter filter_request: The filter request (see CleanSpeakClient.filter())
+        :type filter_request: dict
+        :returns: True if the content is definitely allowed.
+        """
+        index = self.index
+        allowed = (index is not None and isinstance(filter_request, dict) and len(filter_request) == 1 and
+                   isinstance(filter_request.get('content'), str) and
+                   index.is_whitelisted(filter_request['content'], _FAST_PATH_MIN_WORD_LENGTH))
+        with self._lock:
+            if allowed:
+                self._local += 1
+            else:
+                self._remote += 1
+
+        return allowed
+
+    def stats(self):
+        """Returns the number of filter requests answered locally and the number left to CleanSpeak by allows() as a WhitelistStats."""
+        with self._lock:
+            return WhitelistStats(self._local, self._remote)
+
+    def refresh(self):
+        """Retrieves the whitelist and swaps in a new index. If the call fails the current index is kept.
+
+        :returns: True if the index was refreshed.
+        """
+        if self.store is None:
+            return self._retrieve()
+
+        if self._load():
+            return True
+
+        refreshed = False
+        try:
+            with self.store.lock():
+                # Another process may have refreshed the store while this one waited for the lock
+                if self._load():
+                    return True
+
+                refreshed = self._retrieve()
+                if refreshed:
+                    self.store.save(self.index.words())
+        except OSError:
+            # A store that cannot be used only costs the calls it would have saved
+            if not refreshed:
+                refreshed = self._retrieve()
+
+        return refreshed
+
+    def start(self):
+        """Retrieves the whitelist and starts the background refresh thread."""
+        if self._thread is not None:
+            return
+
+        self.refresh()
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name='cleanspeak-whitelist-refresh', daemon=True)
+        self._thread.start()
+
+    def after_fork(self):
+        """Replaces the lock in a child process and starts the background refresh thread again if it was running, since it did not survive the
+        fork. The index is kept."""
+        self._lock = threading.Lock()
+        if self._thread is not None and not self._stopped.is_set():
+            self._stopped = threading.Event()
+            self._thread = threading.Thread(target=self._run, name='cleanspeak-whitelist-refresh', daemon=True)
+            self._thread.start()
+
+    def close(self):
+        """Stops the background refresh thread."""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def is_whitelisted(self, text):
+        """Returns True if every word of the text is whitelisted, or False if it is not or the whitelist has not been retrieved yet."""
+        index = self.index
+        return index is not None and index.is_whitelisted(text)
+
+    def suggest(self, prefix, limit=10):
+        """Returns the whitelisted words that start with the prefix, or an empty list if the whitelist has not been retrieved yet."""
+        index = self.index
+        return index.suggest(prefix, limit) if index is not None else []
+
+    def _load(self):
+        words = self.store.load(self.refresh_interval)
+        if words is None:
+            return False
+
+        self.index = WhitelistIndex(words)
+        self.last_refresh = time.time()
+        self.last_error = None
+        return True
+
+    def _retrieve(self):
+        try:
+            client_response = self.client.retrieve_whitelist()
+        except Exception as e:
+            self.last_error = e
+            return False
+
+        if not client_response.was_successful() or client_response.success_response is None:
+            self.last_error = client_response
+            return False
+
+        self.index = WhitelistIndex.from_response(client_response.success_response)
+        self.last_refresh = time.time()
+        self.last_error = None
+        return True
+
+    def _run(self):
+        while not self._stopped.wait(self.refresh_interval):
+            self.refresh()
@@ -0,0 +1,237 @@
+#
+# Copyright (c) 2016, Inversoft Inc., All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+# either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+#
+
+import asyncio
+
+import os
+
+import socket
+
+import tempfile
+
+import time
+
+import unittest2
+
+from com.inversoft.cleanspeak_async_client import AsyncCleanSpeakClient, AsyncSingleFlight
+from com.inversoft.cleanspeak_resilience import DeadlineExceededError, RetryPolicy, deadline
+from cleanspeak_mock_server import MockCleanSpeakServer
+
+API_KEY = '1f9e348a-61ab-4f53-8a73-3df91c0b5d76'
+
+
+def _unused_url():
+    # Nothing listens on the port once the socket is closed, so connecting to it is refused
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return 'http://127.0.0.1:%d' % s.getsockname()[1]
+
+
+class AsyncClientTest(unittest2.TestCase):
+    def setUp(self):
+        self.server = MockCleanSpeakServer()
+        self.server.start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_endpoints(self):
+        async def calls():
+            async with AsyncCleanSpeakClient(API_KEY, self.server.url + '/') as client:
+                responses = [await client.filter({'content': 'a bad word'})]
+                self.assertEqual(self.server.last_request[1], '/content/item/filter')
+                self.assertEqual(self.server.last_request[2]['Authorization'], API_KEY)
+                self.assertEqual(self.server.last_request[2]['Content-Type'], 'application/json')
+
+                responses.append(await client.moderate('c1', {'content': {'parts': []}}))
+                self.assertEqual(self.server.last_request[:2], ('POST', '/content/item/moderate/c1'))
+
+                responses.append(await client.retrieve_user('missing-user'))
+                self.assertEqual(self.server.last_request[:2], ('GET', '/content/user/missing-user'))
+
+                responses.append(await client.retrieve_applications())
+                responses.append(await client.deleted_user('u1'))
+                self.assertEqual(self.server.last_request[:2], ('DELETE', '/content/user/u1'))
+                self.assertEqual(self.server.last_request[2]['Authorization'], API_KEY)
+                return responses
+
+        filtered, moderated, missing, applications, deleted = asyncio.run(calls())
+        self.assertEqual(filtered.status, 200)
+        self.assertEqual(filtered.success_response, {'matches': [{'matched': 'bad', 'length': 3}]})
+        self.assertEqual(moderated.success_response['contentAction'], 'allow')
+        self.assertEqual(missing.status, 404)
+        self.assertIsNone(missing.error_response)
+        self.assertEqual(len(applications.success_response['applications']), 3)
+        self.assertTrue(deleted.was_successful())
+
+    def test_max_concurrency(self):
+        self.server.latency = 0.05
+
+        async def calls():
+            async with AsyncCleanSpeakClient(API_KEY, self.server.url, max_concurrency=3) as client:
+                return await client.filter_many([{'content': 'bad %d' % i} for i in range(12)])
+
+        responses = asyncio.run(calls())
+        self.assertEqual([response.status for response in responses], [200] * 12)
+        self.assertEqual(self.server.requests, 12)
+        self.assertEqual(self.server.max_in_flight, 3)
+
+    def test_deadline_covers_the_wait_for_a_slot(self):
+        self.server.latency = 0.5
+
+        async def calls():
+            async with AsyncCleanSpeakClient(API_KEY, self.server.url, max_concurrency=1) as client:
+                running = asyncio.ensure_future(client.filter({'content': 'hello'}))
+                await asyncio.sleep(0.05)
+                started = time.time()
+                with deadline(0.1):
+                    with self.assertRaises(DeadlineExceededError):
+                        await client.filter({'content': 'world'})
+
+                waited = time.time() - started
+                return waited, await running
+
+        waited, response = asyncio.run(calls())
+        self.assertLess(waited, 0.3)
+        self.assertEqual(response.status, 200)
+        self.assertEqual(self.server.requests, 1)
+
+    def test_backup(self):
+        path = os.path.join(tempfile.mkdtemp(), 'backup.zip')
+
+        async def calls():
+            async with AsyncCleanSpeakClient(API_KEY, self.server.url) as client:
+                client_response = await client.backup()
+                await client_response.write_response_to_file(path)
+                return client_response
+
+        self.assertEqual(asyncio.run(calls()).status, 200)
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), self.server.backup)
+
+    def test_filter_many_captures_errors(self):
+        async def calls():
+            async with AsyncCleanSpeakClient(API_KEY, _unused_url(), retry_policy=RetryPolicy(max_attempts=1)) as client:
+                return await client.filter_many([{'content': 'hello'}, {'content': 'world'}])
+
+        responses = asyncio.run(calls())
+        self.assertEqual([response.status for response in responses], [-1, -1])
+        self.assertTrue(all(response.exception is not None for response in responses))
+        self.assertFalse(any(response.was_successful() for response in responses))
+
+    def test_retries(self):
+        self.server.error_rate = 1.0
+
+        async def calls():
+            async with AsyncCleanSpeakClient(API_KEY, self.server.url, retry_policy=RetryPolicy(max_attempts=3, backoff=0.001)) as client:
+                filtered = await client.filter({'content': 'hello'})
+                requests = self.server.requests
+                moderated = await client.moderate('c1', {'content': {'parts': []}})
+                return filtered, requests, moderated
+
+        filtered, requests, moderated = asyncio.run(calls())
+        self.assertEqual(filtered.status, 503)
+        self.assertEqual(requests, 3)
+        # The moderate call is not idempotent, so it is only sent once
+        self.assertEqual(moderated.status, 503)
+        self.assertEqual(self.server.requests, 4)
+
+    def test_balancer_fails_over(self):
+        async def calls():
+            base_urls = [_unused_url(), self.server.url]
+            async with AsyncCleanSpeakClient(API_KEY, base_urls, retry_policy=RetryPolicy(max_attempts=2, backoff=0.001)) as client:
+                self.assertIsNotNone(client.balancer)
+                return [await client.filter({'content': 'hello %d' % i}) for i in range(10)]
+
+        responses = asyncio.run(calls())
+        self.assertEqual([response.status for response in responses], [200] * 10)
+        self.assertEqual(self.server.requests, 10)
+
+    def test_close(self):
+        async def calls():
+            client = AsyncCleanSpeakClient(API_KEY, self.server.url)
+            await client.filter({'content': 'hello'})
+            session = client._session
+            self.assertFalse(session.closed)
+            await client.close()
+            self.assertTrue(session.closed)
+            self.assertIsNone(client._session)
+            # Closing twice is harmless
+            await client.close()
+
+            async with AsyncCleanSpeakClient(API_KEY, self.server.url) as client:
+                await client.filter({'content': 'hello'})
+                session = client._session
+
+            self.assertTrue(session.closed)
+
+        asyncio.run(calls())
+
+
+class AsyncCoalescingTest(unittest2.TestCase):
+    def setUp(self):
+        self.server = MockCleanSpeakServer(latency=0.1)
+        self.server.start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_coalesced_callers_share_one_call(self):
+        async def calls():
+            async with AsyncCleanSpeakClient(API_KEY, self.server.url, coalesce_requests=True) as client:
+                return await asyncio.gather(*[client.filter({'content': 'a bad word'}) for _ in range(8)])
+
+        responses = asyncio.run(calls())
+        self.assertEqual(self.server.requests, 1)
+        self.assertTrue(all(response is responses[0] for response in responses))
+        for response in responses:
+            self.assertEqual(response.status, 200)
+            self.assertEqual(response.success_response, {'matches': [{'matched': 'bad', 'length': 3}]})
+
+    def test_cancelled_caller_does_not_cancel_the_others(self):
+        async def calls():
+            async with AsyncCleanSpeakClient(API_KEY, self.server.url, coalesce_requests=True) as client:
+                first = asyncio.ensure_future(client.filter({'content': 'hello'}))
+                await asyncio.sleep(0.02)
+                second = asyncio.ensure_future(client.filter({'content': 'hello'}))
+                await asyncio.sleep(0.02)
+                first.cancel()
+                response = await second
+                self.assertTrue(first.cancelled())
+                return response
+
+        response = asyncio.run(calls())
+        self.assertEqual(response.status, 200)
+        self.assertEqual(self.server.requests, 1)
+
+    def test_single_flight_raises_in_every_caller(self):
+        async def fail():
+            await asyncio.sleep(0.01)
+            raise ValueError('failed')
+
+        async def calls():
+            single_flight = AsyncSingleFlight()
+            results = await asyncio.gather(*[single_flight.do('key', fail) for _ in range(3)], return_exceptions=True)
+            self.assertEqual(single_flight._calls, {})
+            return results
+
+        results = asyncio.run(calls())
+        self.assertTrue(all(isinstance(result, ValueError) for result in results))
+        self.assertTrue(all(result is results[0] for result in results))
+
+
+if __name__ == '__main__':
+    unittest2.main()
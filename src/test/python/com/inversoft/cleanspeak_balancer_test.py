@@ -0,0 +1,93 @@
+#
+# Copyright (c) 2016, Inversoft Inc., All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+# either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+#
+
+import unittest2
+
+from com.inversoft.cleanspeak_balancer import EWMA, Balancer
+
+
+class BalancerTest(unittest2.TestCase):
+    def test_least_outstanding(self):
+        balancer = Balancer(['http://a', 'http://b'])
+        busy = balancer.acquire()
+        for _ in range(10):
+            node = balancer.acquire()
+            self.assertIsNot(node, busy)
+            balancer.release(node, 0.01, True)
+
+    def test_ewma_prefers_the_faster_node(self):
+        balancer = Balancer(['http://a', 'http://b'], policy=EWMA)
+        slow, fast = balancer.nodes
+        balancer.release(balancer.acquire(key=None, exclude=[fast]), 1.0, True)
+        balancer.release(balancer.acquire(key=None, exclude=[slow]), 0.01, True)
+        for _ in range(10):
+            node = balancer.acquire()
+            self.assertIs(node, fast)
+            balancer.release(node, 0.01, True)
+
+    def test_ewma_avoids_a_node_that_fails_fast(self):
+        balancer = Balancer(['http://a', 'http://b'], policy=EWMA, max_failures=100)
+        failing, working = balancer.nodes
+        balancer.release(balancer.acquire(key=None, exclude=[failing]), 0.05, True)
+        for _ in range(5):
+            balancer.release(balancer.acquire(key=None, exclude=[working]), 0.001, False)
+
+        self.assertGreaterEqual(failing.latency, 1.0)
+        for _ in range(10):
+            node = balancer.acquire()
+            self.assertIs(node, working)
+            balancer.release(node, 0.05, True)
+
+    def test_failing_node_is_ejected_and_readmitted(self):
+        balancer = Balancer(['http://a', 'http://b'], max_failures=2)
+        bad = balancer.nodes[0]
+        for _ in range(2):
+            bad.outstanding += 1
+            balancer.release(bad, 0.01, False)
+
+        for _ in range(10):
+            node = balancer.acquire()
+            self.assertIsNot(node, bad)
+            balancer.release(node, 0.01, True)
+
+        balancer.check_health(lambda url: True)
+        self.assertTrue(balancer.stats()[0].healthy)
+
+        balancer.check_health(lambda url: url != 'http://b')
+        self.assertFalse(balancer.stats()[1].healthy)
+
+    def test_sticky_routing(self):
+        balancer = Balancer(['http://a', 'http://b', 'http://c'], sticky=True)
+        first = balancer.acquire('content-1')
+        balancer.release(first, 0.01, True)
+        for _ in range(10):
+            node = balancer.acquire('content-1')
+            self.assertIs(node, first)
+            balancer.release(node, 0.01, True)
+
+        # A retry avoids the node that failed, but the key goes back to it once it is healthy
+        other = balancer.acquire('content-1', exclude=[first])
+        self.assertIsNot(other, first)
+        balancer.release(other, 0.01, True)
+
+    def test_all_nodes_ejected(self):
+        balancer = Balancer(['http://a', 'http://b'])
+        balancer.check_health(lambda url: False)
+        self.assertIn(balancer.acquire(), balancer.nodes)
+
+
+if __name__ == '__main__':
+    unittest2.main()
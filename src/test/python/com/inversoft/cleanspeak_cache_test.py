@@ -0,0 +1,173 @@
+#
+# Copyright (c) 2016, Inversoft Inc., All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+# either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+#
+
+import os
+
+import tempfile
+
+import time
+
+import unittest2
+
+from com.inversoft.cleanspeak_cache import CachedResponse, EntityCache, FilterCache, MemoryCacheBackend, SQLiteCacheBackend
+from com.inversoft.cleanspeak_client import CleanSpeakClient, ClientResponse, JSONCodec
+from cleanspeak_mock_server import MockCleanSpeakServer
+
+
+def response(body, status=200):
+    return ClientResponse(CachedResponse(status, body))
+
+
+class FilterCacheTest(unittest2.TestCase):
+    def test_key_is_normalized(self):
+        self.assertEqual(FilterCache.key({'content': 'gg', 'b': 1}), FilterCache.key({'b': 1, 'content': 'gg'}))
+        self.assertNotEqual(FilterCache.key({'content': 'gg'}), FilterCache.key({'content': 'GG'}))
+
+    def test_hit_and_miss(self):
+        cache = FilterCache()
+        key = cache.key({'content': 'gg'})
+
+        self.assertIsNone(cache.get(key))
+        cache.put(key, response(b'{"matches": []}'))
+        cached = cache.get(key)
+
+        self.assertEqual(cached.status, 200)
+        self.assertEqual(cached.success_response, {'matches': []})
+        self.assertEqual(tuple(cache.stats()), (1, 1, 0))
+
+    def test_errors_are_not_cached(self):
+        cache = FilterCache()
+        key = cache.key({'content': 'gg'})
+        cache.put(key, response(b'{}', 500))
+
+        self.assertIsNone(cache.get(key))
+
+    def test_lru_eviction(self):
+        cache = FilterCache(max_size=2)
+        for content in ('a', 'b'):
+            cache.put(cache.key(content), response(b'{}'))
+
+        cache.get(cache.key('a'))
+        cache.put(cache.key('c'), response(b'{}'))
+
+        self.assertIsNotNone(cache.get(cache.key('a')))
+        self.assertIsNone(cache.get(cache.key('b')))
+        self.assertEqual(cache.stats().evictions, 1)
+
+    def test_ttl_and_invalidate(self):
+        cache = FilterCache(ttl=0.05)
+        cache.put(cache.key('a'), response(b'{}'))
+        time.sleep(0.1)
+        self.assertIsNone(cache.get(cache.key('a')))
+
+        cache = FilterCache(MemoryCacheBackend())
+        cache.put(cache.key('a'), response(b'{}'))
+        cache.invalidate('a')
+        self.assertIsNone(cache.get(cache.key('a')))
+
+    def test_sqlite_backend_is_shared(self):
+        path = os.path.join(tempfile.mkdtemp(), 'cache.db')
+        first = FilterCache(SQLiteCacheBackend(path))
+        second = FilterCache(SQLiteCacheBackend(path))
+        first.put(first.key('gg'), response(b'{"matches": []}'))
+
+        self.assertEqual(second.get(second.key('gg')).success_response, {'matches': []})
+
+    def test_sqlite_backend_eviction(self):
+        backend = SQLiteCacheBackend(os.path.join(tempfile.mkdtemp(), 'cache.db'), max_size=2, eviction_interval=1)
+        for key in ('a', 'b', 'c'):
+            backend.set(key, b'{}', time.time() + 60)
+            time.sleep(0.01)
+
+        self.assertEqual(len(backend), 2)
+        self.assertIsNone(backend.get('a'))
+
+    def test_client_decodes_hits_with_its_codec(self):
+        with MockCleanSpeakServer() as server:
+            codec = _CountingCodec()
+            with CleanSpeakClient('key', server.url, filter_cache=FilterCache(), json_codec=codec) as client:
+                client.filter({'content': 'a bad word'})
+                cached = client.filter({'content': 'a bad word'})
+                self.assertEqual(server.requests, 1)
+
+                loads = codec.loads_calls
+                self.assertEqual(cached.success_response, {'matches': [{'matched': 'bad', 'length': 3}]})
+                self.assertEqual(codec.loads_calls, loads + 1)
+
+
+class EntityCacheTest(unittest2.TestCase):
+    def test_not_found_is_cached_briefly(self):
+        cache = EntityCache(negative_ttl=0.05)
+        cache.put(cache.key('user', 'a'), response(b'{}', 404))
+        cache.put(cache.key('user', 'b'), response(b'{}', 500))
+
+        self.assertEqual(cache.get(cache.key('user', 'a')).status, 404)
+        self.assertIsNone(cache.get(cache.key('user', 'b')))
+        time.sleep(0.06)
+        self.assertIsNone(cache.get(cache.key('user', 'a')))
+
+    def test_stale_generation_is_not_cached(self):
+        cache = EntityCache()
+        generation = cache.generation
+        cache.invalidate(cache.key('user', 'a'))
+        cache.put(cache.key('user', 'a'), response(b'{"user": {}}'), generation)
+
+        self.assertIsNone(cache.get(cache.key('user', 'a')))
+
+    def test_client_reads_and_writes_through(self):
+        with MockCleanSpeakServer() as server:
+            cache = EntityCache()
+            client = CleanSpeakClient('key', server.url, entity_cache=cache, warm_entity_cache=True)
+            requests = server.requests
+            self.assertEqual(client.retrieve_application('application-1').success_response['application']['name'], 'Application 1')
+            self.assertEqual(len(client.retrieve_applications().success_response['applications']), 3)
+            client.retrieve_user('missing')
+            client.retrieve_user('missing')
+            client.retrieve_user('user')
+            client.retrieve_user('user')
+            self.assertEqual(server.requests, requests + 2)
+
+            client.update_user('user', {'user': {'id': 'user'}})
+            client.retrieve_user('user')
+            client.deleted_application('application-1')
+            client.retrieve_applications()
+            self.assertEqual(server.requests, requests + 5)
+            client.close()
+
+    def test_client_decodes_hits_with_its_codec(self):
+        with MockCleanSpeakServer() as server:
+            codec = _CountingCodec()
+            with CleanSpeakClient('key', server.url, entity_cache=EntityCache(), json_codec=codec) as client:
+                client.retrieve_user('user')
+                cached = client.retrieve_user('user')
+                self.assertEqual(server.requests, 1)
+
+                loads = codec.loads_calls
+                self.assertEqual(cached.success_response, {'user': {'id': 'user'}})
+                self.assertEqual(codec.loads_calls, loads + 1)
+
+
+class _CountingCodec(JSONCodec):
+    def __init__(self):
+        self.loads_calls = 0
+
+    def loads(self, data):
+        self.loads_calls += 1
+        return JSONCodec.loads(self, data)
+
+
+if __name__ == '__main__':
+    unittest2.main()
@@ -14,13 +14,30 @@
 # language governing permissions and limitations under the License.
 #
 
+import hashlib
+
 import json
 
+import os
+
+import shutil
+
+import socket
+
+import tempfile
+
+import threading
+
+import time
+
 import unittest2
 
 import uuid
 
-from com.inversoft.cleanspeak_client import CleanSpeakClient
+from com.inversoft.cleanspeak_client import CachedResponse, CleanSpeakClient, ClientResponse, JSONCodec, OrjsonCodec, PreparedModerateRequest, \
+    RESTClient, Route, SingleFlight
+from com.inversoft.cleanspeak_resilience import RetryPolicy
+from cleanspeak_mock_server import MockCleanSpeakServer
 
 
 class ClientTest(unittest2.TestCase):
@@ -75,5 +92,327 @@ class ClientTest(unittest2.TestCase):
         self.assertEqual(cr.status, 200)
 
 
+class PoolTest(unittest2.TestCase):
+    def setUp(self):
+        self.server = MockCleanSpeakServer()
+        self.server.start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def wait_for(self, condition):
+        # The server sees a connection a moment after the client has opened it
+        deadline = time.time() + 5
+        while not condition() and time.time() < deadline:
+            time.sleep(0.01)
+
+        return condition()
+
+    def test_calls_reuse_pooled_connections(self):
+        with CleanSpeakClient('key', self.server.url) as client:
+            for i in range(20):
+                self.assertEqual(client.filter({'content': 'hello %d' % i}).status, 200)
+
+            self.assertEqual(self.server.connections, 1)
+
+    def test_pool_bounds_the_connections(self):
+        self.server.latency = 0.02
+        with CleanSpeakClient('key', self.server.url, pool_maxsize=4) as client:
+            responses = client.filter_many([{'content': 'hello %d' % i} for i in range(40)])
+
+            self.assertEqual([response.status for response in responses], [200] * 40)
+            self.assertLessEqual(self.server.max_in_flight, 4)
+            self.assertLessEqual(self.server.connections, 4)
+
+    def test_warm_up(self):
+        with CleanSpeakClient('key', self.server.url, pool_maxsize=4, warm_connections=3) as client:
+            self.assertTrue(self.wait_for(lambda: self.server.connections == 3))
+            self.assertEqual(self.server.requests, 0)
+
+            for i in range(5):
+                client.filter({'content': 'hello %d' % i})
+
+            self.assertEqual(self.server.connections, 3)
+
+    def test_warm_up_is_best_effort(self):
+        client = CleanSpeakClient('key', _unused_url(), warm_connections=2)
+        client.close()
+
+    def test_close_releases_the_connections(self):
+        client = CleanSpeakClient('key', self.server.url, pool_maxsize=4)
+        client.filter_many([{'content': 'hello %d' % i} for i in range(8)])
+        self.assertGreater(self.server.open_connections, 0)
+
+        client.close()
+        self.assertTrue(self.wait_for(lambda: self.server.open_connections == 0))
+
+
+class BulkTest(unittest2.TestCase):
+    def setUp(self):
+        self.server = MockCleanSpeakServer(jitter=0.02)
+        self.server.start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_filter_many_keeps_the_order(self):
+        contents = ['bad', 'hello', 'worse', 'world', 'worst'] * 4
+        with CleanSpeakClient('key', self.server.url, bulk_concurrency=8) as client:
+            responses = client.filter_many([{'content': content} for content in contents])
+
+        self.assertEqual([response.status for response in responses], [200] * 20)
+        matched = [[match['matched'] for match in response.success_response['matches']] for response in responses]
+        self.assertEqual(matched, [[content] if content.startswith(('bad', 'wors')) else [] for content in contents])
+
+    def test_filter_many_captures_errors(self):
+        with CleanSpeakClient('key', _unused_url(), retry_policy=RetryPolicy(max_attempts=1)) as client:
+            responses = client.filter_many([{'content': 'hello'}, {'content': 'world'}, {'content': 'bad'}])
+
+        self.assertEqual([response.status for response in responses], [-1, -1, -1])
+        self.assertTrue(all(response.exception is not None for response in responses))
+        self.assertFalse(any(response.was_successful() for response in responses))
+
+    def test_filter_many_of_nothing(self):
+        with CleanSpeakClient('key', self.server.url) as client:
+            self.assertEqual(client.filter_many([]), [])
+
+        self.assertEqual(self.server.requests, 0)
+
+    def test_moderate_many(self):
+        with CleanSpeakClient('key', self.server.url) as client:
+            responses = client.moderate_many([('c%d' % i, {'content': {'senderId': 's%d' % i}}) for i in range(6)])
+
+        self.assertEqual([response.success_response['content'] for response in responses], [{'senderId': 's%d' % i} for i in range(6)])
+
+
+class SingleFlightTest(unittest2.TestCase):
+    def test_concurrent_calls_are_shared(self):
+        single_flight = SingleFlight()
+        calls = []
+        results = []
+
+        def call():
+            calls.append(1)
+            time.sleep(0.1)
+            return object()
+
+        threads = [threading.Thread(target=lambda: results.append(single_flight.do('key', call))) for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(set(id(result) for result in results)), 1)
+
+    def test_sequential_calls_are_not_shared(self):
+        single_flight = SingleFlight()
+
+        self.assertNotEqual(single_flight.do('key', object), single_flight.do('key', object))
+
+
+class CoalescingTest(unittest2.TestCase):
+    def setUp(self):
+        self.server = MockCleanSpeakServer(latency=0.1)
+        self.server.start()
+        # A slow codec widens the window in which the callers decode the shared response at the same time
+        self.client = CleanSpeakClient('key', self.server.url, coalesce_requests=True, json_codec=_CountingCodec(delay=0.02))
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+
+    def test_every_caller_reads_the_shared_response(self):
+        responses = []
+        barrier = threading.Barrier(8)
+
+        def call():
+            barrier.wait()
+            client_response = self.client.filter({'content': 'a bad word'})
+            responses.append((client_response, client_response.status, client_response.success_response))
+
+        threads = [threading.Thread(target=call) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.server.requests, 1)
+        self.assertEqual(len(set(id(client_response) for client_response, _, _ in responses)), 1)
+        for _, status, success_response in responses:
+            self.assertEqual(status, 200)
+            self.assertEqual(success_response, {'matches': [{'matched': 'bad', 'length': 3}]})
+
+
+class BackupTest(unittest2.TestCase):
+    def setUp(self):
+        self.server = MockCleanSpeakServer(backup_size=100000)
+        self.server.start()
+        self.client = CleanSpeakClient('key', self.server.url)
+        self.directory = tempfile.mkdtemp()
+        self.file = os.path.join(self.directory, 'backup.zip')
+        self.sha256 = hashlib.sha256(self.server.backup).hexdigest()
+        self.progress = []
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+        shutil.rmtree(self.directory)
+
+    def write(self, content):
+        with open(self.file, 'wb') as f:
+            f.write(content)
+
+    def read(self):
+        with open(self.file, 'rb') as f:
+            return f.read()
+
+    def record_progress(self, done, total):
+        self.progress.append((done, total))
+
+    def test_backup(self):
+        client_response = self.client.backup_to_file(self.file, chunk_size=16384, progress=self.record_progress)
+
+        self.assertEqual(client_response.status, 200)
+        self.assertEqual(client_response.transfer[:3], (100000, self.sha256, 100000))
+        self.assertEqual(self.read(), self.server.backup)
+        self.assertEqual(len(self.progress), 7)
+        self.assertEqual(self.progress[0], (16384, 100000))
+        self.assertEqual(self.progress[-1], (100000, 100000))
+        self.assertEqual(self.progress, sorted(self.progress))
+
+    def test_resume_with_range(self):
+        self.write(self.server.backup[:30000])
+        client_response = self.client.backup_to_file(self.file, chunk_size=16384, progress=self.record_progress)
+
+        self.assertEqual(client_response.status, 206)
+        self.assertEqual(self.server.last_request[2]['Range'], 'bytes=30000-')
+        self.assertEqual(client_response.transfer[:3], (100000, self.sha256, 70000))
+        self.assertEqual(self.read(), self.server.backup)
+        self.assertEqual(self.progress[0], (30000 + 16384, 100000))
+        self.assertEqual(self.progress[-1], (100000, 100000))
+
+    def test_complete_file_is_answered_with_416(self):
+        self.write(self.server.backup)
+        client_response = self.client.backup_to_file(self.file, progress=self.record_progress)
+
+        self.assertEqual(client_response.status, 416)
+        self.assertEqual(tuple(client_response.transfer), (100000, self.sha256, 0, 0.0))
+        self.assertEqual(self.read(), self.server.backup)
+        self.assertEqual(self.progress, [])
+
+    def test_checksum_mismatch_of_a_corrupt_partial_file(self):
+        # The checksum covers the part of the file that was already there, so a resume onto a corrupt file is detected
+        self.write(b'\0' * 30000)
+        client_response = self.client.backup_to_file(self.file)
+        self.assertEqual(client_response.status, 206)
+        self.assertNotEqual(client_response.transfer.sha256, self.sha256)
+        self.assertEqual(client_response.transfer.sha256, hashlib.sha256(self.read()).hexdigest())
+
+        client_response = self.client.backup_to_file(self.file, resume=False)
+        self.assertEqual(client_response.status, 200)
+        self.assertEqual(client_response.transfer[:3], (100000, self.sha256, 100000))
+        self.assertNotIn('Range', self.server.last_request[2])
+
+    def test_restore(self):
+        self.write(self.server.backup)
+        client_response = self.client.restore(self.file, chunk_size=16384, progress=self.record_progress)
+
+        self.assertEqual(client_response.success_response, {'restored': 100000})
+        self.assertEqual(client_response.transfer[:3], (100000, self.sha256, 100000))
+        self.assertEqual(self.server.last_request[2]['Content-Length'], '100000')
+        self.assertEqual(self.progress[-1], (100000, 100000))
+        self.assertEqual(self.progress, sorted(self.progress))
+
+
+class PreparedModerateRequestTest(unittest2.TestCase):
+    def test_encodes_like_the_full_request(self):
+        prepared = PreparedModerateRequest({'applicationId': 'f5d4bd8f-cf54-4ab5-9a4b-a6c4c2f51bc1', 'location': 'lobby',
+                                            'parts': [{'name': 'message', 'type': 'text'}, {'name': 'title', 'type': 'text'}]})
+        body = prepared.encode(['say "hi" \u00e9', 'title'], uuid.UUID('00000000-0000-0000-0000-000000000001'), 1500000000000)
+        self.assertEqual(json.loads(body.decode('utf-8')), {'content': {
+            'applicationId': 'f5d4bd8f-cf54-4ab5-9a4b-a6c4c2f51bc1', 'location': 'lobby', 'createInstant': 1500000000000,
+            'senderId': '00000000-0000-0000-0000-000000000001',
+            'parts': [{'name': 'message', 'type': 'text', 'content': 'say "hi" \u00e9'}, {'name': 'title', 'type': 'text', 'content': 'title'}]}})
+        self.assertRaises(ValueError, prepared.encode, 'one part', 'sender', 0)
+
+
+class RouteTest(unittest2.TestCase):
+    def test_shared_headers_are_copied_on_write(self):
+        route = Route('PUT', 'http://localhost:8001/', '/content/user', {'Authorization': 'key'})
+        rest_client = RESTClient().route(route, 42).header('Range', 'bytes=0-')
+        self.assertEqual(rest_client._url, 'http://localhost:8001/content/user/42')
+        self.assertEqual(rest_client._method, 'PUT')
+        self.assertEqual(route.headers, {'Authorization': 'key'})
+
+
+class ClientResponseTest(unittest2.TestCase):
+    def test_body_is_decoded_lazily(self):
+        codec = _CountingCodec()
+        client_response = ClientResponse(CachedResponse(200, b'{"matches":[]}'), codec=codec)
+        self.assertTrue(client_response.was_successful())
+        self.assertEqual(codec.calls, 0)
+
+        self.assertEqual(client_response.success_response, {'matches': []})
+        self.assertIsNone(client_response.error_response)
+        self.assertEqual(client_response.success_response, {'matches': []})
+        self.assertEqual(codec.calls, 1)
+
+    def test_error_responses(self):
+        client_response = ClientResponse(CachedResponse(400, b'{"fieldErrors":{}}'))
+        self.assertEqual(client_response.error_response, {'fieldErrors': {}})
+        self.assertIsNone(client_response.success_response)
+
+        self.assertIsNone(ClientResponse(CachedResponse(404, b'')).error_response)
+        self.assertIsNone(ClientResponse(CachedResponse(200, b'not json')).success_response)
+        self.assertIsNone(ClientResponse(CachedResponse(400, b'not json')).error_response)
+
+    def test_shared_response_is_decoded_for_every_thread(self):
+        codec = _CountingCodec(delay=0.05)
+        client_response = ClientResponse(CachedResponse(200, b'{"matches":[]}'), codec=codec)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(client_response.success_response)) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, [{'matches': []}] * 8)
+
+    def test_codecs(self):
+        request = {'content': 'caf\u00e9', 'ids': [1, 2], 'flag': None}
+        codecs = [JSONCodec()]
+        try:
+            codecs.append(OrjsonCodec())
+        except ImportError:
+            pass
+
+        for codec in codecs:
+            body = codec.dumps(request)
+            self.assertIsInstance(body, bytes)
+            self.assertEqual(json.loads(body.decode('utf-8')), request)
+            self.assertEqual(codec.loads(body), request)
+            self.assertRaises(ValueError, codec.loads, b'{')
+            self.assertEqual(ClientResponse(CachedResponse(200, body), codec=codec).success_response, request)
+
+
+def _unused_url():
+    # Nothing listens on the port once the socket is closed, so connecting to it is refused
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return 'http://127.0.0.1:%d' % s.getsockname()[1]
+
+
+class _CountingCodec(JSONCodec):
+    def __init__(self, delay=0.0):
+        self.calls = 0
+        self.delay = delay
+
+    def loads(self, data):
+        self.calls += 1
+        time.sleep(self.delay)
+        return JSONCodec.loads(self, data)
+
+
 if __name__ == '__main__':
     unittest2.main()
\ No newline at end of file
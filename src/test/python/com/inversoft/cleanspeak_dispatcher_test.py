@@ -0,0 +1,159 @@
+#
+# Copyright (c) 2016, Inversoft Inc., All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+# either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+#
+
+import concurrent.futures
+
+import threading
+
+import time
+
+import unittest2
+
+from com.inversoft import cleanspeak_dispatcher
+from com.inversoft.cleanspeak_dispatcher import BLOCK, DROP_OLDEST, REJECT, Dispatcher, DispatcherFullError
+
+
+class _Stop(BaseException):
+    pass
+
+
+class _Client:
+    """Stands in for the CleanSpeakClient. Its flag() calls wait until the test releases them."""
+
+    def __init__(self, released=True):
+        self.calls = []
+        self.started = threading.Event()
+        self.released = threading.Event()
+        if released:
+            self.released.set()
+
+    def flag(self, content_id, flag_request):
+        self.started.set()
+        self.released.wait()
+        if content_id == 'stop':
+            raise _Stop()
+
+        self.calls.append(content_id)
+        return content_id
+
+
+class DispatcherTest(unittest2.TestCase):
+    def dispatcher(self, policy, client, workers=1):
+        dispatcher = Dispatcher(client, queue_size=2, workers=workers, policy=policy, batch_size=1)
+        self.addCleanup(dispatcher.close, False)
+        return dispatcher
+
+    def fill(self, dispatcher, client):
+        # The first call is taken by the worker and the next two fill the queue
+        running = dispatcher.flag('c0', {})
+        client.started.wait(5)
+        return [running, dispatcher.flag('c1', {}), dispatcher.flag('c2', {})]
+
+    def test_block(self):
+        client = _Client(released=False)
+        dispatcher = self.dispatcher(BLOCK, client)
+        futures = self.fill(dispatcher, client)
+
+        thread = threading.Thread(target=lambda: futures.append(dispatcher.flag('c3', {})))
+        thread.start()
+        thread.join(0.1)
+        self.assertTrue(thread.is_alive())
+
+        client.released.set()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertTrue(dispatcher.flush(5))
+        self.assertEqual([future.result() for future in futures], ['c0', 'c1', 'c2', 'c3'])
+
+    def test_drop_oldest(self):
+        client = _Client(released=False)
+        dispatcher = self.dispatcher(DROP_OLDEST, client)
+        futures = self.fill(dispatcher, client)
+        futures.append(dispatcher.flag('c3', {}))
+
+        self.assertIsInstance(futures[1].exception(0), DispatcherFullError)
+        client.released.set()
+        self.assertTrue(dispatcher.flush(5))
+        self.assertEqual([future.result() for future in futures[2:]], ['c2', 'c3'])
+        self.assertEqual(client.calls, ['c0', 'c2', 'c3'])
+
+    def test_reject(self):
+        client = _Client(released=False)
+        dispatcher = self.dispatcher(REJECT, client)
+        futures = self.fill(dispatcher, client)
+
+        self.assertRaises(DispatcherFullError, dispatcher.flag, 'c3', {})
+        client.released.set()
+        self.assertTrue(dispatcher.flush(5))
+        self.assertEqual([future.result() for future in futures], ['c0', 'c1', 'c2'])
+
+    def test_close_flushes(self):
+        client = _Client()
+        dispatcher = Dispatcher(client, workers=2)
+        futures = [dispatcher.flag('c%d' % i, {}) for i in range(20)]
+        self.assertIn(dispatcher, cleanspeak_dispatcher._dispatchers)
+
+        dispatcher.close()
+        self.assertTrue(all(future.done() for future in futures))
+        self.assertEqual(sorted(client.calls), sorted('c%d' % i for i in range(20)))
+        self.assertEqual(dispatcher.pending(), 0)
+        self.assertNotIn(dispatcher, cleanspeak_dispatcher._dispatchers)
+        self.assertRaises(RuntimeError, dispatcher.flag, 'c20', {})
+
+    def test_close_without_flush_cancels(self):
+        client = _Client(released=False)
+        dispatcher = self.dispatcher(BLOCK, client)
+        futures = self.fill(dispatcher, client)
+
+        closer = threading.Thread(target=dispatcher.close, args=(False,))
+        closer.start()
+        self.assertTrue(self._wait_cancelled(futures[1]))
+        client.released.set()
+        closer.join(5)
+        self.assertEqual(futures[0].result(), 'c0')
+        self.assertTrue(futures[2].cancelled())
+
+    def test_worker_ended_by_base_exception_does_not_hang_flush(self):
+        excepthook = threading.excepthook
+        threading.excepthook = lambda args: None
+        self.addCleanup(setattr, threading, 'excepthook', excepthook)
+
+        client = _Client(released=False)
+        dispatcher = Dispatcher(client, workers=1, batch_size=32)
+        self.addCleanup(dispatcher.close, False)
+        dispatcher.flag('first', {})
+        client.started.wait(5)
+        # Queued while the worker is busy, so that it takes them in one batch
+        futures = [dispatcher.flag(content_id, {}) for content_id in ('c0', 'stop', 'c2')]
+
+        client.released.set()
+        self.assertTrue(dispatcher.flush(5))
+        self.assertEqual(futures[0].result(), 'c0')
+        self.assertIsInstance(futures[1].exception(), _Stop)
+        self.assertRaises(concurrent.futures.CancelledError, futures[2].result)
+        self.assertEqual(dispatcher.pending(), 0)
+
+    @staticmethod
+    def _wait_cancelled(future):
+        deadline = time.time() + 5
+        while not future.cancelled() and time.time() < deadline:
+            time.sleep(0.01)
+
+        return future.cancelled()
+
+
+if __name__ == '__main__':
+    unittest2.main()
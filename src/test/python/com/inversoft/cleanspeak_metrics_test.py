@@ -0,0 +1,82 @@
+#
+# Copyright (c) 2016, Inversoft Inc., All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+# either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+#
+
+import gc
+
+import threading
+
+import unittest2
+
+from com.inversoft.cleanspeak_client import CachedResponse, ClientResponse
+from com.inversoft.cleanspeak_metrics import Metrics
+
+
+class MetricsTest(unittest2.TestCase):
+    def test_records_every_phase(self):
+        metrics = Metrics(buckets=(0.1, 1.0))
+        timings = []
+        metrics.add_hook(timings.append)
+        metrics.add_hook(lambda timing: 1 / 0)
+
+        timing = metrics.start('POST', '/content/item/moderate')
+        client_response = ClientResponse(CachedResponse(200, b'{"content":{}}'))
+        client_response.timing = timing
+        metrics.finish(timing, 200, client_response)
+        self.assertEqual(client_response.success_response, {'content': {}})
+
+        self.assertEqual(timings, [timing])
+        self.assertEqual(timing.status, 200)
+        self.assertFalse(timing.new_connection)
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot['requests'], {('/content/item/moderate', 'POST', 200): 1})
+        self.assertEqual(snapshot['latency'][('total', '/content/item/moderate', 200)][2], 1)
+        self.assertEqual(snapshot['latency'][('decode', '/content/item/moderate', 200)][2], 1)
+
+    def test_threads_are_added_up(self):
+        metrics = Metrics()
+
+        def record():
+            for _ in range(100):
+                metrics.finish(metrics.start('GET', '/content/user'), 404)
+
+        threads = [threading.Thread(target=record) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        del threads, thread
+        gc.collect()
+        self.assertEqual(metrics.snapshot()['requests'], {('/content/user', 'GET', 404): 400})
+        self.assertEqual(len(metrics._shards), 1)
+
+    def test_export(self):
+        metrics = Metrics(buckets=(0.1, 1.0))
+        metrics.observe('total', '/content/item/filter', 200, 0.05)
+        metrics.observe('total', '/content/item/filter', 200, 0.5)
+        metrics.finish(metrics.start('POST', '/content/item/filter'), 200)
+        metrics.finish(metrics.start('POST', '/content/item/filter'), 503)
+        lines = metrics.export().splitlines()
+        self.assertIn('cleanspeak_client_requests_total{endpoint="/content/item/filter",method="POST",status="200"} 1', lines)
+        self.assertIn('cleanspeak_client_seconds_bucket{endpoint="/content/item/filter",phase="total",status="200",le="1.0"} 3', lines)
+        self.assertIn('cleanspeak_client_seconds_bucket{endpoint="/content/item/filter",phase="total",status="200",le="+Inf"} 3', lines)
+        self.assertIn('cleanspeak_client_seconds_count{endpoint="/content/item/filter",phase="total",status="200"} 3', lines)
+        self.assertIn('cleanspeak_client_seconds_count{endpoint="/content/item/filter",phase="total",status="503"} 1', lines)
+
+
+if __name__ == '__main__':
+    unittest2.main()
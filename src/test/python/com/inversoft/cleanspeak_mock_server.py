@@ -0,0 +1,254 @@
+#
+# Copyright (c) 2016, Inversoft Inc., All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+# either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+#
+
+import argparse
+
+import json
+
+import random
+
+import threading
+
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+_BAD_WORDS = frozenset(['bad', 'worse', 'worst'])
+
+
+class MockCleanSpeakServer:
+    """A stand-in for the CleanSpeak API used by the tests and the benchmarks. It answers the filter, moderate, user, application, whitelist,
+    backup and restore end-points with canned responses, optionally after a delay and with injected errors. It runs in a background thread of
+    the current process (see start()) or as its own process (python cleanspeak_mock_server.py --port 8001), which keeps its CPU use out of the
+    measurements of a benchmark.
+
+    Attributes:
+        latency: The number of seconds each request is delayed
+        jitter: The maximum number of seconds added at random to the latency
+        error_rate: The share of requests (between 0 and 1) that are answered with the error_status instead
+        error_status: The status of the injected errors
+        backup_size: The size in bytes of the backup returned by /system/backup
+        requests: The number of requests received
+        max_in_flight: The largest number of requests that were being handled at once
+        connections: The number of connections accepted
+        open_connections: The number of connections that are open
+        last_request: The method, path and headers of the last request received
+
+    """
+
+    def __init__(self, port=0, latency=0.0, jitter=0.0, error_rate=0.0, error_status=503, backup_size=1024 * 1024):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.backup = bytes(range(256)) * (backup_size // 256) + bytes(backup_size % 256)
+        self.requests = 0
+        self.max_in_flight = 0
+        self.connections = 0
+        self.open_connections = 0
+        self.last_request = None
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        self._port = port
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self._server.server_address[1]
+
+    def start(self):
+        """Starts the server in a background thread and returns its URL."""
+        self._server = ThreadingHTTPServer(('127.0.0.1', self._port), _Handler)
+        self._server.daemon_threads = True
+        self._server.request_queue_size = 1024
+        self._server.mock = self
+        self._thread = threading.Thread(target=self._server.serve_forever, name='cleanspeak-mock-server', daemon=True)
+        self._thread.start()
+        return self.url
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._thread.join()
+            self._server = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def serve_forever(self):
+        """Runs the server in the current thread."""
+        self._server = ThreadingHTTPServer(('127.0.0.1', self._port), _Handler)
+        self._server.daemon_threads = True
+        self._server.request_queue_size = 1024
+        self._server.mock = self
+        self._server.serve_forever()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        mock = self.server.mock
+        with mock._lock:
+            mock.connections += 1
+            mock.open_connections += 1
+
+    def finish(self):
+        try:
+            BaseHTTPRequestHandler.finish(self)
+        finally:
+            mock = self.server.mock
+            with mock._lock:
+                mock.open_connections -= 1
+
+    def do_DELETE(self):
+        self._handle()
+
+    def do_GET(self):
+        self._handle()
+
+    def do_POST(self):
+        self._handle()
+
+    def do_PUT(self):
+        self._handle()
+
+    def _handle(self):
+        mock = self.server.mock
+        body = self._read_body()
+        with mock._lock:
+            mock.requests += 1
+            mock._in_flight += 1
+            mock.max_in_flight = max(mock.max_in_flight, mock._in_flight)
+            mock.last_request = (self.command, self.path, self.headers)
+
+        # The request is no longer counted as in flight once its response is being sent, so the client cannot see it end before it does here
+        try:
+            delay = mock.latency + (random.uniform(0, mock.jitter) if mock.jitter else 0)
+            if delay:
+                time.sleep(delay)
+        finally:
+            with mock._lock:
+                mock._in_flight -= 1
+
+        if mock.error_rate and random.random() < mock.error_rate:
+            return self._send_json(mock.error_status, {'generalErrors': [{'code': '[Injected]', 'message': 'Injected error'}]})
+
+        path = self.path.split('?')[0]
+        if path.startswith('/content/item/filter'):
+            request = json.loads(body)
+            words = request.get('content', '').split()
+            self._send_json(200, {'matches': [{'matched': word, 'length': len(word)} for word in words if word.lower() in _BAD_WORDS]})
+        elif path.startswith('/content/item/moderate'):
+            request = json.loads(body) if body else {}
+            self._send_json(200, {'contentAction': 'allow', 'stored': True, 'content': request.get('content')})
+        elif path.startswith('/content/user'):
+            user_id = path[len('/content/user/'):]
+            if self.command == 'GET' and user_id.startswith('missing'):
+                self._send_json(404, {})
+            else:
+                self._send_json(200, {'user': {'id': user_id}})
+        elif path.startswith('/system/application'):
+            application_id = path[len('/system/application/'):]
+            if self.command == 'GET' and not application_id:
+                self._send_json(200, {'applications': [{'id': 'application-%d' % i, 'name': 'Application %d' % i} for i in range(3)]})
+            elif self.command == 'GET' and application_id.startswith('missing'):
+                self._send_json(404, {})
+            else:
+                self._send_json(200, {'application': {'id': application_id}})
+        elif path.startswith('/filter/whitelist'):
+            self._send_json(200, {'whitelist': ['hello', 'world', 'good', 'game', 'gg']})
+        elif path.startswith('/system/backup'):
+            self._send_backup(mock.backup)
+        elif path.startswith('/system/restore'):
+            self._send_json(200, {'restored': len(body)})
+        else:
+            self._send_json(200, {})
+
+    def _read_body(self):
+        length = self.headers.get('Content-Length')
+        if length is not None:
+            return self.rfile.read(int(length))
+
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b';')[0], 16)
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+                if size == 0:
+                    return b''.join(chunks)
+
+        return b''
+
+    def _send_backup(self, backup):
+        start = 0
+        status = 200
+        range_header = self.headers.get('Range')
+        if range_header is not None and range_header.startswith('bytes='):
+            start = int(range_header[len('bytes='):].split('-')[0])
+            if start >= len(backup):
+                self.send_response(416)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+
+            status = 206
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/zip')
+        self.send_header('Content-Length', str(len(backup) - start))
+        self.end_headers()
+        self.wfile.write(memoryview(backup)[start:])
+
+    def _send_json(self, status, response):
+        body = json.dumps(response).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Runs a stand-in for the CleanSpeak API.')
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--latency', type=float, default=0.0, help='The number of seconds each request is delayed')
+    parser.add_argument('--jitter', type=float, default=0.0, help='The maximum number of seconds added at random to the latency')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='The share of requests answered with an error')
+    parser.add_argument('--error-status', type=int, default=503)
+    parser.add_argument('--backup-size', type=int, default=1024 * 1024)
+    options = parser.parse_args(args)
+    server = MockCleanSpeakServer(options.port, options.latency, options.jitter, options.error_rate, options.error_status, options.backup_size)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,273 @@
+#
+# Copyright (c) 2016, Inversoft Inc., All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+# either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+#
+
+import threading
+
+import time
+
+import unittest2
+
+from com.inversoft.cleanspeak_client import CachedResponse, CleanSpeakClient, ClientResponse
+from com.inversoft.cleanspeak_resilience import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, ConcurrencyLimitError, ConcurrencyLimiter, Hedger, \
+    RateLimiter, RetryPolicy, current_deadline, deadline
+from cleanspeak_mock_server import MockCleanSpeakServer
+
+
+class RetryPolicyTest(unittest2.TestCase):
+    def test_delay_is_capped(self):
+        policy = RetryPolicy(backoff=0.1, max_backoff=0.3)
+        for retry in range(1, 10):
+            delay = policy.delay(retry)
+            self.assertGreaterEqual(delay, 0)
+            self.assertLessEqual(delay, min(0.3, 0.1 * 2 ** (retry - 1)))
+
+
+class DeadlineTest(unittest2.TestCase):
+    def test_nested_deadline_only_shortens(self):
+        self.assertIsNone(current_deadline())
+        with deadline(1):
+            outer = current_deadline()
+            with deadline(10):
+                self.assertEqual(current_deadline(), outer)
+
+            with deadline(0.1):
+                self.assertLess(current_deadline(), outer)
+
+        self.assertIsNone(current_deadline())
+
+
+class HedgerTest(unittest2.TestCase):
+    def setUp(self):
+        self.hedger = Hedger(percentile=50, min_samples=5)
+        for _ in range(5):
+            self.hedger.run(lambda: time.sleep(0.01))
+
+    def tearDown(self):
+        self.hedger.close()
+
+    def test_stuck_call_is_hedged(self):
+        calls = []
+        lock = threading.Lock()
+
+        def call():
+            with lock:
+                calls.append(threading.current_thread())
+                first = len(calls) == 1
+
+            if first:
+                time.sleep(0.3)
+                raise IOError('read timed out')
+
+            time.sleep(0.01)
+            return 'hedged'
+
+        started = time.time()
+        self.assertEqual(self.hedger.run(call), 'hedged')
+        self.assertLess(time.time() - started, 0.5)
+        self.assertEqual(self.hedger.hedged, 1)
+        self.assertEqual(calls[0].name, 'cleanspeak-hedge-first')
+
+    def test_fast_call_is_not_hedged(self):
+        self.assertEqual(self.hedger.run(lambda: 'first'), 'first')
+        time.sleep(0.05)
+        self.assertEqual(self.hedger.hedged, 0)
+
+    def test_slow_call_returns_the_hedged_answer_early(self):
+        calls = []
+        lock = threading.Lock()
+
+        def call():
+            with lock:
+                calls.append(None)
+                first = len(calls) == 1
+
+            time.sleep(1 if first else 0.01)
+            return 'first' if first else 'second'
+
+        started = time.time()
+        self.assertEqual(self.hedger.run(call), 'second')
+        self.assertLess(time.time() - started, 0.5)
+        self.assertEqual(self.hedger.hedged, 1)
+
+    def test_first_answer_wins(self):
+        calls = []
+        lock = threading.Lock()
+
+        def call():
+            with lock:
+                calls.append(None)
+                first = len(calls) == 1
+
+            time.sleep(0.05 if first else 1)
+            return 'first' if first else 'second'
+
+        started = time.time()
+        self.assertEqual(self.hedger.run(call), 'first')
+        self.assertLess(time.time() - started, 0.5)
+        self.assertEqual(self.hedger.hedged, 1)
+
+    def test_unsampled_call_runs_on_the_calling_thread(self):
+        hedger = Hedger()
+        self.assertIs(hedger.run(threading.current_thread), threading.current_thread())
+        hedger.close()
+
+    def test_calls_are_not_capped_by_the_pool(self):
+        # Every call is hedged only after 10 seconds, so the barrier is passed by the first calls alone
+        hedger = Hedger(percentile=50, min_delay=10, min_samples=5, max_workers=1)
+        for _ in range(5):
+            hedger.run(lambda: time.sleep(0.01))
+
+        barrier = threading.Barrier(8, timeout=5)
+        threads = [threading.Thread(target=hedger.run, args=(barrier.wait,)) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertFalse(barrier.broken)
+        hedger.close()
+
+    def test_both_calls_fail(self):
+        def call():
+            time.sleep(0.05)
+            raise IOError('reset')
+
+        self.assertRaises(IOError, self.hedger.run, call)
+
+
+class CircuitBreakerTest(unittest2.TestCase):
+    def test_opens_and_recovers(self):
+        breaker = CircuitBreaker(failure_rate=0.5, minimum_calls=4, open_time=0.05, half_open_calls=2)
+        for success in (True, False, True):
+            self.assertTrue(breaker.allow())
+            breaker.record(success)
+
+        self.assertEqual(breaker.state, CLOSED)
+        breaker.record(False)
+        self.assertEqual(breaker.state, OPEN)
+        self.assertFalse(breaker.allow())
+        self.assertEqual(breaker.stats().rejected, 1)
+
+        time.sleep(0.06)
+        self.assertEqual(breaker.state, HALF_OPEN)
+        self.assertTrue(breaker.allow())
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.record(True)
+        breaker.record(True)
+        self.assertEqual(breaker.state, CLOSED)
+
+    def test_failed_trial_reopens(self):
+        breaker = CircuitBreaker(minimum_calls=1, open_time=0.05)
+        breaker.record(False)
+        time.sleep(0.06)
+        self.assertTrue(breaker.allow())
+        breaker.record(False)
+        self.assertEqual(breaker.state, OPEN)
+
+    def test_trial_is_given_back_when_the_call_is_not_made(self):
+        breaker = CircuitBreaker(minimum_calls=1, open_time=0.05, half_open_calls=1)
+        limiter = ConcurrencyLimiter(initial_limit=1, max_limit=1, max_wait=0.01)
+        with MockCleanSpeakServer() as server:
+            client = CleanSpeakClient('key', server.url, circuit_breaker=breaker, concurrency_limiter=limiter)
+            breaker.record(False)
+            time.sleep(0.06)
+
+            limiter.acquire()
+            self.assertRaises(ConcurrencyLimitError, client.filter, {'content': 'hello'})
+            self.assertEqual(breaker.state, HALF_OPEN)
+            limiter.release(0.01, False)
+
+            self.assertEqual(client.filter({'content': 'hello'}).status, 200)
+            self.assertEqual(breaker.state, CLOSED)
+            client.close()
+
+    def test_fallback_is_called_with_the_path(self):
+        calls = []
+
+        def fallback(method, path, request):
+            calls.append((method, path, request))
+            return ClientResponse(CachedResponse(200, b'{}'))
+
+        with MockCleanSpeakServer() as server:
+            for base_url in (server.url + '/', [server.url, server.url]):
+                breaker = CircuitBreaker(minimum_calls=1)
+                breaker.record(False)
+                with CleanSpeakClient('key', base_url, circuit_breaker=breaker, fallback=fallback) as client:
+                    self.assertEqual(client.moderate('c1', {'content': {}}).status, 200)
+
+            self.assertEqual(server.requests, 0)
+
+        self.assertEqual(calls, [('POST', '/content/item/moderate/c1', {'content': {}})] * 2)
+
+
+class ConcurrencyLimiterTest(unittest2.TestCase):
+    def test_additive_increase_multiplicative_decrease(self):
+        limiter = ConcurrencyLimiter(initial_limit=10, backoff_ratio=0.5)
+        for _ in range(10):
+            limiter.acquire()
+            limiter.release(0.01, False)
+
+        self.assertEqual(limiter.stats().limit, 10)
+        limiter.acquire()
+        limiter.release(0.01, False)
+        self.assertEqual(limiter.stats().limit, 11)
+
+        limiter.acquire()
+        limiter.release(0.01, True)
+        self.assertEqual(limiter.stats().limit, 5)
+
+        # Only once per round of calls
+        limiter.acquire()
+        limiter.release(0.01, True)
+        self.assertEqual(limiter.stats().limit, 5)
+
+    def test_high_latency_is_congestion(self):
+        limiter = ConcurrencyLimiter(initial_limit=10, backoff_ratio=0.5)
+        limiter.acquire()
+        limiter.release(0.01, False)
+        limiter.acquire()
+        limiter.release(1.0, False)
+        self.assertEqual(limiter.stats().limit, 5)
+
+    def test_waits_for_a_slot(self):
+        limiter = ConcurrencyLimiter(initial_limit=1, max_wait=0.05)
+        limiter.acquire()
+        self.assertRaises(ConcurrencyLimitError, limiter.acquire)
+        self.assertEqual(limiter.stats().rejected, 1)
+
+        threading.Timer(0.01, limiter.release, (0.01, False)).start()
+        limiter.acquire(time.time() + 1)
+        self.assertEqual(limiter.stats().in_flight, 1)
+
+
+class RateLimiterTest(unittest2.TestCase):
+    def test_rate_is_capped(self):
+        limiter = RateLimiter(100, burst=5)
+        started = time.time()
+        threads = [threading.Thread(target=lambda: [limiter.acquire() for _ in range(5)]) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        # The burst goes through at once and the other 15 calls are spread over 0.15 seconds
+        self.assertGreaterEqual(time.time() - started, 0.14)
+
+
+if __name__ == '__main__':
+    unittest2.main()
@@ -0,0 +1,141 @@
+#
+# Copyright (c) 2016, Inversoft Inc., All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+# either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+#
+
+import os
+
+import tempfile
+
+import threading
+
+import time
+
+import unittest2
+
+from com.inversoft.cleanspeak_client import CachedResponse, CleanSpeakClient, ClientResponse
+from com.inversoft.cleanspeak_resilience import RetryPolicy
+from com.inversoft.cleanspeak_spool import Spool
+
+
+class SpoolTest(unittest2.TestCase):
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'spool.db')
+
+    def test_entries_survive_reopening(self):
+        spool = Spool(self.path)
+        spool.append('moderate', ['c1', {'content': {}}], 'c1')
+        spool.close()
+
+        spool = Spool(self.path)
+        self.assertEqual(len(spool), 1)
+        self.assertTrue(spool.has_pending('c1'))
+        self.assertFalse(spool.has_pending('c2'))
+        spool.close()
+
+    def test_replay_keeps_key_order(self):
+        spool = Spool(self.path)
+        spool.append('moderate', ['c1', {}], 'c1')
+        spool.append('flag', ['c1', {}], 'c1')
+        spool.append('moderate', ['c2', {}], 'c2')
+        calls = []
+
+        def call(method, args):
+            calls.append((method, args[0]))
+            status = 503 if (method, args[0]) == ('moderate', 'c1') else 200
+            return ClientResponse(CachedResponse(status, b'{}'))
+
+        result = spool.replay(call)
+
+        self.assertEqual(calls, [('moderate', 'c1'), ('moderate', 'c2')])
+        self.assertEqual(tuple(result), (2, 1, 2, 0))
+
+        calls[:] = []
+        result = spool.replay(lambda method, args: calls.append(method) or ClientResponse(CachedResponse(200, b'{}')))
+
+        self.assertEqual(calls, ['moderate', 'flag'])
+        self.assertEqual(result.remaining, 0)
+        spool.close()
+
+    def test_dead_letters(self):
+        spool = Spool(self.path, max_attempts=2)
+        spool.append('moderate', ['c1', {}], 'c1')
+        spool.append('flag', ['c1', {}], 'c1')
+        spool.append('moderate', ['c2', {}], 'c2')
+        spool.append('moderate', ['c3', {}], 'c3')
+
+        def call(method, args):
+            if method == 'moderate' and args[0] == 'c1':
+                raise TypeError('bad arguments')
+            if args[0] == 'c2':
+                return ClientResponse(CachedResponse(400, b'{}'))
+            if args[0] == 'c3':
+                return ClientResponse(None, exception=IOError('connection refused'))
+
+            return ClientResponse(CachedResponse(200, b'{}'))
+
+        # The call that raised no longer holds back the later calls for its key
+        result = spool.replay(call)
+        self.assertEqual(tuple(result), (4, 1, 1, 2))
+        self.assertFalse(spool.has_pending('c1'))
+
+        result = spool.replay(call)
+        self.assertEqual(tuple(result), (1, 0, 0, 1))
+
+        dead_letters = spool.dead_letters()
+        self.assertEqual([(letter.key, letter.method, letter.attempts) for letter in dead_letters],
+                         [('c1', 'moderate', 1), ('c2', 'moderate', 1), ('c3', 'moderate', 2)])
+        self.assertEqual(dead_letters[0].args, ['c1', {}])
+        self.assertIn('TypeError', dead_letters[0].error)
+        self.assertEqual(dead_letters[1].error, 'HTTP status 400')
+        spool.close()
+
+    def test_replays_do_not_overlap(self):
+        spool = Spool(self.path)
+        for i in range(5):
+            spool.append('moderate', ['c%d' % i, {}], 'c%d' % i)
+
+        calls = []
+
+        def call(method, args):
+            calls.append(args[0])
+            time.sleep(0.01)
+            return ClientResponse(CachedResponse(200, b'{}'))
+
+        threads = [threading.Thread(target=spool.replay, args=(call,)) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted(calls), ['c0', 'c1', 'c2', 'c3', 'c4'])
+        spool.close()
+
+    def test_client_only_spools_failures_to_reach_cleanspeak(self):
+        client = CleanSpeakClient('key', 'http://127.0.0.1:1', spool=Spool(self.path), retry_policy=RetryPolicy(max_attempts=1))
+        self.assertRaises(TypeError, client.moderate, 'c1', {'content': object()})
+        self.assertEqual(len(client.spool), 0)
+
+        client_response = client.moderate('c1', {'content': {}})
+        self.assertTrue(client_response.spooled)
+        self.assertIsNotNone(client_response.exception)
+        self.assertEqual(len(client.spool), 1)
+
+        result = client.replay_spool()
+        self.assertEqual((result.failed, result.remaining, result.dead_lettered), (1, 1, 0))
+        client.close()
+
+
+if __name__ == '__main__':
+    unittest2.main()
@@ -0,0 +1,179 @@
+#
+# Copyright (c) 2016, Inversoft Inc., All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+# either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+#
+
+import contextlib
+
+import io
+
+import json
+
+import os
+
+import random
+
+import tempfile
+
+import threading
+
+import time
+
+import unittest2
+
+from com.inversoft.cleanspeak_stream import Checkpoint, StreamPipeline, main
+from cleanspeak_mock_server import MockCleanSpeakServer
+
+
+def slow_call(item):
+    time.sleep(random.random() / 100)
+    return item * 2
+
+
+def failing_call(item):
+    raise IOError('connection reset')
+
+
+class StreamPipelineTest(unittest2.TestCase):
+    def test_ordered(self):
+        results = list(StreamPipeline(slow_call, window=4, ordered=True).run(range(50)))
+
+        self.assertEqual([result.index for result in results], list(range(50)))
+        self.assertEqual([result.response for result in results], [i * 2 for i in range(50)])
+
+    def test_unordered(self):
+        results = list(StreamPipeline(slow_call, window=4).run(range(50)))
+
+        self.assertEqual(sorted(result.index for result in results), list(range(50)))
+
+    def test_errors_are_captured(self):
+        results = list(StreamPipeline(failing_call, window=2).run(range(3)))
+
+        self.assertEqual(len(results), 3)
+        self.assertEqual(results[0].response.status, -1)
+        self.assertIsInstance(results[0].response.exception, IOError)
+
+    def test_resume_from_checkpoint(self):
+        checkpoint = os.path.join(tempfile.mkdtemp(), 'checkpoint')
+        pipeline = StreamPipeline(slow_call, window=4, ordered=True, checkpoint=checkpoint, checkpoint_interval=5)
+
+        results = pipeline.run(range(50))
+        for result in results:
+            if result.index == 20:
+                break
+        results.close()
+
+        self.assertEqual(pipeline.read_checkpoint(), 20)
+        self.assertEqual([result.index for result in pipeline.run(range(50))], list(range(20, 50)))
+
+    def test_resume_unordered_skips_the_completed_items(self):
+        checkpoint = os.path.join(tempfile.mkdtemp(), 'checkpoint')
+        calls = []
+        first_released = threading.Event()
+
+        def call(item):
+            calls.append(item)
+            if item == 0:
+                first_released.wait(5)
+
+            return item
+
+        pipeline = StreamPipeline(call, window=4, checkpoint=checkpoint, checkpoint_interval=1, checkpoint_data=lambda: 'state')
+        results = pipeline.run(range(10))
+        handed_back = [next(results).index for _ in range(3)]
+        self.assertEqual(sorted(handed_back), [1, 2, 3])
+        # The window is full of the items completed ahead of the first one, so no other item was started
+        self.assertEqual(sorted(calls), [0, 1, 2, 3])
+        first_released.set()
+        results.close()
+
+        # The last result was not complete, since the caller did not ask for the next one
+        self.assertEqual(pipeline.load_checkpoint(), Checkpoint(0, frozenset(handed_back[:2]), 'state'))
+        self.assertEqual(pipeline.read_checkpoint(), 2)
+        self.assertEqual(sorted(result.index for result in pipeline.run(range(10))), [0, handed_back[2], 4, 5, 6, 7, 8, 9])
+        self.assertEqual(pipeline.load_checkpoint(), Checkpoint(10, frozenset(), 'state'))
+
+    def test_checkpoint_of_a_watermark(self):
+        checkpoint = os.path.join(tempfile.mkdtemp(), 'checkpoint')
+        with open(checkpoint, 'w') as f:
+            f.write('5')
+
+        pipeline = StreamPipeline(slow_call, checkpoint=checkpoint)
+        self.assertEqual(pipeline.load_checkpoint(), Checkpoint(5, frozenset(), None))
+        self.assertEqual(sorted(result.index for result in pipeline.run(range(8))), [5, 6, 7])
+
+    def test_resume_ordered_from_an_unordered_checkpoint(self):
+        checkpoint = os.path.join(tempfile.mkdtemp(), 'checkpoint')
+        with open(checkpoint, 'w') as f:
+            f.write(json.dumps({'watermark': 0, 'completed': [1, 3]}))
+
+        pipeline = StreamPipeline(slow_call, window=4, ordered=True, checkpoint=checkpoint)
+        results = list(pipeline.run(range(20)))
+        self.assertEqual([result.index for result in results], [0, 2] + list(range(4, 20)))
+        self.assertEqual([result.response for result in results], [index * 2 for index in [0, 2] + list(range(4, 20))])
+        self.assertEqual(pipeline.load_checkpoint(), Checkpoint(20, frozenset(), None))
+
+
+class StreamMainTest(unittest2.TestCase):
+    def setUp(self):
+        self.server = MockCleanSpeakServer()
+        self.server.start()
+        self.directory = tempfile.mkdtemp()
+        self.input = os.path.join(self.directory, 'input.jsonl')
+        self.output = os.path.join(self.directory, 'output.jsonl')
+        self.checkpoint = os.path.join(self.directory, 'checkpoint')
+        with open(self.input, 'w') as f:
+            for i in range(30):
+                f.write(json.dumps({'content': 'bad %d' % i if i % 3 == 0 else 'hello %d' % i}) + '\n')
+
+    def tearDown(self):
+        self.server.stop()
+
+    def main(self):
+        with contextlib.redirect_stderr(io.StringIO()):
+            return main(['filter', '--api-key', 'key', '--url', self.server.url, '--input', self.input, '--output', self.output,
+                         '--checkpoint', self.checkpoint, '--window', '4'])
+
+    def read_output(self):
+        with open(self.output) as f:
+            return [json.loads(line) for line in f]
+
+    def test_filter(self):
+        self.assertEqual(self.main(), 0)
+
+        output = sorted(self.read_output(), key=lambda line: line['index'])
+        self.assertEqual([line['index'] for line in output], list(range(30)))
+        self.assertEqual(output[0], {'index': 0, 'status': 200, 'response': {'matches': [{'matched': 'bad', 'length': 3}]}})
+        self.assertEqual(output[1], {'index': 1, 'status': 200, 'response': {'matches': []}})
+        self.assertEqual(self.server.requests, 30)
+
+    def test_resume_does_not_duplicate_results(self):
+        self.main()
+        lines = {line['index']: json.dumps(line) + '\n' for line in self.read_output()}
+
+        # A run that stopped after checkpointing items 0-9 and 12, and wrote 10 and 11 before it could checkpoint them
+        recorded = ''.join(lines[index] for index in list(range(10)) + [12])
+        with open(self.output, 'w') as f:
+            f.write(recorded + lines[10] + lines[11])
+        with open(self.checkpoint, 'w') as f:
+            json.dump({'watermark': 10, 'completed': [12], 'data': len(recorded)}, f)
+
+        self.server.requests = 0
+        self.assertEqual(self.main(), 0)
+        self.assertEqual(sorted(line['index'] for line in self.read_output()), list(range(30)))
+        self.assertEqual(self.server.requests, 19)
+
+
+if __name__ == '__main__':
+    unittest2.main()
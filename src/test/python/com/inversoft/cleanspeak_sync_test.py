@@ -0,0 +1,135 @@
+#
+# Copyright (c) 2016, Inversoft Inc., All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+# either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+#
+
+import os
+
+import shutil
+
+import tempfile
+
+import unittest2
+
+from com.inversoft.cleanspeak_client import CachedResponse, CleanSpeakClient, ClientResponse
+from com.inversoft.cleanspeak_sync import CREATE, UPDATE, FingerprintIndex, Sync
+from cleanspeak_mock_server import MockCleanSpeakServer
+
+
+class SyncTest(unittest2.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.index = FingerprintIndex(os.path.join(self.directory, 'index.db'))
+        self.server = MockCleanSpeakServer()
+        self.server.start()
+        self.client = CleanSpeakClient('key', self.server.url)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+        self.index.close()
+        shutil.rmtree(self.directory)
+
+    def test_only_changes_are_sent(self):
+        users = [('user-%d' % i, {'user': {'id': 'user-%d' % i, 'name': 'User %d' % i}}) for i in range(10)]
+        report = self.client.sync_users(users, self.index, concurrency=4)
+        self.assertEqual((report.created, report.updated, report.deleted, report.unchanged, report.failed), (10, 0, 0, 0, 0))
+        self.assertEqual(self.index.count('user'), 10)
+
+        requests = self.server.requests
+        report = self.client.sync_users(iter(users), self.index)
+        self.assertEqual((report.created, report.updated, report.deleted, report.unchanged), (0, 0, 0, 10))
+        self.assertEqual(self.server.requests, requests)
+
+        users[0] = ('user-0', {'user': {'id': 'user-0', 'name': 'Renamed'}})
+        report = self.client.sync_users(users[:9], self.index, rate=1000, delete=True)
+        self.assertEqual((report.created, report.updated, report.deleted, report.unchanged), (0, 1, 1, 8))
+        self.assertEqual(self.server.requests, requests + 2)
+        self.assertEqual(self.index.count('user'), 9)
+
+        report = self.client.sync_applications([('application-0', {'application': {'name': 'Chat'}})], self.index)
+        self.assertEqual(report.created, 1)
+        self.assertEqual(self.index.count('user'), 9)
+
+    def test_deletes_are_guarded(self):
+        users = [('user-%d' % i, {'user': {'id': 'user-%d' % i}}) for i in range(5)]
+        self.client.sync_users(users, self.index)
+
+        # Deleting is off by default
+        report = self.client.sync_users(users[:4], self.index)
+        self.assertEqual((report.deleted, report.refused_deletes, report.unchanged), (0, 0, 4))
+
+        requests = self.server.requests
+        report = self.client.sync_users([], self.index, delete=True, max_delete_ratio=1.0)
+        self.assertEqual((report.deleted, report.refused_deletes), (0, 5))
+
+        report = self.client.sync_users(users[:3], self.index, delete=True, max_delete_ratio=0.2)
+        self.assertEqual((report.deleted, report.refused_deletes), (0, 2))
+        self.assertEqual(self.server.requests, requests)
+        self.assertEqual(self.index.count('user'), 5)
+
+        report = self.client.sync_users(users[:3], self.index, delete=True, max_delete_ratio=0.5)
+        self.assertEqual((report.deleted, report.refused_deletes), (2, 0))
+        self.assertEqual(self.index.count('user'), 3)
+
+    def test_failures_are_reported(self):
+        client = _FakeClient(create_status=400)
+        report = Sync(client, self.index, 'user').run([('user', {'user': {}})])
+        self.assertEqual(report.failed, 1)
+        self.assertEqual(report.failures[0].id, 'user')
+        self.assertEqual(report.failures[0].action, CREATE)
+        self.assertEqual(report.failures[0].response.status, 400)
+        self.assertEqual(client.calls, ['create_user'])
+        self.assertEqual(self.index.count('user'), 0)
+
+        client = _FakeClient(create_status=409, update_status=500)
+        report = Sync(client, self.index, 'user').run([('user', {'user': {}})])
+        self.assertEqual((report.failures[0].action, report.failures[0].response.status), (UPDATE, 500))
+        self.assertEqual(client.calls, ['create_user', 'update_user'])
+
+    def test_existing_records_are_updated(self):
+        # A user created before the index existed is updated instead
+        client = _FakeClient(create_status=400, create_body=b'{"fieldErrors":{"user.id":[{"code":"[duplicate]user.id"}]}}')
+        report = Sync(client, self.index, 'user').run([('user', {'user': {}})])
+        self.assertEqual((report.created, report.updated, report.failed), (0, 1, 0))
+        self.assertEqual(self.index.count('user'), 1)
+
+    def test_unknown_kind(self):
+        self.assertRaises(ValueError, Sync, self.client, self.index, 'moderator')
+
+
+class _FakeClient:
+    bulk_concurrency = 2
+
+    def __init__(self, create_status=200, update_status=200, create_body=b'{}'):
+        self.create_status = create_status
+        self.create_body = create_body
+        self.update_status = update_status
+        self.calls = []
+
+    def create_user(self, user_id, user_request):
+        self.calls.append('create_user')
+        return ClientResponse(CachedResponse(self.create_status, self.create_body))
+
+    def update_user(self, user_id, user_request):
+        self.calls.append('update_user')
+        return ClientResponse(CachedResponse(self.update_status, b'{}'))
+
+    def deleted_user(self, user_id):
+        self.calls.append('deleted_user')
+        return ClientResponse(CachedResponse(200, b'{}'))
+
+
+if __name__ == '__main__':
+    unittest2.main()
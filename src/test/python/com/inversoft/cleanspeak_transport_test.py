@@ -0,0 +1,159 @@
+#
+# Copyright (c) 2016, Inversoft Inc., All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+# either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+#
+
+import os
+
+import socket
+
+import tempfile
+
+import threading
+
+import unittest2
+
+from com.inversoft.cleanspeak_client import CleanSpeakClient
+from com.inversoft.cleanspeak_resilience import RetryPolicy
+from com.inversoft.cleanspeak_transport import ConnectError, HTTPClientTransport, TransportError
+from cleanspeak_mock_server import MockCleanSpeakServer
+
+
+class _DroppingServer:
+    """Answers the first request on each connection with a keep-alive response, then reads the second one and closes the connection without
+    answering it, like a server that closes an idle connection while a request is on its way."""
+
+    def __init__(self):
+        self.requests = []
+        self._stopped = threading.Event()
+        self._socket = socket.create_server(('127.0.0.1', 0))
+        # Closing the socket does not wake up a thread blocked in accept(), so the thread checks for stop() instead
+        self._socket.settimeout(0.05)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self._socket.getsockname()[1]
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+        self._socket.close()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                connection, _ = self._socket.accept()
+            except socket.timeout:
+                continue
+
+            with connection:
+                connection.settimeout(5)
+                if self._read_request(connection):
+                    connection.sendall(b'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nContent-Length: 2\r\n\r\n{}')
+                    self._read_request(connection)
+
+    def _read_request(self, connection):
+        request = b''
+        while b'\r\n\r\n' not in request:
+            data = connection.recv(4096)
+            if not data:
+                return False
+
+            request += data
+
+        headers, _, body = request.partition(b'\r\n\r\n')
+        lengths = [line.split(b':')[1] for line in headers.split(b'\r\n') if line.lower().startswith(b'content-length:')]
+        while len(body) < int(lengths[0] if lengths else 0):
+            body += connection.recv(4096)
+
+        self.requests.append(headers.split(b' ')[0].decode())
+        return True
+
+
+class HTTPClientTransportTest(unittest2.TestCase):
+    def setUp(self):
+        self.server = MockCleanSpeakServer(backup_size=100000)
+        self.server.start()
+        self.transport = HTTPClientTransport(pool_maxsize=2)
+        self.client = CleanSpeakClient('key', self.server.url, transport=self.transport)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+
+    def test_reuses_connections(self):
+        client_response = self.client.filter({'content': 'a bad word'})
+        self.assertEqual(client_response.status, 200)
+        self.assertEqual(client_response.success_response, {'matches': [{'matched': 'bad', 'length': 3}]})
+        self.assertEqual(self.client.retrieve_user('missing').status, 404)
+        self.assertEqual(len(self.transport._pools[('http', self.server.url[len('http://'):])]), 1)
+
+    def test_stale_connection_is_replaced(self):
+        server = _DroppingServer()
+        self.addCleanup(server.stop)
+        client = CleanSpeakClient('key', server.url, retry_policy=RetryPolicy(max_attempts=1), transport=HTTPClientTransport())
+        self.addCleanup(client.close)
+
+        self.assertEqual(client.retrieve_user('user').status, 200)
+        # A GET is sent again on a new connection when the server closes the pooled one without answering
+        self.assertEqual(client.retrieve_user('user').status, 200)
+        self.assertEqual(server.requests, ['GET', 'GET', 'GET'])
+
+        # The server may have processed a POST before it closed the connection, so it is not sent again
+        self.assertRaises(TransportError, client.moderate, 'id', {'content': {}})
+        self.assertEqual(server.requests, ['GET', 'GET', 'GET', 'POST'])
+
+    def test_backup_and_restore(self):
+        file = os.path.join(tempfile.mkdtemp(), 'backup.zip')
+        client_response = self.client.backup_to_file(file, chunk_size=4096)
+        self.assertEqual(client_response.status, 200)
+        self.assertEqual(client_response.transfer.size, 100000)
+
+        client_response = self.client.restore(file)
+        self.assertEqual(client_response.success_response, {'restored': 100000})
+        os.remove(file)
+
+    def test_connect_error(self):
+        client = CleanSpeakClient('key', 'http://127.0.0.1:1', retry_policy=RetryPolicy(max_attempts=1), transport=HTTPClientTransport())
+        self.assertRaises(ConnectError, client.moderate, 'id', {'content': {}})
+        self.assertTrue(client.transport.was_not_sent(ConnectError()))
+        client.close()
+
+    @unittest2.skipUnless(hasattr(os, 'fork'), 'requires os.fork()')
+    def test_fork(self):
+        self.client.filter({'content': 'hello'})
+        dispatcher = self.client.dispatcher(workers=2)
+        pid = os.fork()
+        if pid == 0:
+            # The child must not use the connections of the parent, and gets its own dispatcher threads
+            status = 1
+            try:
+                if not self.transport._pools and all(thread.is_alive() for thread in dispatcher._threads) and \
+                        self.client.filter({'content': 'bad'}).status == 200:
+                    dispatcher.flag_user('user', {'flag': {}})
+                    dispatcher.flush(5)
+                    status = 0 if dispatcher.pending() == 0 else 1
+            finally:
+                os._exit(status)
+
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(status, 0)
+        self.assertEqual(len(dispatcher._threads), 2)
+        self.assertEqual(self.client.filter({'content': 'hello'}).status, 200)
+
+
+if __name__ == '__main__':
+    unittest2.main()
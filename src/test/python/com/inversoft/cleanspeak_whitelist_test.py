@@ -0,0 +1,140 @@
+#
+# Copyright (c) 2016, Inversoft Inc., All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+# either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+#
+
+import os
+
+import shutil
+
+import tempfile
+
+import unittest2
+
+from com.inversoft.cleanspeak_client import CachedResponse, CleanSpeakClient, ClientResponse
+from com.inversoft.cleanspeak_whitelist import LocalWhitelist, WhitelistFileStore, WhitelistIndex
+from cleanspeak_mock_server import MockCleanSpeakServer
+
+
+class WhitelistIndexTest(unittest2.TestCase):
+    def setUp(self):
+        self.index = WhitelistIndex.from_response({'whitelist': ['Good', 'game', 'gg', 'glhf', 'hello', 'well', 'played']})
+
+    def test_is_whitelisted(self):
+        self.assertTrue(self.index.is_whitelisted('gg'))
+        self.assertTrue(self.index.is_whitelisted('Good game, well played!'))
+        self.assertFalse(self.index.is_whitelisted('good game noob'))
+        self.assertFalse(self.index.is_whitelisted('g.g'))
+        self.assertFalse(self.index.is_whitelisted(''))
+        self.assertFalse(self.index.is_whitelisted('!!!'))
+
+    def test_min_word_length(self):
+        index = WhitelistIndex(['a', 'gg', 'f', 'u', 'c', 'k'])
+
+        self.assertTrue(index.is_whitelisted('f u c k'))
+        self.assertFalse(index.is_whitelisted('f u c k', min_word_length=2))
+        self.assertFalse(index.is_whitelisted('a gg', min_word_length=2))
+        self.assertTrue(index.is_whitelisted('gg!', min_word_length=2))
+
+    def test_suggest(self):
+        self.assertEqual(self.index.suggest('g'), ['game', 'gg', 'glhf', 'good'])
+        self.assertEqual(self.index.suggest('G', limit=2), ['game', 'gg'])
+        self.assertEqual(self.index.suggest('x'), [])
+
+    def test_entry_objects(self):
+        index = WhitelistIndex.from_response({'whitelist': [{'word': 'gg'}, {'text': 'lol'}]})
+
+        self.assertIn('GG', index)
+        self.assertIn('lol', index)
+        self.assertEqual(len(index), 2)
+
+
+class WhitelistFileStoreTest(unittest2.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = WhitelistFileStore(os.path.join(self.directory, 'whitelist.json'))
+        self.calls = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def retrieve_whitelist(self):
+        self.calls += 1
+        return ClientResponse(CachedResponse(200, b'{"whitelist":["GG","glhf"]}'))
+
+    def test_one_process_retrieves(self):
+        first = LocalWhitelist(self, refresh_interval=60, store=self.store)
+        second = LocalWhitelist(self, refresh_interval=60, store=self.store)
+
+        self.assertTrue(first.refresh())
+        self.assertTrue(second.refresh())
+        self.assertEqual(self.calls, 1)
+        self.assertTrue(second.is_whitelisted('gg glhf'))
+        self.assertEqual(self.store.load(60), ['gg', 'glhf'])
+
+    def test_stale_store_is_refreshed(self):
+        self.store.save(['old'])
+        self.assertIsNone(self.store.load(-1))
+
+        whitelist = LocalWhitelist(self, refresh_interval=-1, store=self.store)
+        self.assertTrue(whitelist.refresh())
+        self.assertEqual(self.calls, 1)
+        self.assertFalse(whitelist.is_whitelisted('old'))
+
+
+class LocalWhitelistTest(unittest2.TestCase):
+    def retrieve_whitelist(self):
+        return ClientResponse(CachedResponse(200, b'{"whitelist":["good","game","gg","f","u","c","k"]}'))
+
+    def test_allows(self):
+        whitelist = LocalWhitelist(self)
+        self.assertFalse(whitelist.allows({'content': 'good game'}))
+
+        whitelist.refresh()
+        self.assertTrue(whitelist.allows({'content': 'Good game!'}))
+        self.assertFalse(whitelist.allows({'content': 'good game noob'}))
+        # Whitelisted single letters can spell out a word that is not
+        self.assertFalse(whitelist.allows({'content': 'f u c k'}))
+        self.assertFalse(whitelist.allows({'content': 'gg', 'applicationId': 'a1'}))
+        self.assertFalse(whitelist.allows({'content': ''}))
+        self.assertFalse(whitelist.allows('gg'))
+        self.assertEqual(tuple(whitelist.stats()), (1, 6))
+
+
+class WhitelistFastPathTest(unittest2.TestCase):
+    def setUp(self):
+        self.server = MockCleanSpeakServer()
+        self.server.start()
+        self.client = CleanSpeakClient('key', self.server.url, whitelist_fast_path=True)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+
+    def test_whitelisted_content_is_answered_locally(self):
+        client_response = self.client.filter({'content': 'hello world'})
+        self.assertEqual(client_response.status, 200)
+        self.assertEqual(client_response.success_response, {'matches': []})
+        # Only the whitelist was retrieved
+        self.assertEqual(self.server.requests, 1)
+        self.assertEqual(self.server.last_request[1], '/filter/whitelist')
+
+        client_response = self.client.filter({'content': 'hello bad world'})
+        self.assertEqual(client_response.success_response, {'matches': [{'matched': 'bad', 'length': 3}]})
+        self.assertEqual(self.server.requests, 2)
+        self.assertEqual(tuple(self.client.local_whitelist().stats()), (1, 1))
+
+
+if __name__ == '__main__':
+    unittest2.main()